@@ -3,6 +3,7 @@ Train a model to segment the jawbone from labelled DICOM images
 
 """
 
+import os
 import pickle
 import pathlib
 import argparse
@@ -13,6 +14,9 @@ import matplotlib.pyplot as plt
 
 from fishlib.util import files, util
 from fishlib.model import data, model
+from fishlib.model import distributed, batch_planner, checkpoints, artifact
+from fishlib.model.validation import validation_options
+from fishlib.inference import profiles
 from fishlib.visualisation import images_3d, training
 
 
@@ -29,97 +33,208 @@ def _plot_example(out_dir: pathlib.Path, batch: dict[str, torch.Tensor]):
     fig.savefig(f"{out_dir}/train_example.png")
 
 
+def _batch_plan(
+    config: dict, device: str, ranks_per_node: int
+) -> batch_planner.BatchPlan:
+    """
+    Work out how to split each training batch up so that it fits in memory, if
+    `plan_batch_size` is set in the config. Otherwise, batches aren't split up.
+
+    If we're training on several processes, the first one works it out for all of them
+    (and the memory is shared between the processes on each machine).
+
+    """
+    batch_size = distributed.per_rank_batch_size(config["batch_size"])
+    if not config.get("plan_batch_size", False):
+        return batch_planner.BatchPlan(batch_size, 1)
+
+    micro_batch_size = batch_size
+    if distributed.is_main_process():
+        if (limit := config.get("memory_limit_gb")) is None:
+            limit = batch_planner.memory_limit(device)
+        else:
+            limit *= 1024**3
+
+        print(f"Finding the largest batch that fits in {limit / 1024**3:.1f}GB")
+        plan = batch_planner.plan_batches(
+            config | {"device": device},
+            data.get_patch_size(config),
+            batch_size,
+            limit / ranks_per_node,
+        )
+        for size, peak in plan.peak_memory.items():
+            print(f"\t{size} patches: {peak / 1024**3:.2f}GB")
+        micro_batch_size = plan.micro_batch_size
+
+    micro_batch_size = distributed.minimum(micro_batch_size)
+    plan = batch_planner.BatchPlan(micro_batch_size, batch_size // micro_batch_size)
+    if distributed.is_main_process():
+        print(
+            f"Using batches of {plan.micro_batch_size} patches, accumulating gradients"
+            f" over {plan.accumulation_steps} of them"
+        )
+    return plan
+
+
 def train_model(
     config: dict,
     data_config: data.DataConfig,
     out_dir: pathlib.Path,
+    device: str,
+    accumulation_steps: int = 1,
+    *,
+    checkpoint_dir: pathlib.Path | None = None,
+    resume: bool = False,
 ) -> tuple[
-    tuple[torch.nn.Module, list[list[float]], list[list[float]], torch.optim.Optimizer]
+    tuple[torch.nn.Module, list[list[float]], list[list[float]]],
+    torch.optim.Optimizer,
+    model.TrainingConfig,
 ]:
     """
     Create a model, train and return it
 
-    Returns the model, the training losses and the validation losses, and the optimiser
+    Returns the model, the training losses and the validation losses, the optimiser
+    and the training config (which holds the fraction of foreground in each training
+    batch and how long each epoch took)
+
+    If `checkpoint_every` is set in the config, checkpoints are saved in
+    `checkpoint_dir`; if `resume` is set, training carries on from the latest one.
 
     """
     # Create a model and optimiser
-    net = model.model(config["model_params"])
-
-    device = config["device"]
+    net = model.model(config["model_params"], train=True)
     net = net.to(device)
 
     optimiser = model.optimiser(config, net)
 
     # Plot an example of the training data (which has been augmented)
-    _plot_example(out_dir, next(iter(data_config.train_data)))
+    # Every process takes a batch, so that they stay in step
+    example = next(iter(data_config.train_data))
+    if distributed.is_main_process():
+        _plot_example(out_dir, example)
 
     # Define loss function
     loss = model.lossfn(config)
 
+    validation = validation_options(config)
+    # Use bfloat16 for validation if the machine's execution profile does
+    validation_autocast, validation_autocast_dtype = (
+        validation["autocast"] is True,
+        None,
+    )
+    if validation["autocast"] == "profile":
+        validation_autocast = profiles.get().bf16
+        validation_autocast_dtype = torch.bfloat16
     train_config = model.TrainingConfig(
         device,
         config["epochs"],
         torch.optim.lr_scheduler.ExponentialLR(optimiser, gamma=config["lr_lambda"]),
+        validation_every=validation["every"],
+        validation_autocast=validation_autocast,
+        validation_autocast_dtype=validation_autocast_dtype,
+        prefetch=config.get("prefetch_batches", 2),
+        accumulation_steps=accumulation_steps,
+        checkpoint=config.get("checkpoint_every") is not None,
+        checkpoint_dir=checkpoint_dir,
+        checkpoint_every=config.get("checkpoint_every") or 1,
+        keep_checkpoints=config.get("keep_checkpoints", 3),
+        resume=resume,
     )
     return (
         model.train(net, optimiser, loss, data_config, train_config),
         optimiser,
+        train_config,
     )
 
 
-def main():
+def _train(
+    config: dict,
+    model_path: pathlib.Path,
+    device: str,
+    ranks_per_node: int = 1,
+    resume: bool = False,
+) -> None:
     """
-    Get the right data, train the model and create some outputs
+    Read the data, train the model and (on the main process) save it and
+    create some outputs
 
     """
-    config = util.userconf()
-
-    # If the model is already cached, don't train it again
-    model_path = files.model_path(config)
     model_dir = model_path.parent
-    if model_path.is_file():
-        raise FileExistsError(f"Model already exists at {model_path}")
-    if not model_dir.is_dir():
-        model_path.parent.mkdir(parents=True)
+    is_main = distributed.is_main_process()
 
-    print(f"Training model to save at {model_path}")
-
-    torch.manual_seed(config["torch_seed"])
+    # Each process gets a different seed so they augment differently; the model
+    # parameters are copied from the first process anyway
+    torch.manual_seed(config["torch_seed"] + distributed.rank())
 
     # Find the activation - we'll need this for inference
     activation = model.activation_name(config)
 
-    # Read the data from disk (from the DICOMs created by create_dicoms.py)
+    # Read the data from disk (from the DICOMs created by create_dicoms.py). With a
+    # patch bank the training patches are already made, so the training DICOMs
+    # aren't needed
     train_subjects, val_subjects, test_subject = data.read_dicoms_from_disk(
-        config, verbose=True
+        config, verbose=is_main, train=config.get("patch_bank") is None
+    )
+    plan = _batch_plan(config, device, ranks_per_node)
+    data_config = data.DataConfig(
+        config, train_subjects, val_subjects, micro_batch_size=plan.micro_batch_size
     )
-    data_config = data.DataConfig(config, train_subjects, val_subjects)
 
     # Save the testing subject
     output_dir = model_dir / "train_output"
-    if not output_dir.is_dir():
-        output_dir.mkdir(parents=True)
-    print(f"Saving outputs to {output_dir}")
+    if is_main:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        print(f"Saving outputs to {output_dir}")
 
-    with open(output_dir / "test_subject.pkl", "wb") as f:
-        pickle.dump(test_subject, f)
+        with open(output_dir / "test_subject.pkl", "wb") as f:
+            pickle.dump(test_subject, f)
 
-    (net, train_losses, val_losses), optimiser = train_model(
-        config, data_config, output_dir
+    (net, train_losses, val_losses), optimiser, train_config = train_model(
+        config,
+        data_config,
+        output_dir,
+        device,
+        plan.accumulation_steps,
+        checkpoint_dir=checkpoints.checkpoint_dir(model_path),
+        resume=resume,
     )
 
+    # Only the first process writes anything
+    if not is_main:
+        return
+
     # Save the model
     with open(str(model_path), "wb") as f:
         pickle.dump(
             model.ModelState(net.state_dict(), optimiser.state_dict(), config),
             f,
         )
+    # ...and as an artifact, which is quicker to load for inference
+    artifact.save(model_path, net.state_dict(), config, optimiser.state_dict())
+
+    # We don't need the checkpoints once the model is saved; leaving them would stop
+    # the next model with this name being trained
+    checkpoints.remove(checkpoints.checkpoint_dir(model_path))
 
     # Plot the loss
     fig = training.plot_losses(train_losses, val_losses)
     fig.savefig(str(output_dir / "loss.png"))
     plt.close(fig)
 
+    fig = training.plot_foreground_fractions(train_config.foreground_fractions)
+    fig.savefig(str(output_dir / "foreground_fraction.png"))
+    plt.close(fig)
+
+    data_wait = [timing.data_wait for timing in train_config.epoch_timings]
+    compute = [timing.compute for timing in train_config.epoch_timings]
+    print(
+        f"Spent {sum(data_wait):.1f}s waiting for training data and "
+        f"{sum(compute):.1f}s on everything else"
+    )
+    fig = training.plot_epoch_timings(data_wait, compute)
+    fig.savefig(str(output_dir / "epoch_timing.png"))
+    plt.close(fig)
+
     # Plot the testing image
     fig = images_3d.plot_inference(
         net,
@@ -138,9 +253,173 @@ def main():
     plt.close(fig)
 
 
+def _train_rank(
+    local_rank: int,
+    config: dict,
+    model_path: pathlib.Path,
+    ranks: int,
+    nodes: int,
+    node_rank: int,
+    init_method: str,
+    threads: int,
+    resume: bool,
+) -> None:
+    """
+    Train on one of several processes; run by `torch.multiprocessing.spawn`
+
+    """
+    distributed.setup(
+        node_rank * ranks + local_rank, nodes * ranks, init_method, threads
+    )
+    try:
+        _train(config, model_path, "cpu", ranks, resume)
+    finally:
+        distributed.cleanup()
+
+
+def _rendezvous(
+    model_path: pathlib.Path,
+    rendezvous: pathlib.Path | None,
+    nodes: int,
+    node_rank: int,
+) -> pathlib.Path:
+    """
+    Where the processes find each other
+
+    A file left behind by a run that crashed would make this one hang or join the
+    old run, so the first machine won't start if the file's already there.
+
+    :param model_path: where the model will be saved
+    :param rendezvous: the file asked for, or None for the default: one named after the
+                       model and this process on one machine, or after just the model
+                       if there are several (since they all need to agree on it)
+    :param nodes: how many machines are training
+    :param node_rank: which one this is
+
+    :returns: the rendezvous file
+    :raises FileExistsError: if this is the first machine and the file already exists
+
+    """
+    if rendezvous is None:
+        suffix = f".{os.getpid()}.rendezvous" if nodes == 1 else ".rendezvous"
+        rendezvous = model_path.with_name(model_path.stem + suffix)
+
+    if node_rank == 0 and rendezvous.exists():
+        raise FileExistsError(
+            f"Rendezvous file {rendezvous} already exists, maybe from a run that"
+            " crashed; delete it if nothing else is using it"
+        )
+    return rendezvous
+
+
+def main(
+    *,
+    ranks: int,
+    nodes: int,
+    node_rank: int,
+    rendezvous: pathlib.Path | None,
+    threads_per_rank: int | None,
+    resume: bool,
+):
+    """
+    Get the right data, train the model and create some outputs
+
+    """
+    config = util.userconf()
+
+    # If the model is already cached, don't train it again
+    # Only the first machine checks, since the others might start after it's been made
+    model_path = files.model_path(config)
+    if node_rank == 0 and model_path.is_file():
+        raise FileExistsError(f"Model already exists at {model_path}")
+    model_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Don't mix up checkpoints from an earlier run with this one
+    checkpoint_dir = checkpoints.checkpoint_dir(model_path)
+    if node_rank == 0 and not resume and checkpoints.list_checkpoints(checkpoint_dir):
+        raise FileExistsError(
+            f"Checkpoints already exist in {checkpoint_dir};"
+            " use --resume to carry on from them, or delete them"
+        )
+
+    if ranks == 1 and nodes == 1:
+        print(f"Training model to save at {model_path}")
+        _train(config, model_path, config["device"], resume=resume)
+        return
+
+    rendezvous = _rendezvous(model_path, rendezvous, nodes, node_rank)
+    if threads_per_rank is None:
+        threads_per_rank = max(1, (os.cpu_count() or 1) // ranks)
+
+    print(
+        f"Training model to save at {model_path} on {ranks} processes x {nodes}"
+        f" machines, {threads_per_rank} threads each (rendezvous at {rendezvous})"
+    )
+    try:
+        torch.multiprocessing.spawn(
+            _train_rank,
+            args=(
+                config,
+                model_path,
+                ranks,
+                nodes,
+                node_rank,
+                distributed.file_init_method(rendezvous),
+                threads_per_rank,
+                resume,
+            ),
+            nprocs=ranks,
+        )
+    finally:
+        # The other machines have finished with it once our processes have
+        if node_rank == 0:
+            rendezvous.unlink(missing_ok=True)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Train a model to segment the jawbone."
         "Configuration (hyperparams, model name etc.) is in `userconf.yml`."
     )
+    parser.add_argument(
+        "--ranks",
+        type=int,
+        default=1,
+        help="Number of training processes to run on this machine. If more than one,"
+        " the processes train data-parallel on the CPU",
+    )
+    parser.add_argument(
+        "--nodes",
+        type=int,
+        default=1,
+        help="Number of machines taking part in training. Run this script on each"
+        " of them with the same settings and a different --node-rank",
+    )
+    parser.add_argument(
+        "--node-rank",
+        type=int,
+        default=0,
+        help="Which machine this is, from 0 to nodes - 1. Only machine 0 writes outputs",
+    )
+    parser.add_argument(
+        "--rendezvous",
+        type=pathlib.Path,
+        default=None,
+        help="A file on a filesystem shared by all the machines, that the processes use"
+        " to find each other. Mustn't exist already, and is deleted at the end."
+        " Defaults to a file next to the model, named after this run if there's only"
+        " one machine",
+    )
+    parser.add_argument(
+        "--threads-per-rank",
+        type=int,
+        default=None,
+        help="Threads for each process. Defaults to sharing this machine's cores"
+        " between the processes",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Carry on training from the latest checkpoint, e.g. after a crash",
+    )
     main(**vars(parser.parse_args()))
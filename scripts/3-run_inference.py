@@ -19,17 +19,63 @@ EXAMPLE
 
 """
 
+import os
 import sys
+import math
+import time
 import pathlib
 import argparse
+import contextlib
+import dataclasses
 import tifffile
 
-from tqdm import tqdm
+import numpy as np
+from pydicom.errors import InvalidDicomError
 
 from fishlib.util import files, util
-from fishlib.inference import models, io
+from fishlib.model import data, artifact
+from fishlib.model.validation import grid_starts
+from fishlib.inference import models, io, backends, profiles, compiled
+from fishlib.inference.cache import (
+    StageCache,
+    STAGES,
+    file_fingerprint,
+    array_digest,
+    key,
+)
+from fishlib.inference.pipeline import Pipeline, run_in_processes
+from fishlib.inference.work_queue import WorkQueue
 from fishlib.images.transform import CropOutOfBoundsError
 
+# Passed to `models.segment_objects`; part of the segmentation cache key
+_SEGMENT_OPTIONS = {"threshold": 0.5, "largest_component": True}
+
+
+def _scans_per_batch(
+    config: dict, crop_size: int, batch_size: int, n_scans: int
+) -> int:
+    """
+    How many cropped scans it takes to fill a batch of patches
+
+    """
+    patches_per_scan = len(
+        grid_starts((crop_size,) * 3, data.get_patch_size(config), models.PATCH_OVERLAP)
+    )
+    return max(1, min(n_scans, math.ceil(batch_size / patches_per_scan)))
+
+
+def _output_paths(
+    path: pathlib.Path, img_out_dir: pathlib.Path, mask_out_dir: pathlib.Path
+) -> tuple[pathlib.Path, pathlib.Path]:
+    """
+    Where to save the cropped image and mask for an input
+
+    """
+    return (
+        (img_out_dir / path.name).with_suffix(".tif"),
+        (mask_out_dir / path.name).with_suffix(".tif"),
+    )
+
 
 def main(
     locator_model: str,
@@ -40,6 +86,22 @@ def main(
     downsampled_input_size: list[int, int, int],
     device: str,
     output_dir: pathlib.Path,
+    readers: int,
+    writers: int,
+    queue_size: int,
+    workers: int,
+    threads_per_worker: int | None,
+    work_queue: pathlib.Path | None,
+    lease_time: float,
+    cache_dir: pathlib.Path | None,
+    force_stage: list[str],
+    batch_size: int | None,
+    skip_threshold: float | None,
+    whole_window: bool,
+    backend: str,
+    profile: str | None,
+    compile_mode: str,
+    compile_cache_dir: pathlib.Path | None,
 ):
     """
     Segment out the data given the provided models and configuration.
@@ -51,9 +113,30 @@ def main(
      - segment the objet out from the cropped image
      - save the cropped image and corresponding segmentation mask
 
+    Reading and writing happen in background threads, at the same time as the
+    models run on other scans. With more than one worker, that all happens in each
+    of several processes that share one copy of the models.
+
+    With a work queue, each scan is claimed before it's read, so several copies of
+    this script (e.g. on different machines) can share the scans between them.
+
+    With a cache, the results of each step are kept and reused next time if nothing
+    they depend on has changed - e.g. if only the segmentation model is different,
+    the scans aren't read or located again.
+
+    The models are run with an execution profile (threads, memory layout and
+    precision); by default the one saved for this machine by
+    `benchmarks/execution_profiles.py`. The segmentation network can also be
+    compiled for the patch shape; the compiled network is cached on disk, so only
+    the first run pays for compiling it.
+
     """
     if len(downsampled_input_size) != 3:
         raise ValueError(f"Must have 3D image size, got {downsampled_input_size}")
+    if workers > 1 and device != "cpu":
+        raise ValueError("Can only use several workers on the CPU")
+    if batch_size is None:
+        batch_size = 8 if device == "cuda" else 1
 
     # Get the directories where the outputs will be stored, creating them if
     # necessary
@@ -65,40 +148,228 @@ def main(
     img_out_dir.mkdir(exist_ok=True)
     mask_out_dir.mkdir(exist_ok=True)
 
-    # Get the models
+    # Find the inputs, and check we're not going to overwrite anything before we start.
+    # With a work queue, outputs that aren't in the manifest are left over from a
+    # crash, so they get redone
+    paths = io.inference_paths(input_data, two_d_images)
+    if work_queue is None:
+        for path in paths:
+            for out_path in _output_paths(path, img_out_dir, mask_out_dir):
+                if out_path.exists():
+                    raise FileExistsError(f"{out_path} exists; move or delete it")
+
+    queue = None if work_queue is None else WorkQueue(work_queue, lease_time=lease_time)
+
+    # Before anything runs, since some of the thread settings can't be changed later
+    execution_profile = profiles.get(profile)
+    profiles.apply(execution_profile)
+
+    # Get the models. Loading (and maybe compiling) them is reported separately from
+    # the time per scan, since it's only paid once
+    startup_start = time.perf_counter()
     # TODO make these generic - we might want to use a non-jaw model...
-    locator_net = models.get_jaw_loc_model(locator_model, device=device)
-    segmentation_net = models.get_jaw_segment_model(segmentation_model, device=device)
-
-    # Read in input(s)
-    for path, image in io.inference_inputs(input_data, two_d_images):
-        name = path.name
-        img_path = (img_out_dir / name).with_suffix(".tif")
-        mask_path = (mask_out_dir / name).with_suffix(".tif")
-        if img_path.exists():
-            raise FileExistsError(f"{img_path} exists; move or delete it")
-        if mask_path.exists():
-            raise FileExistsError(f"{mask_path} exists; move or delete it")
-
-        try:
-            cropped = models.crop_object(
-                locator_net,
-                image,
-                locator_input_size=downsampled_input_size,
-                window_size=tuple([crop_size] * 3),
+    # Only the segmentation model can be quantised
+    locator_net = models.get_jaw_loc_model(
+        locator_model, device=device, backend="torch" if backend == "int8" else backend
+    )
+    segmentation_net = models.get_jaw_segment_model(
+        segmentation_model, device=device, backend=backend
+    )
+    locator_net = profiles.wrap(locator_net, execution_profile)
+    segmentation_net = dataclasses.replace(
+        segmentation_net, net=profiles.wrap(segmentation_net.net, execution_profile)
+    )
+    segment_options = dict(_SEGMENT_OPTIONS)
+    if skip_threshold is not None:
+        segment_options["skip_threshold"] = skip_threshold
+    if whole_window:
+        segment_options["whole_window"] = True
+
+    cache = StageCache(cache_dir, force=tuple(force_stage))
+    # The backends and precisions give slightly different results, so they're part
+    # of the keys
+    locator_fingerprint = [
+        file_fingerprint(files.jaw_locator_model_path(locator_model)),
+        backends.fingerprint(locator_net),
+        profiles.fingerprint(execution_profile),
+    ]
+    segmenter_fingerprint = [
+        *(
+            file_fingerprint(path)
+            for path in artifact.model_files(
+                files.model_path({"model_path": segmentation_model})
             )
-        except CropOutOfBoundsError as e:
-            print(
-                f"Error cropping {name}; likely an issue with the localising model\n{str(e)}",
-                file=sys.stderr,
+        ),
+        backends.fingerprint(segmentation_net.net),
+        profiles.fingerprint(execution_profile),
+    ]
+
+    # Compiled for full batches of patches; anything else runs eagerly
+    compiled_net, compile_startup = compiled.compile_network(
+        segmentation_net.net,
+        compile_mode,
+        input_shape=(batch_size, 1, *data.get_patch_size(segmentation_net.config)),
+        model_key=segmenter_fingerprint,
+        profile=execution_profile,
+        cache_dir=compile_cache_dir,
+    )
+    segmentation_net = dataclasses.replace(segmentation_net, net=compiled_net)
+    if workers > 1:
+        # So the workers all use the same copy of the weights
+        locator_net.share_memory()
+        segmentation_net.net.share_memory()
+    print(
+        f"Models ready in {time.perf_counter() - startup_start:.1f}s"
+        f" (segmentation network: {compile_startup})"
+    )
+
+    def read(path: pathlib.Path) -> tuple[dict, np.ndarray | None, dict | None]:
+        """
+        Read the scan, unless we've already got the crop from the cache
+
+        """
+        scan = file_fingerprint(path)
+        location = cache.load(
+            "locate",
+            key(scan, locator_fingerprint, downsampled_input_size, crop_size),
+        )
+        image = io.convert_input_to_array(path) if location is None else None
+        return scan, image, location
+
+    def locate(read_result: tuple[dict, np.ndarray | None, dict | None]) -> np.ndarray:
+        """
+        Crop the object out of a scan, or get the crop from the cache
+
+        """
+        scan, image, location = read_result
+        if location is not None:
+            return location["cropped"]
+
+        downsample_key = key(scan, downsampled_input_size)
+        downsampled = cache.load("downsample", downsample_key)
+
+        found = models.locate_object(
+            locator_net,
+            image,
+            locator_input_size=downsampled_input_size,
+            window_size=tuple([crop_size] * 3),
+            downsampled=None if downsampled is None else downsampled["downsampled"],
+        )
+        if downsampled is None:
+            cache.save("downsample", downsample_key, downsampled=found.downsampled)
+        cache.save(
+            "locate",
+            key(scan, locator_fingerprint, downsampled_input_size, crop_size),
+            centroid=np.array(found.centroid),
+            crop_box=np.array(found.crop_box),
+            cropped=found.cropped,
+        )
+        return found.cropped
+
+    def compute(
+        paths: list[pathlib.Path],
+        read_results: list[tuple[dict, np.ndarray | None, dict | None]],
+    ) -> list[tuple[np.ndarray, np.ndarray] | CropOutOfBoundsError]:
+        """
+        Crop each scan, then segment them all together so their patches can share
+        batches
+
+        """
+        crops, results = {}, [None] * len(paths)
+        for i, read_result in enumerate(read_results):
+            try:
+                crops[i] = locate(read_result)
+            except CropOutOfBoundsError as e:
+                results[i] = e
+
+        to_segment = {}
+        for i, cropped in crops.items():
+            segment_key = key(
+                array_digest(cropped), segmenter_fingerprint, segment_options
             )
-            continue
+            if (segmented := cache.load("segment", segment_key)) is not None:
+                results[i] = cropped, segmented["mask"]
+            else:
+                to_segment[i] = segment_key
 
-        prediction = models.segment_object(segmentation_net, cropped)
+        predictions = models.segment_objects(
+            segmentation_net,
+            [crops[i] for i in to_segment],
+            batch_size=batch_size,
+            **segment_options,
+        )
+        for (i, segment_key), prediction in zip(to_segment.items(), predictions):
+            cache.save("segment", segment_key, mask=prediction)
+            results[i] = crops[i], prediction
+
+        return results
+
+    def write(path: pathlib.Path, result: tuple[np.ndarray, np.ndarray]) -> None:
+        img_path, mask_path = _output_paths(path, img_out_dir, mask_out_dir)
+        cropped, prediction = result
 
         tifffile.imwrite(img_path, cropped)
         tifffile.imwrite(mask_path, prediction)
 
+        if queue is not None:
+            queue.complete(path.name, image=str(img_path), mask=str(mask_path))
+
+    pipeline = Pipeline(
+        read,
+        compute,
+        write,
+        n_readers=readers,
+        n_writers=writers,
+        queue_size=queue_size,
+        batch_size=_scans_per_batch(
+            segmentation_net.config, crop_size, batch_size, len(paths)
+        ),
+        # A scan that can't be read or cropped shouldn't stop the others
+        item_errors=(
+            CropOutOfBoundsError,
+            OSError,
+            tifffile.TiffFileError,
+            InvalidDicomError,
+        ),
+    )
+    with queue if queue is not None else contextlib.nullcontext():
+        items = paths if queue is None else queue.claim_all(paths, key=lambda p: p.name)
+
+        if workers > 1:
+            if threads_per_worker is None:
+                threads_per_worker = max(1, os.cpu_count() // workers)
+            report = run_in_processes(
+                pipeline,
+                items,
+                n_workers=workers,
+                threads_per_worker=threads_per_worker,
+            )
+        else:
+            report = pipeline.run(items)
+
+        if queue is not None:
+            for failure in report.failures:
+                queue.fail(failure.item.name, f"{failure.stage}: {failure.error}")
+
+    for failure in report.failures:
+        if isinstance(failure.error, CropOutOfBoundsError):
+            reason = "likely an issue with the localising model"
+        else:
+            reason = f"error in the {failure.stage} stage"
+        print(
+            f"Error with {failure.item.name}; {reason}\n{str(failure.error)}",
+            file=sys.stderr,
+        )
+    print(report.summary())
+
+    # Not including startup, since the models were ready before the pipeline started
+    (compute,) = [stage for stage in report.stages if stage.name == "compute"]
+    if compute.n_done:
+        print(
+            f"Steady state: {compute.busy / compute.n_done:.2f}s per scan to locate"
+            " and segment"
+        )
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -174,5 +445,131 @@ Empty lines and lines starting with # in this file will be ignored.
         type=pathlib.Path,
     )
 
+    parser.add_argument(
+        "--readers",
+        type=int,
+        default=2,
+        help="How many scans to read at once, while the models are running",
+    )
+    parser.add_argument(
+        "--writers",
+        type=int,
+        default=1,
+        help="How many outputs to write at once, while the models are running",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=2,
+        help="How many scans can wait to go through the models (and to be written)."
+        " More uses more memory",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="How many processes to run inference in (CPU only). Each one runs the"
+        " models on its own scans, sharing one copy of the weights",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=None,
+        help="How many threads each worker uses for the models."
+        " Defaults to sharing the cores between the workers",
+    )
+
+    parser.add_argument(
+        "--work-queue",
+        type=pathlib.Path,
+        default=None,
+        help="A directory (on a filesystem all the machines can see) to share the scans"
+        " through, so that this script can be run on several machines at once."
+        " Scans that are already in its manifest are skipped",
+    )
+    parser.add_argument(
+        "--lease-time",
+        type=float,
+        default=300.0,
+        help="With --work-queue: how long (in seconds) before a scan claimed by a"
+        " machine that's stopped responding is taken over by another one",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="How many patches to run through the segmentation model at once. A cropped"
+        " scan only has a few patches, so patches from several scans are batched"
+        " together if this is bigger. Defaults to 8 on the GPU and 1 on the CPU,"
+        " where bigger batches use lots of memory without being much faster",
+    )
+    parser.add_argument(
+        "--skip-threshold",
+        type=float,
+        default=None,
+        help="Don't run the segmentation model on patches where nothing is at least this"
+        " bright (intensities scaled to 0-1), i.e. that can't have any bone in them."
+        " See scripts/experiments/skip_empty_patches.py for choosing it",
+    )
+    parser.add_argument(
+        "--whole-window",
+        action="store_true",
+        help="Run the segmentation model on each whole crop at once instead of on"
+        " overlapping patches, if there's enough memory",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=backends.BACKENDS,
+        default="torch",
+        help="What to run the models with. 'onnx' uses ONNX Runtime on the CPU, which"
+        " needs the models exporting first with scripts/export_onnx.py. 'int8' runs a"
+        " quantised segmentation model on the CPU, from scripts/quantise_model.py."
+        " Falls back to torch if it can't be used",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=[*profiles.PROFILES, profiles.SAVED],
+        default=None,
+        help="The execution profile to run the models with: how many threads, whether"
+        " to use channels-last and bfloat16, and whether to use deterministic"
+        " algorithms. Uses the one saved by scripts/benchmarks/execution_profiles.py"
+        " if there is one, and PyTorch's defaults otherwise. With several workers,"
+        " --threads-per-worker is used instead of the profile's threads",
+    )
+    parser.add_argument(
+        "--compile",
+        dest="compile_mode",
+        choices=compiled.MODES,
+        default="eager",
+        help="Compile the segmentation network for the patch shape: 'frozen' traces"
+        " and freezes it with TorchScript, 'inductor' uses torch.compile (slow the"
+        " first time). The result is cached and reused by later runs. Runs eagerly if"
+        " compiling fails. Only applies to the torch backend",
+    )
+    parser.add_argument(
+        "--compile-cache-dir",
+        type=pathlib.Path,
+        default=None,
+        help="Where to keep the compiled networks. Defaults to"
+        " script_output/compiled_models/",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        default=None,
+        help="Where to cache the downsampled scans, locations and segmentations, so that"
+        " re-running (e.g. with a different segmentation model) only redoes the steps"
+        " that have changed. Nothing is cached if not given",
+    )
+    parser.add_argument(
+        "--force-stage",
+        nargs="+",
+        choices=STAGES,
+        default=[],
+        help="Redo these steps even if they're cached (and the ones after them)",
+    )
+
     args = parser.parse_args()
     main(**vars(args))
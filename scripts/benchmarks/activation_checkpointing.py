@@ -0,0 +1,128 @@
+"""
+Benchmark the peak memory and time of a training step with different amounts of
+activation checkpointing (`activation_checkpointing` in `userconf.yml`).
+
+Each setting is run in its own process, so that the peak memory of one doesn't
+affect the others. On the GPU this reports the peak memory allocated by torch; on
+the CPU it reports how much the peak memory of the process went up during the
+training steps.
+
+"""
+
+import time
+import resource
+import argparse
+import multiprocessing
+
+import torch
+
+from fishlib.util import util
+from fishlib.model import data, model
+
+
+def _settings(n_layers: int) -> dict[str, bool | list[int]]:
+    """
+    The checkpointing settings to try: none, just the top few levels, and all of them
+
+    """
+    return {
+        "off": False,
+        "level 0": [0],
+        "levels 0-1": [0, 1],
+        f"levels 0-{n_layers // 2}": list(range(n_layers // 2 + 1)),
+        "all": True,
+    }
+
+
+def _max_rss() -> float:
+    """
+    Peak memory used by this process so far, in GB
+
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2
+
+
+def _step(
+    config: dict,
+    checkpointing: bool | list[int],
+    patch_size: tuple[int, int, int],
+    batch_size: int,
+    n_steps: int,
+) -> tuple[float, float]:
+    """
+    Run a few training steps
+
+    :returns: peak memory, in GB
+    :returns: mean time per step, in seconds
+
+    """
+    device = config["device"]
+    model_params = config["model_params"] | {"activation_checkpointing": checkpointing}
+
+    net = model.model(model_params, train=True).to(device).train()
+    optimiser = model.optimiser(config, net)
+    loss_fn = model.lossfn(config)
+
+    x = torch.rand(batch_size, 1, *patch_size, device=device)
+    y = (torch.rand(batch_size, 1, *patch_size, device=device) > 0.9).to(torch.uint8)
+
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    baseline = _max_rss()
+
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        optimiser.zero_grad()
+        loss_fn(net(x), y).backward()
+        optimiser.step()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / n_steps
+
+    if device == "cuda":
+        return torch.cuda.max_memory_allocated() / 1024**3, elapsed
+    return _max_rss() - baseline, elapsed
+
+
+def main(*, batch_size: int, patch_size: str | None, n_steps: int) -> None:
+    """
+    Measure memory and time for each checkpointing setting
+
+    """
+    config = util.userconf()
+    if not torch.cuda.is_available():
+        config["device"] = "cpu"
+
+    patch_size = data.get_patch_size(
+        config if patch_size is None else {"patch_size": patch_size}
+    )
+    print(
+        f"Patch {patch_size}, batch size {batch_size}, "
+        f"{config['model_params']['n_layers']} layers, on {config['device']}"
+    )
+    print(f"{'Checkpointing':>14} {'Peak memory /GB':>16} {'Step time /s':>13}")
+
+    context = multiprocessing.get_context("spawn")
+    for name, checkpointing in _settings(config["model_params"]["n_layers"]).items():
+        with context.Pool(1) as pool:
+            memory, elapsed = pool.apply(
+                _step, (config, checkpointing, patch_size, batch_size, n_steps)
+            )
+        print(f"{name:>14} {memory:>16.2f} {elapsed:>13.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="Batch size for the training steps"
+    )
+    parser.add_argument(
+        "--patch-size",
+        type=str,
+        default=None,
+        help="Comma-separated ZYX patch size; defaults to the one in userconf.yml",
+    )
+    parser.add_argument(
+        "--n-steps", type=int, default=2, help="How many training steps to time"
+    )
+    main(**vars(parser.parse_args()))
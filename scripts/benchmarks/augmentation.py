@@ -0,0 +1,97 @@
+"""
+Benchmark the random affine augmentation at the settings in userconf.yml.
+
+Compares augmenting the whole window and then taking a patch (the old way) against
+choosing the patch first and only augmenting that (`patch_first_augmentation`).
+The affine is always applied here (p=1), since that's the expensive bit.
+
+"""
+
+import time
+import argparse
+
+import torch
+import numpy as np
+import torchio as tio
+from tqdm import trange
+
+from fishlib.util import util
+from fishlib.model import data
+from fishlib.model.augmentation import PatchFirstAugmentation
+from fishlib.images import transform
+
+
+def _subject(window_size: tuple[int, int, int]) -> tio.Subject:
+    """
+    A random subject the size of the window
+
+    """
+    return tio.Subject(
+        image=tio.ScalarImage(tensor=torch.rand(1, *window_size)),
+        label=tio.LabelMap(tensor=(torch.rand(1, *window_size) > 0.9).to(torch.uint8)),
+    )
+
+
+def _affine_args(config: dict) -> dict:
+    """
+    The RandomAffine arguments from the config, but always applied
+
+    """
+    args = dict(config["transforms"]["torchio.RandomAffine"])
+    args["p"] = 1.0
+    return args
+
+
+def _time(fcn, subject: tio.Subject, n_repeats: int, desc: str) -> np.ndarray:
+    """
+    Time how long a function takes to run on the subject, in seconds
+
+    """
+    times = np.empty(n_repeats)
+    for i in trange(n_repeats, desc=desc):
+        start = time.perf_counter()
+        fcn(subject)
+        times[i] = time.perf_counter() - start
+    return times
+
+
+def main(*, n_repeats: int) -> None:
+    """
+    Time both ways of augmenting
+
+    """
+    config = util.userconf()
+    torch.manual_seed(config["torch_seed"])
+
+    window_size = transform.window_size(config)
+    patch_size = data.get_patch_size(config)
+    subject = _subject(window_size)
+
+    whole_window = tio.Compose([tio.RandomAffine(**_affine_args(config))])
+    sampler = tio.UniformSampler(patch_size=patch_size)
+
+    def old(subject: tio.Subject) -> tio.Subject:
+        return next(iter(sampler(whole_window(subject))))
+
+    patch_first = PatchFirstAugmentation(
+        [tio.RandomAffine(**_affine_args(config))], patch_size
+    )
+
+    old_times = _time(old, subject, n_repeats, "Whole window")
+    new_times = _time(patch_first, subject, n_repeats, "Patch first")
+
+    print(f"Window {window_size}, patch {patch_size}, affine {_affine_args(config)}")
+    print(f"Whole window: {old_times.mean():.3f} +- {old_times.std():.3f} s")
+    print(f"Patch first:  {new_times.mean():.3f} +- {new_times.std():.3f} s")
+    print(f"Speedup:      {old_times.mean() / new_times.mean():.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--n-repeats",
+        type=int,
+        default=20,
+        help="How many times to run each augmentation",
+    )
+    main(**vars(parser.parse_args()))
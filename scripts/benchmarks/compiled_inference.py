@@ -0,0 +1,172 @@
+"""
+Benchmark running the segmentation model compiled (`3-run_inference.py --compile`)
+against running it eagerly.
+
+Compiling costs time up front, so this reports that separately from how long each
+prediction takes afterwards. Each mode is run twice, each time in a fresh process:
+once with an empty cache (so the network is compiled from scratch) and once reusing
+what the first run cached, which is what every run after the first would see.
+The steady-state time is for `model.predict` on a random window, so includes the
+patching and stitching; the largest difference from the eager prediction is printed
+too, and should be tiny.
+
+By default this uses an untrained segmentation model from `userconf.yml`, which is
+fine for the timings; pass `--model-name` to use a trained one.
+
+"""
+
+import os
+import time
+import pathlib
+import argparse
+import tempfile
+import multiprocessing
+
+import torch
+import numpy as np
+import torchio as tio
+
+from fishlib.util import util
+from fishlib.model import data, model
+from fishlib.images import transform
+from fishlib.inference import compiled, profiles
+from fishlib.inference.models import PATCH_OVERLAP
+
+
+def _run(
+    mode: str,
+    model_name: str | None,
+    batch_size: int,
+    n_repeats: int,
+    cache_dir: pathlib.Path,
+    inductor_dir: pathlib.Path,
+) -> tuple[compiled.Startup, float, np.ndarray]:
+    """
+    Get the network ready then time predicting with it; runs in a fresh process
+
+    :returns: how the startup went
+    :returns: the mean time per prediction, in seconds
+    :returns: the prediction
+
+    """
+    # So that inductor can't reuse kernels compiled by earlier runs, other than
+    # through our cache
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = str(inductor_dir)
+
+    if model_name is None:
+        config = util.userconf()
+        torch.manual_seed(config["torch_seed"])
+        net = model.model(config["model_params"]).eval()
+    else:
+        model_state = model.load_model(model_name)
+        config = model_state.config
+        net = model_state.load_model(set_eval=True)
+
+    profile = profiles.get()
+    profiles.apply(profile)
+    net = profiles.wrap(net, profile)
+
+    patch_size = data.get_patch_size(config)
+    net, startup = compiled.compile_network(
+        net,
+        mode,
+        input_shape=(batch_size, 1, *patch_size),
+        model_key=model_name,
+        profile=profile,
+        cache_dir=cache_dir,
+    )
+
+    subject = tio.Subject(
+        image=tio.ScalarImage(
+            tensor=torch.rand(
+                1,
+                *transform.window_size(config),
+                generator=torch.Generator().manual_seed(0),
+            )
+        )
+    )
+
+    def predict() -> np.ndarray:
+        return model.predict(
+            net,
+            subject,
+            patch_size=patch_size,
+            patch_overlap=PATCH_OVERLAP,
+            activation=model.activation_name(config),
+            batch_size=batch_size,
+        )
+
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        prediction = predict()
+    return startup, (time.perf_counter() - start) / n_repeats, prediction
+
+
+def main(
+    *, modes: list[str], model_name: str | None, batch_size: int, n_repeats: int
+) -> None:
+    """
+    Time getting ready and predicting with each mode
+
+    """
+    print(
+        f"{'Mode':>9} {'Run':>5} {'Startup /s':>11} {'Steady state /s':>16}"
+        f" {'Max difference':>15}"
+    )
+
+    context = multiprocessing.get_context("spawn")
+    reference = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = pathlib.Path(tmp_dir)
+        for mode in ["eager", *(mode for mode in modes if mode != "eager")]:
+            for run in ("cold", "warm"):
+                with context.Pool(1) as pool:
+                    startup, latency, prediction = pool.apply(
+                        _run,
+                        (
+                            mode,
+                            model_name,
+                            batch_size,
+                            n_repeats,
+                            tmp_dir / "compiled",
+                            tmp_dir / f"inductor_{mode}_{run}",
+                        ),
+                    )
+
+                if reference is None:
+                    reference = prediction
+                print(
+                    f"{startup.mode:>9} {run:>5} {startup.seconds:>11.2f}"
+                    f" {latency:>16.3f}"
+                    f" {np.abs(prediction - reference).max():>15.2e}"
+                )
+                if mode == "eager":
+                    # Nothing is cached, so a second run is the same
+                    break
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=compiled.MODES,
+        default=["frozen", "inductor"],
+        help="Which ways of compiling to compare to eager mode",
+    )
+    parser.add_argument(
+        "--model-name",
+        default=None,
+        help="A trained segmentation model (e.g. my_model.pkl). Uses an untrained model"
+        " if not given",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="Patches per forward pass"
+    )
+    parser.add_argument(
+        "--n-repeats",
+        type=int,
+        default=3,
+        help="How many predictions to time after getting the network ready",
+    )
+    main(**vars(parser.parse_args()))
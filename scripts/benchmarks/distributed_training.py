@@ -0,0 +1,152 @@
+"""
+Benchmark data-parallel training on the CPU, with different numbers of processes (ranks).
+
+Each rank trains the model in `userconf.yml` on random patches with a fixed batch
+size, and the machine's cores are shared between the ranks. Reports the training
+throughput (patches per second, across all ranks) for each number of ranks.
+
+"""
+
+import os
+import time
+import pathlib
+import argparse
+import tempfile
+
+import torch
+import torch.multiprocessing as mp
+
+from fishlib.util import util
+from fishlib.model import data, model, distributed
+
+
+def _rank(
+    rank: int,
+    world_size: int,
+    init_method: str,
+    threads: int,
+    patch_size: tuple[int, int, int],
+    batch_size: int,
+    n_steps: int,
+    results: mp.SimpleQueue,
+) -> None:
+    """
+    Train for a few steps on one rank; rank 0 reports how long it took
+
+    """
+    distributed.setup(rank, world_size, init_method, threads)
+    try:
+        config = util.userconf()
+        torch.manual_seed(rank)
+
+        net = distributed.wrap(model.model(config["model_params"], train=True))
+        optimiser = model.optimiser(config, net)
+        loss_fn = model.lossfn(config)
+
+        x = torch.rand(batch_size, 1, *patch_size)
+        y = (torch.rand(batch_size, 1, *patch_size) > 0.9).to(torch.uint8)
+
+        def step():
+            optimiser.zero_grad()
+            loss_fn(net(x), y).backward()
+            optimiser.step()
+
+        # Warm up, then start everyone at the same time
+        step()
+        torch.distributed.barrier()
+
+        start = time.perf_counter()
+        for _ in range(n_steps):
+            step()
+        torch.distributed.barrier()
+
+        if rank == 0:
+            results.put(time.perf_counter() - start)
+    finally:
+        distributed.cleanup()
+
+
+def _time(
+    world_size: int,
+    threads: int,
+    patch_size: tuple[int, int, int],
+    batch_size: int,
+    n_steps: int,
+) -> float:
+    """
+    Time training with the given number of ranks, in seconds
+
+    """
+    context = mp.get_context("spawn")
+    results = context.SimpleQueue()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        init_method = distributed.file_init_method(pathlib.Path(tmpdir) / "rendezvous")
+        mp.spawn(
+            _rank,
+            args=(
+                world_size,
+                init_method,
+                threads,
+                patch_size,
+                batch_size,
+                n_steps,
+                results,
+            ),
+            nprocs=world_size,
+        )
+
+    return results.get()
+
+
+def main(
+    *, ranks: list[int], n_steps: int, batch_size: int, patch_size: str | None
+) -> None:
+    """
+    Time training with each number of ranks
+
+    """
+    config = util.userconf()
+    patch_size = data.get_patch_size(
+        config if patch_size is None else {"patch_size": patch_size}
+    )
+    n_cores = os.cpu_count() or 1
+
+    print(f"Patch {patch_size}, batch size {batch_size} per rank, {n_cores} cores")
+    print(f"{'Ranks':>6} {'Threads':>8} {'Patches/s':>10} {'Speedup':>8}")
+
+    baseline = None
+    for world_size in ranks:
+        threads = max(1, n_cores // world_size)
+        elapsed = _time(world_size, threads, patch_size, batch_size, n_steps)
+
+        throughput = world_size * batch_size * n_steps / elapsed
+        baseline = baseline or throughput
+        print(
+            f"{world_size:>6} {threads:>8} {throughput:>10.2f}"
+            f" {throughput / baseline:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--ranks",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+        help="Numbers of processes to try",
+    )
+    parser.add_argument(
+        "--n-steps", type=int, default=5, help="How many training steps to time"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="Batch size on each rank"
+    )
+    parser.add_argument(
+        "--patch-size",
+        type=str,
+        default=None,
+        help="Comma-separated ZYX patch size; defaults to the one in userconf.yml",
+    )
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,228 @@
+"""
+Find the fastest execution profile (threads, channels-last, bfloat16 and algorithm
+selection; see `fishlib.inference.profiles`) for running the models on this machine,
+and save it so that `3-run_inference.py` uses it.
+
+Each built-in profile is tried with each number of threads, in its own process
+(some thread settings can only be set once per process). Each runs the segmentation
+model through `model.predict` on a random window and the locator model on a random
+downsampled scan, and the fastest in total is saved - as long as its segmentation is
+close enough to the default profile's (bfloat16 is less accurate).
+
+By default this uses an untrained segmentation model from `userconf.yml`, which is
+fine for the timings; pass `--model-name` to use a trained one, which gives a more
+meaningful accuracy check. The locator model is always untrained.
+
+"""
+
+import os
+import time
+import argparse
+import dataclasses
+import multiprocessing
+
+import torch
+import numpy as np
+import torchio as tio
+
+from fishlib.util import util, files
+from fishlib.model import data, model
+from fishlib.images import transform
+from fishlib.localisation.model import get_model, heatmap
+from fishlib.inference import profiles
+from fishlib.inference.models import PATCH_OVERLAP
+
+
+def _candidates(threads: list[int]) -> list[profiles.ExecutionProfile]:
+    """
+    Every built-in profile with every number of threads
+
+    """
+    return [
+        dataclasses.replace(profile, name=f"{name}-{n}", intra_op_threads=n)
+        for name, profile in profiles.PROFILES.items()
+        for n in threads
+    ]
+
+
+def _mean_time(fcn, n_repeats: int) -> tuple[float, np.ndarray]:
+    """
+    Time a function, in seconds, after running it once to warm up
+
+    :returns: the mean time
+    :returns: the output of the last run
+
+    """
+    fcn()
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        out = fcn()
+    return (time.perf_counter() - start) / n_repeats, out
+
+
+def _run(
+    profile: profiles.ExecutionProfile,
+    model_name: str | None,
+    locator_input_size: tuple[int, int, int],
+    batch_size: int,
+    n_repeats: int,
+) -> tuple[float, float, np.ndarray]:
+    """
+    Time both models with a profile; runs in a fresh process
+
+    :returns: the time per segmentation, in seconds
+    :returns: the time per location, in seconds
+    :returns: the segmentation model's prediction
+
+    """
+    profiles.apply(profile)
+
+    if model_name is None:
+        config = util.userconf()
+        torch.manual_seed(config["torch_seed"])
+        segmenter = model.model(config["model_params"]).eval()
+    else:
+        model_state = model.load_model(model_name)
+        config = model_state.config
+        segmenter = model_state.load_model(set_eval=True)
+    torch.manual_seed(0)
+    locator = get_model("cpu").eval()
+
+    segmenter = profiles.wrap(segmenter, profile)
+    locator = profiles.wrap(locator, profile)
+
+    generator = torch.Generator().manual_seed(0)
+    subject = tio.Subject(
+        image=tio.ScalarImage(
+            tensor=torch.rand(1, *transform.window_size(config), generator=generator)
+        )
+    )
+    downsampled = np.random.default_rng(0).random(locator_input_size, dtype=np.float32)
+
+    segment_time, prediction = _mean_time(
+        lambda: model.predict(
+            segmenter,
+            subject,
+            patch_size=data.get_patch_size(config),
+            patch_overlap=PATCH_OVERLAP,
+            activation=model.activation_name(config),
+            batch_size=batch_size,
+        ),
+        n_repeats,
+    )
+    locate_time, _ = _mean_time(lambda: heatmap(locator, downsampled), n_repeats)
+
+    return segment_time, locate_time, prediction
+
+
+def main(
+    *,
+    threads: list[int] | None,
+    model_name: str | None,
+    locator_input_size: tuple[int, int, int],
+    batch_size: int,
+    n_repeats: int,
+    tolerance: float,
+    dry_run: bool,
+) -> None:
+    """
+    Time every candidate profile and save the fastest
+
+    """
+    if threads is None:
+        threads = sorted({os.cpu_count(), max(1, os.cpu_count() // 2)}, reverse=True)
+
+    print(
+        f"{'Profile':>24} {'Segment /s':>11} {'Locate /s':>10} {'Total /s':>9}"
+        f" {'Max difference':>15}"
+    )
+    candidates = {profile.name: profile for profile in _candidates(threads)}
+    context = multiprocessing.get_context("spawn")
+    results, reference = {}, None
+    for profile in candidates.values():
+        with context.Pool(1) as pool:
+            segment_time, locate_time, prediction = pool.apply(
+                _run,
+                (profile, model_name, locator_input_size, batch_size, n_repeats),
+            )
+
+        # Compared to the first profile, which uses PyTorch's defaults
+        if reference is None:
+            reference = prediction
+        difference = float(np.abs(prediction - reference).max())
+
+        results[profile.name] = {
+            "segment_time": segment_time,
+            "locate_time": locate_time,
+            "max_difference": difference,
+        }
+        print(
+            f"{profile.name:>24} {segment_time:>11.3f} {locate_time:>10.3f}"
+            f" {segment_time + locate_time:>9.3f} {difference:>15.2e}"
+        )
+
+    fastest = min(
+        (
+            name
+            for name, result in results.items()
+            if result["max_difference"] <= tolerance
+        ),
+        key=lambda name: results[name]["segment_time"] + results[name]["locate_time"],
+    )
+    print(f"Fastest: {fastest}")
+
+    if not dry_run:
+        profiles.save(
+            candidates[fastest],
+            torch_version=torch.__version__,
+            cpu_count=os.cpu_count(),
+            model_name=model_name,
+            results=results,
+        )
+        print(f"Saved to {files.execution_profile_path()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Numbers of threads to try. Defaults to all the cores and half of them",
+    )
+    parser.add_argument(
+        "--model-name",
+        default=None,
+        help="A trained segmentation model (e.g. my_model.pkl). Uses an untrained model"
+        " if not given",
+    )
+    parser.add_argument(
+        "--locator-input-size",
+        type=int,
+        nargs=3,
+        default=(512, 128, 128),
+        help="The size of the downsampled scan the locator model is run on",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="Patches per forward pass"
+    )
+    parser.add_argument(
+        "--n-repeats",
+        type=int,
+        default=2,
+        help="How many times to run each model with each profile",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.05,
+        help="Only pick profiles whose foreground probabilities are within this of the"
+        " default profile's",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Just print the timings; don't save the fastest profile",
+    )
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,147 @@
+"""
+Benchmark splitting a window into patches and stitching the predictions back together
+during inference.
+
+Compares the old way (`tio.GridSampler` and `tio.inference.GridAggregator`) against
+the tensor-only grid in `fishlib.model.grid` that `model.predict` now uses, on a
+random image the size of the window in `userconf.yml`.
+
+By default the model is replaced with something that costs (almost) nothing, so that
+we only time the patching and stitching; pass `--with-model` to time the whole
+prediction with an (untrained) segmentation model.
+
+"""
+
+import time
+import argparse
+
+import torch
+import numpy as np
+import torchio as tio
+from tqdm import trange
+
+from fishlib.util import util
+from fishlib.model import data, model
+from fishlib.images import transform
+
+
+class _TwoChannels(torch.nn.Module):
+    """
+    Stand-in for the model: turns the image into two channels, like the segmentation
+    model's output
+
+    """
+
+    def __init__(self):
+        super().__init__()
+        # So that `predict` can find the device
+        self.dummy = torch.nn.Parameter(torch.zeros(()))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return torch.cat([1 - x, x], dim=1)
+
+
+def _torchio_predict(
+    net: torch.nn.Module,
+    subject: tio.Subject,
+    *,
+    patch_size: tuple[int, int, int],
+    patch_overlap: tuple[int, int, int],
+    batch_size: int,
+) -> np.ndarray:
+    """
+    How `model.predict` used to work, with a softmax activation
+
+    """
+    sampler = tio.GridSampler(subject, patch_size, patch_overlap=patch_overlap)
+
+    tensors, locations = [], []
+    for patch in sampler:
+        tensors.append(patch[tio.IMAGE][tio.DATA].unsqueeze(0))
+        locations.append(patch[tio.LOCATION])
+    tensors = torch.cat(tensors, dim=0)
+
+    predictions = []
+    for i in range(0, len(tensors), batch_size):
+        with torch.no_grad():
+            predictions.append(net(tensors[i : i + batch_size]))
+    prediction = torch.nn.functional.softmax(torch.cat(predictions), dim=1)
+
+    aggregator = tio.inference.GridAggregator(sampler=sampler, overlap_mode="hann")
+    aggregator.add_batch(prediction, locations=torch.stack(locations))
+    return aggregator.get_output_tensor()[1].numpy()
+
+
+def _time(fcn, n_repeats: int, desc: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Time a function, in seconds
+
+    :returns: the times
+    :returns: the output of the last run
+
+    """
+    times = np.empty(n_repeats)
+    for i in trange(n_repeats, desc=desc):
+        start = time.perf_counter()
+        out = fcn()
+        times[i] = time.perf_counter() - start
+    return times, out
+
+
+def main(*, n_repeats: int, with_model: bool, batch_size: int) -> None:
+    """
+    Time both ways of predicting
+
+    """
+    config = util.userconf()
+    torch.manual_seed(config["torch_seed"])
+
+    window_size = transform.window_size(config)
+    patch_size = data.get_patch_size(config)
+    patch_overlap = (4, 4, 4)
+    subject = tio.Subject(image=tio.ScalarImage(tensor=torch.rand(1, *window_size)))
+
+    net = model.model(config["model_params"]).eval() if with_model else _TwoChannels()
+    kwargs = {
+        "patch_size": patch_size,
+        "patch_overlap": patch_overlap,
+        "batch_size": batch_size,
+    }
+
+    old_times, old = _time(
+        lambda: _torchio_predict(net, subject, **kwargs), n_repeats, "torchio"
+    )
+    new_times, new = _time(
+        lambda: model.predict(net, subject, activation="softmax", **kwargs),
+        n_repeats,
+        "fishlib.model.grid",
+    )
+
+    print(
+        f"Window {window_size}, patch {patch_size}, overlap {patch_overlap},"
+        f" {'with' if with_model else 'without'} the model"
+    )
+    print(f"torchio: {old_times.mean():.3f} +- {old_times.std():.3f} s")
+    print(f"grid:    {new_times.mean():.3f} +- {new_times.std():.3f} s")
+    print(f"Speedup: {old_times.mean() / new_times.mean():.2f}x")
+    print(f"Largest difference: {np.abs(old - new).max():.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--n-repeats",
+        type=int,
+        default=10,
+        help="How many times to run each prediction",
+    )
+    parser.add_argument(
+        "--with-model",
+        action="store_true",
+        help="Use the (untrained) segmentation model from userconf.yml, rather than"
+        " only timing the patching and stitching",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="Patches per forward pass"
+    )
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,148 @@
+"""
+Benchmark running the segmentation and locator models with ONNX Runtime, against
+eager PyTorch.
+
+The models are exported to ONNX in a temporary directory, then both backends are run
+on the same random volume: the segmentation model through `model.predict` (so the
+patching and stitching are included), and the locator model on a downsampled scan.
+This prints the time per call for each backend and the largest difference between
+their outputs, which should be tiny.
+
+By default this uses an untrained segmentation model from `userconf.yml`, which is
+fine for the timings; pass `--model-name` to use a trained one. The locator model is
+always untrained.
+
+Needs the optional ONNX dependencies (`uv sync --extra onnx`).
+
+"""
+
+import time
+import pathlib
+import argparse
+import tempfile
+
+import torch
+import numpy as np
+import torchio as tio
+from tqdm import trange
+
+from fishlib.util import util
+from fishlib.model import data, model
+from fishlib.images import transform
+from fishlib.localisation.model import get_model, heatmap
+from fishlib.inference import backends
+from fishlib.inference.models import PATCH_OVERLAP
+
+
+def _time(fcn, n_repeats: int, desc: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Time a function, in seconds, after running it once to warm up
+
+    :returns: the times
+    :returns: the output of the last run
+
+    """
+    fcn()
+    times = np.empty(n_repeats)
+    for i in trange(n_repeats, desc=desc):
+        start = time.perf_counter()
+        out = fcn()
+        times[i] = time.perf_counter() - start
+    return times, out
+
+
+def _compare(name: str, fcn, nets: dict[str, torch.nn.Module], n_repeats: int) -> None:
+    """
+    Time a function with each backend's network, and compare their outputs
+
+    """
+    outputs = {}
+    for backend, net in nets.items():
+        times, outputs[backend] = _time(
+            lambda: fcn(net), n_repeats, f"{name} {backend}"
+        )
+        print(f"{name} ({backend}): {times.mean():.3f} +- {times.std():.3f} s")
+
+    print(
+        f"{name}: largest difference between backends:"
+        f" {np.abs(outputs['torch'] - outputs['onnx']).max():.2e}"
+    )
+
+
+def main(
+    *, n_repeats: int, model_name: str | None, locator_input_size: tuple[int, int, int]
+) -> None:
+    """
+    Export the models, then time and compare both backends
+
+    """
+    if not backends.onnx_available():
+        raise ImportError("onnxruntime isn't installed; try `uv sync --extra onnx`")
+
+    if model_name is None:
+        config = util.userconf()
+        torch.manual_seed(config["torch_seed"])
+        segmenter = model.model(config["model_params"]).eval()
+    else:
+        model_state = model.load_model(model_name)
+        config = model_state.config
+        segmenter = model_state.load_model(set_eval=True)
+    locator = get_model("cpu").eval()
+
+    patch_size = data.get_patch_size(config)
+    subject = tio.Subject(
+        image=tio.ScalarImage(tensor=torch.rand(1, *transform.window_size(config)))
+    )
+    downsampled = np.random.default_rng(0).random(locator_input_size, dtype=np.float32)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = pathlib.Path(tmp_dir)
+        segmenter_path = backends.export(
+            segmenter, tmp_dir / "segmenter.onnx", input_shape=(1, *patch_size)
+        )
+        locator_path = backends.export(
+            locator, tmp_dir / "locator.onnx", input_shape=(1, *locator_input_size)
+        )
+
+        _compare(
+            "segmenter",
+            lambda net: model.predict(
+                net,
+                subject,
+                patch_size=patch_size,
+                patch_overlap=PATCH_OVERLAP,
+                activation=model.activation_name(config),
+            ),
+            {"torch": segmenter, "onnx": backends.OnnxModule(segmenter_path)},
+            n_repeats,
+        )
+        _compare(
+            "locator",
+            lambda net: heatmap(net, downsampled),
+            {"torch": locator, "onnx": backends.OnnxModule(locator_path)},
+            n_repeats,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--n-repeats",
+        type=int,
+        default=3,
+        help="How many times to run each model with each backend",
+    )
+    parser.add_argument(
+        "--model-name",
+        default=None,
+        help="A trained segmentation model (e.g. my_model.pkl). Uses an untrained model"
+        " if not given",
+    )
+    parser.add_argument(
+        "--locator-input-size",
+        type=int,
+        nargs=3,
+        default=(512, 128, 128),
+        help="The size of the downsampled scan the locator model is run on",
+    )
+    main(**vars(parser.parse_args()))
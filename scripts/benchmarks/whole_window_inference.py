@@ -0,0 +1,134 @@
+"""
+Benchmark running the segmentation model on the whole window in one go, against
+splitting it into overlapping patches and blending them with a Hann window.
+
+The model is fully convolutional, so it can take the whole (e.g. 192^3) window at
+once; with overlapping (e.g. 160^3) patches, a lot of the window is computed several
+times. This times both, and compares the segmentations they give.
+
+By default this uses an untrained model from `userconf.yml` on a random image, which
+is fine for the timings but means the comparison is between two sets of noise; pass
+`--model-name` to use a trained model on its test fish.
+
+"""
+
+import time
+import argparse
+
+import torch
+import numpy as np
+import torchio as tio
+from tqdm import trange
+
+from fishlib.util import util
+from fishlib.model import data, model, grid
+from fishlib.images import metrics, transform
+from fishlib.inference import read
+from fishlib.inference.models import PATCH_OVERLAP
+
+
+def _time(fcn, n_repeats: int, desc: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Time a function, in seconds
+
+    :returns: the times
+    :returns: the output of the last run
+
+    """
+    times = np.empty(n_repeats)
+    for i in trange(n_repeats, desc=desc):
+        start = time.perf_counter()
+        out = fcn()
+        times[i] = time.perf_counter() - start
+    return times, out
+
+
+def main(
+    *, n_repeats: int, model_name: str | None, batch_size: int, device: str
+) -> None:
+    """
+    Time both ways of predicting, and compare them
+
+    """
+    if model_name is None:
+        config = util.userconf()
+        torch.manual_seed(config["torch_seed"])
+        net = model.model(config["model_params"]).eval()
+        subject = tio.Subject(
+            image=tio.ScalarImage(tensor=torch.rand(1, *transform.window_size(config)))
+        )
+    else:
+        model_state = model.load_model(model_name)
+        config = model_state.config
+        net = model_state.load_model(set_eval=True)
+        subject = read.test_subject(config["model_path"])
+    net = net.to(device)
+
+    window_size = tuple(subject[tio.IMAGE][tio.DATA].shape[1:])
+    patch_size = data.get_patch_size(config)
+    kwargs = {
+        "patch_size": patch_size,
+        "patch_overlap": PATCH_OVERLAP,
+        "activation": model.activation_name(config),
+        "batch_size": batch_size,
+    }
+
+    tiled_times, tiled = _time(
+        lambda: model.predict(net, subject, **kwargs), n_repeats, "tiled"
+    )
+    whole_times, whole = _time(
+        lambda: model.predict(
+            net,
+            subject,
+            whole_window_multiple=model.input_multiple(config),
+            **kwargs,
+        ),
+        n_repeats,
+        "whole window",
+    )
+
+    n_patches = len(
+        grid.GridPatches(subject[tio.IMAGE][tio.DATA], patch_size, PATCH_OVERLAP)
+    )
+    print(f"Window {window_size}, {n_patches} patches of {patch_size}")
+    print(
+        f"Tiling computes {n_patches * np.prod(patch_size) / np.prod(window_size):.2f}x"
+        " as many voxels as the window"
+    )
+    print(f"tiled:        {tiled_times.mean():.3f} +- {tiled_times.std():.3f} s")
+    print(f"whole window: {whole_times.mean():.3f} +- {whole_times.std():.3f} s")
+    print(f"Speedup: {tiled_times.mean() / whole_times.mean():.2f}x")
+    print(f"Largest difference in probability: {np.abs(tiled - whole).max():.3f}")
+    print(
+        "Dice between the segmentations:"
+        f" {metrics.dice_score((tiled > 0.5).astype(np.uint8), (whole > 0.5).astype(np.float32)):.4f}"
+    )
+
+    if tio.LABEL in subject:
+        label = subject[tio.LABEL][tio.DATA].squeeze().numpy().astype(np.uint8)
+        for name, prediction in [("tiled", tiled), ("whole window", whole)]:
+            print(
+                f"Dice vs label ({name}):"
+                f" {metrics.dice_score(label, (prediction > 0.5).astype(np.float32)):.4f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--n-repeats",
+        type=int,
+        default=3,
+        help="How many times to run each prediction",
+    )
+    parser.add_argument(
+        "--model-name",
+        default=None,
+        help="A trained segmentation model (e.g. my_model.pkl) to run on its test fish."
+        " Uses an untrained model on a random image if not given",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="Patches per forward pass when tiling"
+    )
+    parser.add_argument("--device", "-d", choices={"cpu", "cuda"}, default="cpu")
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,86 @@
+"""
+Convert pickled segmentation models (e.g. `example_segmenter.pkl`) to the artifact
+format, which is quicker and safer to load for inference.
+
+Writes the weights, config and (optionally) optimiser state next to the pickle; see
+`fishlib.model.artifact`. The pickle is left where it is. Once the artifact exists,
+`model.load_model` reads it instead of the pickle, as long as the pickle hasn't been
+written since (an artifact older than its pickle is converted again).
+
+"""
+
+import time
+import pickle
+import argparse
+
+from fishlib.util import files
+from fishlib.model import artifact, model
+
+
+def _load_time(model_name: str) -> float:
+    """
+    How long it takes to load the model, in seconds
+
+    """
+    start = time.perf_counter()
+    model.load_model(model_name).load_model(set_eval=True)
+    return time.perf_counter() - start
+
+
+def main(*, model_names: list[str], no_optimizer: bool, overwrite: bool) -> None:
+    """
+    Convert each model
+
+    """
+    for model_name in model_names:
+        model_path = files.model_path({"model_path": model_name})
+        paths = artifact.paths(model_path)
+        # Stale artifacts (older than the pickle) are always redone
+        if paths.exists() and not artifact.is_stale(model_path) and not overwrite:
+            print(f"{model_name}: already converted; pass --overwrite to redo it")
+            continue
+
+        start = time.perf_counter()
+        with open(model_path, "rb") as f:
+            model_state = pickle.load(f)
+        model_state.load_model(set_eval=True)
+        pickle_time = time.perf_counter() - start
+
+        artifact.save(
+            model_path,
+            model_state.model_state_dict,
+            model_state.config,
+            None if no_optimizer else model_state.optimizer_state_dict,
+        )
+
+        # Check the weights come back the same
+        weights = artifact.load_weights(model_path)
+        for name, tensor in model_state.model_state_dict.items():
+            if not tensor.cpu().equal(weights[name]):
+                raise RuntimeError(f"{model_name}: {name} changed when converting")
+
+        print(
+            f"{model_name}: wrote {paths.weights.name}, {paths.config.name}"
+            f"{'' if no_optimizer else ', ' + paths.optimizer.name}."
+            f" Loads in {_load_time(model_name):.2f}s (was {pickle_time:.2f}s)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "model_names",
+        nargs="+",
+        help="The models to convert, e.g. example_segmenter.pkl",
+    )
+    parser.add_argument(
+        "--no-optimizer",
+        action="store_true",
+        help="Don't keep the optimiser state (only needed for carrying on training)",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Convert models that already have an artifact",
+    )
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,83 @@
+"""
+Create a bank of augmented training patches, for training lots of models with the
+same data settings (e.g. `scripts/paper_scripts/train_lots_of_models.sh`)
+
+The training data and augmentations are read from `userconf.yml`, in the same way
+as `2-train_jaw_segmenter.py`. To train from the bank, set `patch_bank` in
+`userconf.yml` to the directory it was written to.
+
+"""
+
+import pathlib
+import argparse
+import itertools
+from typing import Generator
+
+import torch
+import numpy as np
+import torchio as tio
+
+from fishlib.util import util
+from fishlib.model import data, patch_bank
+
+
+def _patches(queue: tio.Queue) -> Generator[tio.Subject, None, None]:
+    """
+    Patches from the queue, forever
+
+    """
+    for i in itertools.count():
+        yield queue[i]
+
+
+def main(
+    *, out_dir: pathlib.Path, n_patches: int, chunk_size: int, seed: int, float16: bool
+) -> None:
+    """
+    Read the training data, augment it and write patches to disk
+
+    """
+    config = util.userconf()
+    if seed is None:
+        seed = config["torch_seed"]
+    torch.manual_seed(seed)
+
+    train_subjects, _, _ = data.read_dicoms_from_disk(config, verbose=True)
+
+    patch_bank.write_patch_bank(
+        _patches(data.patch_queue(train_subjects, config, train=True)),
+        out_dir,
+        n_patches=n_patches,
+        chunk_size=chunk_size,
+        image_dtype=np.float16 if float16 else np.float32,
+        metadata=patch_bank.metadata(config, seed),
+    )
+    print(f"Wrote {n_patches} patches to {out_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "out_dir", type=pathlib.Path, help="Directory to write the patch bank to"
+    )
+    parser.add_argument(
+        "--n-patches",
+        type=int,
+        default=2048,
+        help="How many patches to write. Each 160^3 patch takes ~20MB of disk",
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=32, help="How many patches in each file"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Random seed for the augmentations; defaults to torch_seed in userconf.yml",
+    )
+    parser.add_argument(
+        "--float16",
+        action="store_true",
+        help="Store the images as float16, to halve the size of the bank",
+    )
+    main(**vars(parser.parse_args()))
@@ -137,7 +137,7 @@ def train(*, epochs: int, **kwargs):
 
     quadrate_data = DataConfig(config, train_subjects, val_subjects)
 
-    net = model.model(config["model_params"])
+    net = model.model(config["model_params"], train=True)
     net = net.to(config["device"])
 
     optimiser = model.optimiser(config, net)
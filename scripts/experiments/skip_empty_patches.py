@@ -0,0 +1,134 @@
+"""
+Check how much skipping empty patches during inference changes the segmentation,
+and how much time it saves.
+
+Runs the segmentation model on the test fish (the one dumped when the model was
+trained) with every patch, then again skipping patches that have nothing bright
+enough to be bone in them (`skip_threshold` in `model.predict`), for a few
+thresholds. Prints a table of the Dice between the segmentations with and without
+skipping (should be ~1), the Dice against the human label, how many patches went
+through the model and how long it took.
+
+Also prints the intensity of the dimmest voxel labelled as bone - thresholds below
+this should never skip a patch with bone in it.
+
+"""
+
+import time
+import argparse
+
+import torch
+import numpy as np
+import torchio as tio
+
+from fishlib.model import model, data
+from fishlib.inference import read
+from fishlib.inference.models import PATCH_OVERLAP
+from fishlib.images import metrics
+
+
+def _predict(
+    net: torch.nn.Module,
+    config: dict,
+    subject: tio.Subject,
+    skip_threshold: float | None,
+    batch_size: int,
+) -> tuple[np.ndarray, int, float]:
+    """
+    Segment the subject
+
+    :returns: the predicted probabilities
+    :returns: how many patches went through the model
+    :returns: how long it took, in seconds
+
+    """
+    n_patches = []
+    hook = net.register_forward_hook(
+        lambda module, args, output: n_patches.append(len(output))
+    )
+
+    start = time.perf_counter()
+    prediction = model.predict(
+        net,
+        subject,
+        patch_size=data.get_patch_size(config),
+        patch_overlap=PATCH_OVERLAP,
+        activation=model.activation_name(config),
+        batch_size=batch_size,
+        skip_threshold=skip_threshold,
+    )
+    elapsed = time.perf_counter() - start
+
+    hook.remove()
+    return prediction, sum(n_patches), elapsed
+
+
+def main(
+    *, model_name: str, thresholds: list[float], batch_size: int, device: str
+) -> None:
+    """
+    Segment the test fish with and without skipping patches, and compare
+
+    """
+    model_state = model.load_model(model_name)
+    config = model_state.config
+    net = model_state.load_model(set_eval=True).to(device)
+
+    subject = read.test_subject(config["model_path"])
+    image = subject[tio.IMAGE][tio.DATA]
+    label = (
+        subject[tio.LABEL][tio.DATA].squeeze().numpy().astype(np.uint8)
+        if tio.LABEL in subject
+        else None
+    )
+    if label is not None:
+        print(f"Dimmest bone voxel: {image[0][label.astype(bool)].min().item():.3f}")
+
+    baseline, n_baseline, baseline_time = _predict(
+        net, config, subject, None, batch_size
+    )
+    baseline_mask = baseline > 0.5
+
+    print(
+        f"{'Threshold':>9} {'Patches':>8} {'Time /s':>8}"
+        f" {'Dice vs all patches':>20} {'Dice vs label':>14}"
+    )
+    for threshold in [None, *thresholds]:
+        if threshold is None:
+            prediction, n_patches, elapsed = baseline, n_baseline, baseline_time
+        else:
+            prediction, n_patches, elapsed = _predict(
+                net, config, subject, threshold, batch_size
+            )
+        mask = prediction > 0.5
+
+        vs_label = (
+            f"{metrics.dice_score(label, mask.astype(np.float32)):.4f}"
+            if label is not None
+            else "-"
+        )
+        print(
+            f"{'none' if threshold is None else threshold:>9} "
+            f"{n_patches:>4}/{n_baseline:<3} {elapsed:>8.1f} "
+            f"{metrics.dice_score(baseline_mask.astype(np.uint8), mask.astype(np.float32)):>20.4f}"
+            f" {vs_label:>14}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("model_name", help="The segmentation model, e.g. my_model.pkl")
+    parser.add_argument(
+        "--thresholds",
+        type=float,
+        nargs="+",
+        default=[0.05, 0.1, 0.2, 0.3],
+        help="Skip patches with nothing at least this bright (intensities are 0-1)",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="Patches per forward pass"
+    )
+    parser.add_argument("--device", "-d", choices={"cpu", "cuda"}, default="cpu")
+
+    main(**vars(parser.parse_args()))
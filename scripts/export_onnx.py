@@ -0,0 +1,106 @@
+"""
+Export the segmentation and/or locator models to ONNX, so they can be run with
+ONNX Runtime (`3-run_inference.py --backend onnx`).
+
+The ONNX files are written next to the models. If ONNX Runtime is installed, the
+exported models are checked against the PyTorch ones on a random volume.
+
+Needs the optional ONNX dependencies (`uv sync --extra onnx`).
+
+"""
+
+import pathlib
+import argparse
+
+import torch
+
+from fishlib.util import files
+from fishlib.model import model, data
+from fishlib.inference import backends, models
+
+
+def _export(
+    net: torch.nn.Module,
+    model_path: pathlib.Path,
+    input_shape: tuple[int, ...],
+    tolerance: float,
+) -> None:
+    """
+    Export a network, and check it gives the same output as PyTorch
+
+    :raises ValueError: if the outputs differ by more than `tolerance`
+
+    """
+    path = backends.export(net, backends.onnx_path(model_path), input_shape=input_shape)
+    print(f"Wrote {path}")
+
+    if not backends.onnx_available():
+        print("onnxruntime isn't installed; not checking the export")
+        return
+
+    difference = backends.max_difference(net, backends.OnnxModule(path), input_shape)
+    print(f"Largest difference in logits vs PyTorch: {difference:.2e}")
+    if difference > tolerance:
+        raise ValueError(
+            f"{path} differs from the PyTorch model by {difference} (> {tolerance})"
+        )
+
+
+def main(
+    *,
+    segmentation_model: str | None,
+    locator_model: str | None,
+    locator_input_size: tuple[int, int, int],
+    tolerance: float,
+) -> None:
+    """
+    Export the models
+
+    """
+    if segmentation_model is None and locator_model is None:
+        raise ValueError("Nothing to export; give a segmentation or locator model")
+
+    if segmentation_model is not None:
+        model_state = model.load_model(segmentation_model)
+        _export(
+            model_state.load_model(set_eval=True),
+            files.model_path({"model_path": segmentation_model}),
+            (1, *data.get_patch_size(model_state.config)),
+            tolerance,
+        )
+
+    if locator_model is not None:
+        _export(
+            models.get_jaw_loc_model(locator_model, "cpu"),
+            files.jaw_locator_model_path(locator_model),
+            (1, *locator_input_size),
+            tolerance,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--segmentation-model",
+        default=None,
+        help="The segmentation model to export, e.g. my_model.pkl",
+    )
+    parser.add_argument(
+        "--locator-model", default=None, help="The locator model to export"
+    )
+    parser.add_argument(
+        "--locator-input-size",
+        type=int,
+        nargs=3,
+        default=(512, 128, 128),
+        help="The size the scans are downsampled to for the locator model; used to"
+        " check the export",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1e-3,
+        help="Fail if the exported model's logits differ from PyTorch's by more than"
+        " this",
+    )
+    main(**vars(parser.parse_args()))
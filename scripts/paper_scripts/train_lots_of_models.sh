@@ -2,6 +2,9 @@
 # Shell script for training lots of models with the same configuration
 # Useful in case we want to investigate the effect of the randomness in the training 
 # process
+#
+# Set PATCH_BANK to a directory to share one bank of augmented patches between all the
+# models, e.g. PATCH_BANK=patch_bank/ bash scripts/paper_scripts/train_lots_of_models.sh
 
 # Backup the original config file
 cp userconf.yml userconf.yml.backup
@@ -9,6 +12,18 @@ cp userconf.yml userconf.yml.backup
 # This is where stuff will get saved to
 mkdir -p logs/
 
+# If PATCH_BANK is set, augment the training data once and train every model from it
+if [ -n "${PATCH_BANK}" ]; then
+    if [ ! -f "${PATCH_BANK}/manifest.json" ]; then
+        if ! uv run python scripts/create_patch_bank.py "${PATCH_BANK}"; then
+            echo "Creating the patch bank failed"
+            rm userconf.yml.backup
+            exit 1
+        fi
+    fi
+    sed -i "s|^patch_bank: .*|patch_bank: \"${PATCH_BANK}\"|" userconf.yml
+fi
+
 for i in {0..19}; do
     echo "Training model attempt_${i}.pkl (iteration $((i+1)) of 19)"
     
@@ -0,0 +1,196 @@
+"""
+Quantise a trained segmentation model to INT8, for faster inference on CPU-only
+machines.
+
+The model is calibrated by running it on windows cropped from the validation DICOMs
+(as created by `0-create_dicoms.py`), then saved next to the float model (see
+`fishlib.inference.quantisation`). Use it with `3-run_inference.py --backend int8`.
+
+The quantised model is then compared to the float one on the test DICOMs: this
+prints the Dice and Hausdorff distance between their segmentations, how long each
+takes and how much memory each uses.
+
+"""
+
+import time
+import resource
+import argparse
+import multiprocessing
+
+import torch
+import numpy as np
+import torchio as tio
+from tqdm import tqdm
+
+from fishlib.util import files
+from fishlib.model import data, model
+from fishlib.images import metrics, transform
+from fishlib.inference import quantisation, backends, models
+
+
+def _max_rss() -> float:
+    """
+    Peak memory used by this process so far, in GB
+
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2
+
+
+def _peak_memory(fcn) -> float:
+    """
+    How much running a function increases the peak memory, in GB
+
+    Run in a forked process, so that one model's peak doesn't hide the other's.
+
+    """
+    context = multiprocessing.get_context("fork")
+    results = context.SimpleQueue()
+
+    def run() -> None:
+        baseline = _max_rss()
+        fcn()
+        results.put(_max_rss() - baseline)
+
+    process = context.Process(target=run)
+    process.start()
+    memory = results.get()
+    process.join()
+    return memory
+
+
+def _timed(fcn) -> tuple[np.ndarray, float]:
+    """
+    :returns: the output of the function
+    :returns: how long it took, in seconds
+
+    """
+    start = time.perf_counter()
+    out = fcn()
+    return out, time.perf_counter() - start
+
+
+def _size(net: torch.nn.Module) -> float:
+    """
+    Size of a network's weights, in MB
+
+    """
+    return (
+        sum(
+            tensor.numel() * tensor.element_size()
+            for tensor in net.state_dict().values()
+            if isinstance(tensor, torch.Tensor)
+        )
+        / 1024**2
+    )
+
+
+def main(
+    *, model_name: str, n_calibration: int | None, engine: str, batch_size: int
+) -> None:
+    """
+    Calibrate and quantise the model, then compare it to the float one
+
+    """
+    model_state = model.load_model(model_name)
+    config = model_state.config
+    float_net = model_state.load_model(set_eval=True)
+
+    patch_size = data.get_patch_size(config)
+    window_size = transform.window_size(config)
+    kwargs = {
+        "patch_size": patch_size,
+        "patch_overlap": models.PATCH_OVERLAP,
+        "activation": model.activation_name(config),
+        "batch_size": batch_size,
+    }
+
+    # Calibrate on the patches the model will actually see at inference time
+    prepared = quantisation.prepare(float_net, (1, *patch_size), engine=engine)
+    for path in tqdm(
+        files.dicom_paths(config, "val")[:n_calibration], desc="Calibrating"
+    ):
+        model.predict(prepared, data.subject(path, window_size), **kwargs)
+
+    quantised = quantisation.save(
+        files.model_path({"model_path": model_name}),
+        prepared,
+        config,
+        input_shape=(1, *patch_size),
+        engine=engine,
+    )
+    print(f"Wrote {quantised.weights} and {quantised.settings}")
+
+    # Load it back by name, the same way inference does
+    int8_net = models.get_jaw_segment_model(
+        model_name, device="cpu", backend="int8"
+    ).net
+    if backends.backend_name(int8_net) != "int8":
+        raise RuntimeError(f"Couldn't load the quantised {model_name}")
+
+    names, labels, float_preds, int8_preds = [], [], [], []
+    float_times, int8_times = [], []
+    for path in tqdm(files.dicom_paths(config, "test"), desc="Comparing"):
+        subject = data.subject(path, window_size)
+        names.append(path.stem)
+        labels.append(subject[tio.LABEL][tio.DATA].squeeze().numpy().astype(np.uint8))
+
+        prediction, elapsed = _timed(
+            lambda: model.predict(float_net, subject, **kwargs)
+        )
+        float_preds.append(prediction)
+        float_times.append(elapsed)
+
+        prediction, elapsed = _timed(lambda: model.predict(int8_net, subject, **kwargs))
+        int8_preds.append(prediction)
+        int8_times.append(elapsed)
+
+    # The float model's segmentation is the truth here
+    table = metrics.table(
+        [(prediction > 0.5).astype(np.uint8) for prediction in float_preds],
+        int8_preds,
+        thresholded_metrics=True,
+    )
+    table.index = names
+    table["Float time /s"] = float_times
+    table["INT8 time /s"] = int8_times
+    print("INT8 vs float model:")
+    print(table.to_markdown())
+
+    for name, predictions in [("float", float_preds), ("INT8", int8_preds)]:
+        print(
+            f"Mean Dice vs label ({name}):"
+            f" {metrics.table(labels, predictions)['Dice'].mean():.4f}"
+        )
+    print(f"Speedup: {np.mean(float_times) / np.mean(int8_times):.2f}x")
+
+    subject = data.subject(files.dicom_paths(config, "test")[0], window_size)
+    for name, net in [("float", float_net), ("INT8", int8_net)]:
+        memory = _peak_memory(lambda: model.predict(net, subject, **kwargs))
+        print(
+            f"{name}: weights {_size(net):.2f} MB,"
+            f" peak memory during inference +{memory:.2f} GB"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "model_name", help="The segmentation model to quantise, e.g. my_model.pkl"
+    )
+    parser.add_argument(
+        "--n-calibration",
+        type=int,
+        default=None,
+        help="How many validation DICOMs to calibrate on. Uses all of them by default",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=torch.backends.quantized.supported_engines,
+        default="x86",
+        help="The quantised kernels to target: x86 for Intel/AMD CPUs, qnnpack for ARM."
+        " Use the same one as the machines you'll run inference on",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="Patches per forward pass"
+    )
+    main(**vars(parser.parse_args()))
@@ -289,7 +289,7 @@ def hausdorff_distance(
     h_d = skimage_m.hausdorff_distance(truth, pred)
 
     # Scale by the image dimensions
-    return h_d / np.sqrt(np.sum(a**2 for a in truth.shape))
+    return h_d / np.sqrt(sum(a**2 for a in truth.shape))
 
 
 def hausdorff_profile(
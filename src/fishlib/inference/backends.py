@@ -0,0 +1,324 @@
+"""
+Run the models with something other than eager PyTorch
+
+The segmentation and locator models can be exported to ONNX (with `export`) and
+run with ONNX Runtime, which fuses and rearranges the graph before running it - on
+CPU-only machines this can be a lot faster than PyTorch.
+
+The segmentation model can also be quantised to INT8 (see `quantisation`).
+
+The ONNX and INT8 models are wrapped in modules that look like a `torch.nn.Module`
+to the rest of the inference code (they take and return tensors), so nothing else
+needs to know which backend is being used.
+
+ONNX and ONNX Runtime are optional; install them with e.g.
+`uv sync --extra onnx`. If they aren't installed (or the model hasn't been exported
+or quantised, or we're not running on the CPU) asking for another backend warns and
+falls back to PyTorch.
+
+"""
+
+import os
+import uuid
+import pathlib
+import warnings
+import threading
+import importlib.util
+from typing import Any, Callable
+
+import torch
+
+from . import quantisation
+from .cache import file_fingerprint
+
+BACKENDS = ("torch", "onnx", "int8")
+
+_INPUT_NAME = "image"
+_OUTPUT_NAME = "logits"
+
+
+def onnx_available() -> bool:
+    """Whether ONNX Runtime is installed"""
+    return importlib.util.find_spec("onnxruntime") is not None
+
+
+def onnx_path(model_path: pathlib.Path) -> pathlib.Path:
+    """
+    Where the ONNX export of a model lives: next to the model, with the extension
+    changed to .onnx
+
+    :param model_path: e.g. from `files.model_path` or `files.jaw_locator_model_path`
+
+    """
+    return pathlib.Path(model_path).with_suffix(".onnx")
+
+
+def export(
+    net: torch.nn.Module,
+    path: pathlib.Path,
+    *,
+    input_shape: tuple[int, ...],
+    opset: int = 17,
+) -> pathlib.Path:
+    """
+    Export a network to ONNX
+
+    The batch size and the spatial dimensions are left dynamic, so the exported
+    model can be run on e.g. a batch of patches or the whole window.
+
+    :param net: the network, e.g. from `ModelState.load_model` or
+                `localisation.model.get_model`. Put into evaluation mode
+    :param path: where to write the ONNX file, e.g. from `onnx_path`
+    :param input_shape: the shape of one input (channels, z, y, x) to trace the
+                        network with
+    :param opset: the ONNX operator set to export to
+
+    :returns: the path that was written
+    :raises ImportError: if ONNX isn't installed
+
+    """
+    if importlib.util.find_spec("onnx") is None:
+        raise ImportError("Exporting to ONNX needs the onnx package; install it")
+
+    path = pathlib.Path(path)
+    dynamic_axes = {0: "batch", 2: "z", 3: "y", 4: "x"}
+
+    # Written to a temporary file then renamed, so an interrupted export doesn't
+    # leave a broken model behind for `load` to find
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with torch.no_grad():
+            torch.onnx.export(
+                net.eval().cpu().float(),
+                (torch.rand(1, *input_shape),),
+                str(tmp_path),
+                input_names=[_INPUT_NAME],
+                output_names=[_OUTPUT_NAME],
+                dynamic_axes={_INPUT_NAME: dynamic_axes, _OUTPUT_NAME: dynamic_axes},
+                opset_version=opset,
+            )
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    return path
+
+
+class CpuModule(torch.nn.Module):
+    """
+    A network read from a file by one of the backends other than PyTorch, which
+    only runs on the CPU in float32
+
+    :param path: the file it was read from
+
+    """
+
+    def __init__(self, path: pathlib.Path):
+        super().__init__()
+        self.path = pathlib.Path(path)
+
+        # The inference code works out which device and precision to send the input
+        # at from the network's parameters
+        self._placeholder = torch.nn.Parameter(torch.empty(0), requires_grad=False)
+
+
+class OnnxModule(CpuModule):
+    """
+    An ONNX model run with ONNX Runtime on the CPU, that can be called like a
+    PyTorch network
+
+    The session is made the first time the model is called, in each process, so
+    it's safe to make one of these before forking worker processes. It uses as many
+    threads as `torch.get_num_threads()` at that point.
+
+    :param path: the ONNX file, from `export`
+
+    """
+
+    def __init__(self, path: pathlib.Path):
+        super().__init__(path)
+
+        self._session: Any = None
+        self._session_pid: int | None = None
+        self._lock = threading.Lock()
+
+    def _get_session(self) -> Any:
+        with self._lock:
+            if self._session_pid != os.getpid():
+                import onnxruntime
+
+                options = onnxruntime.SessionOptions()
+                options.graph_optimization_level = (
+                    onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+                )
+                options.intra_op_num_threads = torch.get_num_threads()
+
+                self._session = onnxruntime.InferenceSession(
+                    str(self.path), options, providers=["CPUExecutionProvider"]
+                )
+                self._session_pid = os.getpid()
+
+            return self._session
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        (logits,) = self._get_session().run(
+            [_OUTPUT_NAME], {_INPUT_NAME: x.detach().cpu().float().numpy()}
+        )
+        return torch.from_numpy(logits)
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Sessions and locks can't be pickled; the new copy makes its own
+        state = self.__dict__.copy()
+        state.update(_session=None, _session_pid=None, _lock=None)
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class QuantisedModule(CpuModule):
+    """
+    An INT8 segmentation model, from `quantisation`
+
+    :param model_path: path to the float model's pickle; the quantised model is
+                       next to it
+
+    """
+
+    def __init__(self, model_path: pathlib.Path):
+        super().__init__(quantisation.paths(model_path).weights)
+        self.net = quantisation.load(model_path)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.net(x.cpu().float())
+
+
+def max_difference(
+    reference: torch.nn.Module,
+    other: torch.nn.Module,
+    input_shape: tuple[int, ...],
+    *,
+    seed: int = 0,
+) -> float:
+    """
+    Check two networks (e.g. the PyTorch model and its ONNX export) give the same
+    output, on a random volume
+
+    :param reference: one network
+    :param other: the other
+    :param input_shape: the shape of the input (channels, z, y, x)
+    :param seed: for making the input
+
+    :returns: the largest absolute difference between their logits
+
+    """
+    x = torch.rand(1, *input_shape, generator=torch.Generator().manual_seed(seed))
+    with torch.no_grad():
+        expected = reference.eval()(x).float().cpu()
+        actual = other.eval()(x).float().cpu()
+    return (expected - actual).abs().max().item()
+
+
+# The file each backend reads, and how to make it
+_BACKEND_FILES = {
+    "onnx": (onnx_path, "export it with scripts/export_onnx.py"),
+    "int8": (
+        lambda model_path: quantisation.paths(model_path).weights,
+        "quantise it with scripts/quantise_model.py",
+    ),
+}
+
+
+def _unavailable_reason(
+    backend: str,
+    model_path: pathlib.Path,
+    model_files: list[pathlib.Path],
+    device: str,
+    dtype: torch.dtype,
+) -> str | None:
+    """
+    Why we can't use a backend other than PyTorch, or None if we can
+
+    """
+    if backend == "onnx" and not onnx_available():
+        return "onnxruntime isn't installed"
+    if torch.device(device).type != "cpu":
+        return f"it only runs on the CPU, not {device}"
+    if dtype != torch.float32:
+        return f"it only runs in float32, not {dtype}"
+
+    get_path, how = _BACKEND_FILES[backend]
+    path = get_path(model_path)
+    if not path.is_file():
+        return f"{path} doesn't exist; {how}"
+    if any(
+        model_file.stat().st_mtime > path.stat().st_mtime
+        for model_file in model_files
+        if model_file.exists()
+    ):
+        return f"{path} is older than the model; {how} again"
+    return None
+
+
+def load(
+    backend: str,
+    torch_net: Callable[[], torch.nn.Module],
+    model_path: pathlib.Path,
+    model_files: list[pathlib.Path],
+    *,
+    device: str,
+    dtype: torch.dtype = torch.float32,
+) -> torch.nn.Module:
+    """
+    Get a network to run with a backend, falling back to PyTorch if we can't use it
+
+    :param backend: one of `BACKENDS`. "int8" only works for segmentation models
+    :param torch_net: builds the PyTorch network, on the right device and with the
+                      right precision, in evaluation mode. Only called if we're
+                      using (or falling back to) PyTorch
+    :param model_path: the model, e.g. from `files.model_path`; the ONNX or INT8
+                       files are next to it
+    :param model_files: the files the weights are read from; the ONNX or INT8 files
+                        shouldn't be older than any of them
+    :param device: the device to run on
+    :param dtype: the precision to run at
+
+    :returns: something that can be called like a PyTorch network
+    :raises ValueError: if the backend isn't one of `BACKENDS`
+
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}; must be one of {BACKENDS}")
+
+    if backend != "torch":
+        reason = _unavailable_reason(backend, model_path, model_files, device, dtype)
+        if reason is None:
+            if backend == "onnx":
+                return OnnxModule(onnx_path(model_path))
+            return QuantisedModule(model_path)
+        warnings.warn(
+            f"Can't use the {backend} backend ({reason}); using PyTorch instead"
+        )
+
+    return torch_net()
+
+
+def backend_name(net: torch.nn.Module) -> str:
+    """Which backend a network from `load` runs with"""
+    if isinstance(net, OnnxModule):
+        return "onnx"
+    if isinstance(net, QuantisedModule):
+        return "int8"
+    return "torch"
+
+
+def fingerprint(net: torch.nn.Module) -> str | dict[str, Any]:
+    """
+    Something that changes if a different backend or ONNX file is used, for cache
+    keys - the backends don't give exactly the same output
+
+    """
+    if isinstance(net, CpuModule):
+        return {backend_name(net): file_fingerprint(net.path)}
+    return "torch"
@@ -0,0 +1,150 @@
+"""
+Cache the results of each stage of inference, so re-runs only redo what's changed
+
+Inference on a scan goes through three stages, each of which we can cache:
+ - downsample: shrink the scan to the size the locator model expects
+ - locate: find the object with the locator model and crop it out
+ - segment: segment the cropped image
+
+Each result is stored under a key made from everything it depends on: the input
+file (its size and modification time, not the contents - reading a whole scan just to
+hash it would take as long as the thing we're trying to skip), the model files, and
+the options. If any of these change, the key changes and the stage is redone.
+The segmentation key uses a digest of the cropped image itself, so it's still valid
+if the locator is re-run and gives the same crop.
+
+The locate stage also stores the cropped image, so if it's still valid we don't need
+to read the scan at all.
+
+"""
+
+import os
+import json
+import uuid
+import hashlib
+import pathlib
+import zipfile
+from typing import Any
+
+import numpy as np
+
+STAGES = ("downsample", "locate", "segment")
+
+
+def file_fingerprint(path: pathlib.Path) -> dict[str, Any]:
+    """
+    Something that changes if a file (or any file in a directory) changes, without
+    reading it
+
+    :param path: a file, or a directory (e.g. of 2D TIFs)
+    :returns: the resolved path, and the size and modification time of every file
+
+    """
+    path = pathlib.Path(path).resolve()
+    paths = (
+        sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+    )
+
+    return {
+        "path": str(path),
+        "files": [
+            (str(p.relative_to(path)) if path.is_dir() else p.name, *_stat(p))
+            for p in paths
+        ],
+    }
+
+
+def _stat(path: pathlib.Path) -> tuple[int, int]:
+    stat = path.stat()
+    return stat.st_size, stat.st_mtime_ns
+
+
+def array_digest(array: np.ndarray) -> str:
+    """
+    A hash of an array's contents, shape and type
+
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{array.dtype.str}{array.shape}".encode())
+    digest.update(np.ascontiguousarray(array).data)
+    return digest.hexdigest()
+
+
+def key(*parts: Any) -> str:
+    """
+    Make a cache key from some JSON-able parts, e.g. a file fingerprint and options
+
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class StageCache:
+    """
+    Arrays stored on disk, one file per stage and key
+
+    :param directory: where to keep the cache, or None to not cache anything
+    :param force: stages to redo even if they're cached. Forcing a stage also forces
+                  the ones after it. The new results replace the cached ones.
+
+    :raises ValueError: if a stage isn't one of `STAGES`
+
+    """
+
+    def __init__(self, directory: pathlib.Path | None, *, force: tuple[str, ...] = ()):
+        if unknown := set(force) - set(STAGES):
+            raise ValueError(f"Unknown stages {unknown}; must be from {STAGES}")
+
+        self.directory = None if directory is None else pathlib.Path(directory)
+        self.forced = (
+            set(STAGES[min(STAGES.index(stage) for stage in force) :])
+            if force
+            else set()
+        )
+
+    def _path(self, stage: str, stage_key: str) -> pathlib.Path:
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage {stage}; must be one of {STAGES}")
+        return self.directory / stage / f"{stage_key}.npz"
+
+    def load(self, stage: str, stage_key: str) -> dict[str, np.ndarray] | None:
+        """
+        Get a cached result
+
+        :param stage: which stage it's from
+        :param stage_key: from `key`
+        :returns: the arrays that were saved, or None if there aren't any (or the
+                  stage is forced, or the file is broken)
+
+        """
+        if self.directory is None or stage in self.forced:
+            return None
+
+        try:
+            with np.load(self._path(stage, stage_key)) as cached:
+                return dict(cached)
+        except (OSError, zipfile.BadZipFile, EOFError, ValueError):
+            # Not there, or corrupted; redo it
+            return None
+
+    def save(self, stage: str, stage_key: str, **arrays: np.ndarray) -> None:
+        """
+        Cache a result
+
+        Written to a temporary file and then renamed, so other processes never see
+        half a file.
+
+        :param stage: which stage it's from
+        :param stage_key: from `key`
+        :param arrays: the result
+
+        """
+        if self.directory is None:
+            return
+
+        path = self._path(stage, stage_key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
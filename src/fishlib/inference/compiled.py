@@ -0,0 +1,268 @@
+"""
+Compile the segmentation network for the patch shape it's run on, to cut out the
+Python overhead of running it eagerly
+
+There are two ways to do this:
+ - "frozen": trace the network with TorchScript and freeze it, which folds the
+   weights in as constants and fuses e.g. the convolutions with what follows them.
+   Quick to do, and the result is saved as a TorchScript file.
+ - "inductor": `torch.compile`, which generates fused kernels for the network.
+   Can be a lot faster but takes a minute or more to compile, so the compiled
+   kernels are saved with `torch.compiler.save_cache_artifacts` and loaded back
+   next time, which makes compiling again much quicker.
+
+Either way, the result is kept in a cache directory under a key made from the
+model's files, the input shape, the execution profile and the PyTorch version, and
+reused on later runs. Compiling only covers one input shape, so anything else (e.g.
+the last, smaller batch of patches) runs eagerly. If compiling fails, or the compiled
+network doesn't give the same output as the eager one, this warns and runs
+everything eagerly.
+
+"""
+
+import os
+import time
+import uuid
+import pathlib
+import warnings
+import dataclasses
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import torch
+
+from ..util import files
+from .cache import key
+from .profiles import ExecutionProfile
+from .backends import CpuModule
+
+MODES = ("eager", "frozen", "inductor")
+
+_SUFFIXES = {"frozen": ".frozen.pt", "inductor": ".inductor.bin"}
+
+
+def default_cache_dir() -> pathlib.Path:
+    """Where compiled networks are kept unless told otherwise"""
+    return files.script_out_dir() / "compiled_models"
+
+
+@dataclass(frozen=True)
+class Startup:
+    """How getting the compiled network ready went"""
+
+    # What the network actually runs with: the mode asked for, or "eager" if it
+    # couldn't be compiled
+    mode: str
+
+    # How long it took, including the warm-up runs
+    seconds: float
+
+    # Whether the compiled network was read from the cache rather than compiled
+    cached: bool
+
+    def __str__(self) -> str:
+        if self.mode == "eager":
+            return f"eager, {self.seconds:.1f}s"
+        how = "loaded from cache" if self.cached else "compiled"
+        return f"{self.mode}, {how} in {self.seconds:.1f}s"
+
+
+class CompiledModule(torch.nn.Module):
+    """
+    A network with a compiled version for one input shape; inputs of any other
+    shape are run with the original network
+
+    :param net: the eager network
+    :param compiled: the compiled version of it
+    :param input_shape: the shape (batch, channels, z, y, x) it was compiled for
+
+    """
+
+    def __init__(
+        self,
+        net: torch.nn.Module,
+        compiled: Callable[[torch.Tensor], torch.Tensor],
+        input_shape: tuple[int, ...],
+    ):
+        super().__init__()
+        self.net = net
+        self.compiled = compiled
+        self.input_shape = tuple(input_shape)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if tuple(x.shape) == self.input_shape:
+            return self.compiled(x)
+        return self.net(x)
+
+
+def cache_path(
+    cache_dir: pathlib.Path,
+    mode: str,
+    *,
+    model_key: Any,
+    input_shape: tuple[int, ...],
+    profile: ExecutionProfile,
+    device: str,
+) -> pathlib.Path:
+    """
+    Where a compiled network is kept
+
+    :param cache_dir: the cache directory
+    :param mode: "frozen" or "inductor"
+    :param model_key: something JSON-able that changes when the model does, e.g. the
+                      fingerprints of its files
+    :param input_shape: the shape it's compiled for
+    :param profile: the execution profile it's run with; the threads don't matter
+    :param device: the device it's run on
+
+    """
+    settings = dataclasses.asdict(profile)
+    for ignored in ("name", "intra_op_threads", "inter_op_threads"):
+        settings.pop(ignored)
+
+    return pathlib.Path(cache_dir) / (
+        key(
+            model_key,
+            list(input_shape),
+            settings,
+            mode,
+            str(torch.device(device)),
+            torch.__version__,
+        )
+        + _SUFFIXES[mode]
+    )
+
+
+def _write(path: pathlib.Path, write: Callable[[pathlib.Path], None]) -> None:
+    """
+    Write a file via a temporary one, so other processes never see half of it
+
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _frozen(
+    net: torch.nn.Module, example: torch.Tensor, path: pathlib.Path
+) -> tuple[torch.jit.ScriptModule, bool]:
+    """
+    Load the frozen network from the cache, or trace and freeze it
+
+    :returns: the frozen network
+    :returns: whether it was in the cache
+
+    """
+    if path.is_file():
+        return torch.jit.load(path, map_location=example.device), True
+
+    with torch.no_grad():
+        frozen = torch.jit.freeze(torch.jit.trace(net, example))
+    _write(path, lambda tmp_path: torch.jit.save(frozen, tmp_path))
+    return frozen, False
+
+
+def _inductor(
+    net: torch.nn.Module, example: torch.Tensor, path: pathlib.Path
+) -> tuple[Callable[[torch.Tensor], torch.Tensor], bool]:
+    """
+    Compile the network with `torch.compile`, starting from the cached kernels if
+    we've got them
+
+    :returns: the compiled network, already compiled for `example`'s shape
+    :returns: whether the kernels were in the cache
+
+    """
+    cached = path.is_file()
+    if cached:
+        torch.compiler.load_cache_artifacts(path.read_bytes())
+
+    compiled = torch.compile(net, dynamic=False)
+    with torch.no_grad():
+        compiled(example)
+
+    if not cached and (artifacts := torch.compiler.save_cache_artifacts()):
+        _write(path, lambda tmp_path: tmp_path.write_bytes(artifacts[0]))
+    return compiled, cached
+
+
+def compile_network(
+    net: torch.nn.Module,
+    mode: str,
+    *,
+    input_shape: tuple[int, ...],
+    model_key: Any,
+    profile: ExecutionProfile,
+    cache_dir: pathlib.Path | None = None,
+    n_warmup: int = 2,
+    tolerance: float = 1e-2,
+) -> tuple[torch.nn.Module, Startup]:
+    """
+    Get a network ready to run compiled, falling back to running it eagerly if
+    that doesn't work
+
+    :param net: the network in evaluation mode, e.g. from `profiles.wrap`. Networks
+                from the other backends (see `backends`) aren't compiled
+    :param mode: one of `MODES`
+    :param input_shape: the shape (batch, channels, z, y, x) to compile it for
+    :param model_key: something JSON-able that changes when the model does, e.g. the
+                      fingerprints of its files
+    :param profile: the execution profile the network is run with
+    :param cache_dir: where to keep the compiled network. Defaults to
+                      `default_cache_dir()`
+    :param n_warmup: how many times to run it before returning, so the first real
+                     call isn't slow
+    :param tolerance: fall back to eager mode if the compiled network's output
+                      differs from the eager one's by more than this
+
+    :returns: something that can be called like the network
+    :returns: what was done, and how long it took
+    :raises ValueError: if the mode isn't one of `MODES`
+
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown compile mode {mode}; must be one of {MODES}")
+
+    start = time.perf_counter()
+    if mode == "eager" or isinstance(net, CpuModule):
+        return net, Startup("eager", time.perf_counter() - start, False)
+
+    parameter = next(net.parameters())
+    example = torch.rand(input_shape, generator=torch.Generator().manual_seed(0)).to(
+        device=parameter.device, dtype=parameter.dtype
+    )
+    path = cache_path(
+        default_cache_dir() if cache_dir is None else cache_dir,
+        mode,
+        model_key=model_key,
+        input_shape=input_shape,
+        profile=profile,
+        device=str(parameter.device),
+    )
+
+    try:
+        compiled, cached = (_frozen if mode == "frozen" else _inductor)(
+            net, example, path
+        )
+        with torch.no_grad():
+            for _ in range(n_warmup):
+                actual = compiled(example)
+            difference = (actual.float() - net(example).float()).abs().max().item()
+        if difference > tolerance:
+            raise ValueError(
+                f"the output differs from the eager network's by {difference:.2e}"
+            )
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        # Don't keep a cached network that doesn't work
+        path.unlink(missing_ok=True)
+        warnings.warn(f"Couldn't compile the network ({e}); running it eagerly")
+        return net, Startup("eager", time.perf_counter() - start, False)
+
+    return (
+        CompiledModule(net, compiled, input_shape),
+        Startup(mode, time.perf_counter() - start, cached),
+    )
@@ -85,34 +85,24 @@ def _get_paths(input_data: pathlib.Path) -> list[pathlib.Path]:
     return [input_data]
 
 
-def inference_inputs(
-    input_data: pathlib.Path, two_d_images: bool
-) -> Generator[tuple[pathlib.Path, np.ndarray], None, None]:
+def inference_paths(input_data: pathlib.Path, two_d_images: bool) -> list[pathlib.Path]:
     """
-    Get the inputs to run inference on as numpy arrays - both the path and the
-    image as a numpy array.
-
-    The inputs can be:
-        1) A single image, specified as:
-            i) The path to a regular file (3D TIF or DICOM)
-            ii) The path to a directory containing 2D TIFs
-        2) Multiple images, specified as:
-            i) A directory containing regular files (3D TIF or DICOM)
-            i) A text file containing paths to regular files
+    Find the inputs to run inference on, without reading them.
 
-    Yields image arrays one at a time.
+    Each path is either a 3D image file (TIF or DICOM) or a directory of 2D TIFs,
+    and can be read with `convert_input_to_array`.
 
-    :param input_data: the input data path (either directory or regular file)
+    :param input_data: the input data path - see `inference_inputs`
     :param two_d_images: whether the input(s) are directories containing 2D images.
 
     :raises FileNotFoundError: the input file doesn't exist
-    :raises FileNotFoundError: if we try to stack 2D images but the directory doesn't contain any
     :raises ValueError: if we are passed a regular file but --two-d-images is set
-    :raises ValueError: if we are passed directory containing no 3D TIFs or DICOMs
+    :raises FileNotFoundError: if we are passed directory containing no 3D TIFs or DICOMs
     """
     if not input_data.exists():
         raise FileNotFoundError(str(input_data))
 
+    paths = []
     for path in _get_paths(input_data):
         if not path.exists():
             raise FileNotFoundError(str(path))
@@ -125,17 +115,46 @@ def inference_inputs(
                     "This might be because you tried to supply a text file with a mixture of directories of 2D"
                     "TIFs and 3D images."
                 )
-            yield path, convert_input_to_array(path)
+            paths.append(path)
 
         # Case 2 - dir of 2D images
         elif two_d_images:
-            yield path, convert_input_to_array(path)
+            paths.append(path)
 
         # Case 3 - dir of regular files
         else:
             img_paths = sorted(list(path.glob("*.dcm")) + list(path.glob("*.tif")))
             if not img_paths:
                 raise FileNotFoundError(f"No .dcm or .tif files found in {path}")
+            paths.extend(img_paths)
+
+    return paths
+
+
+def inference_inputs(
+    input_data: pathlib.Path, two_d_images: bool
+) -> Generator[tuple[pathlib.Path, np.ndarray], None, None]:
+    """
+    Get the inputs to run inference on as numpy arrays - both the path and the
+    image as a numpy array.
+
+    The inputs can be:
+        1) A single image, specified as:
+            i) The path to a regular file (3D TIF or DICOM)
+            ii) The path to a directory containing 2D TIFs
+        2) Multiple images, specified as:
+            i) A directory containing regular files (3D TIF or DICOM)
+            i) A text file containing paths to regular files
+
+    Yields image arrays one at a time.
+
+    :param input_data: the input data path (either directory or regular file)
+    :param two_d_images: whether the input(s) are directories containing 2D images.
 
-            for image_path in img_paths:
-                yield image_path, convert_input_to_array(image_path)
+    :raises FileNotFoundError: the input file doesn't exist
+    :raises FileNotFoundError: if we try to stack 2D images but the directory doesn't contain any
+    :raises ValueError: if we are passed a regular file but --two-d-images is set
+    :raises ValueError: if we are passed directory containing no 3D TIFs or DICOMs
+    """
+    for path in inference_paths(input_data, two_d_images):
+        yield path, convert_input_to_array(path)
@@ -7,17 +7,33 @@ functions, they're just here to keep everything in one place
 """
 
 import pathlib
+import threading
 import functools
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
 
 import torch
 import numpy as np
 import torchio as tio
 
 from ..util import files
-from ..model import data
-from ..model.model import ModelState, load_model, predict, activation_name
-from ..localisation.model import get_model, crop
+from ..model import data, artifact
+from ..model.model import (
+    ModelState,
+    load_model,
+    predict_many,
+    activation_name,
+    input_multiple,
+)
+from ..localisation.model import get_model, predict_centroid
+from ..localisation.data import downsample_img, scale_factor, scale_prediction_up
+from ..images import transform
 from ..images.metrics import largest_connected_component
+from . import backends
+
+# The overlap between the patches the segmentation model is run on
+PATCH_OVERLAP = (4, 4, 4)
 
 
 class InferenceError(Exception):
@@ -26,8 +42,27 @@ class InferenceError(Exception):
     """
 
 
+def _jaw_loc_model(model_path: pathlib.Path, device: str) -> torch.nn.Module:
+    """
+    Build the locator network in PyTorch and load its weights
+    """
+    # Get the right architecture
+    model = get_model(device)
+
+    # Load the weights into it
+    with open(model_path, "rb") as f:
+        model.load_state_dict(torch.load(f))
+
+    # Set into eval mode - we don't need to update weights or anything during
+    # inference
+    model.eval()
+    return model
+
+
 @functools.cache
-def get_jaw_loc_model(model_name: str, device: str) -> torch.nn.Module:
+def get_jaw_loc_model(
+    model_name: str, device: str, backend: str = "torch"
+) -> torch.nn.Module:
     """
     Get the network used to locate the jaw in a CT scan
 
@@ -37,33 +72,211 @@ def get_jaw_loc_model(model_name: str, device: str) -> torch.nn.Module:
     :param model_name: name of the jaw locator model, as provided when
                        training the model.
     :param device: "cuda" to run on GPU, else "cpu"
+    :param backend: what to run the network with; see `backends.load`
 
     :returns: the trained model for locating the jaw
     """
-    # Get the right architecture
-    model = get_model(device)
+    model_path = files.jaw_locator_model_path(model_name)
+    return backends.load(
+        backend,
+        lambda: _jaw_loc_model(model_path, device),
+        model_path,
+        [model_path],
+        device=device,
+    )
 
-    # Load the weights into it
-    with open(files.jaw_locator_model_path(model_name), "rb") as f:
-        model.load_state_dict(torch.load(f))
 
-    # Set into eval mode - we don't need to update weights or anything during
-    # inference
-    model.eval()
-    return model
+@dataclass(frozen=True)
+class LoadedModel:
+    """
+    A segmentation network, built and ready for inference
+    """
 
+    # In evaluation mode, on the right device and with the right precision (or
+    # an ONNX model that can be called like one; see `backends`)
+    net: torch.nn.Module
+
+    # The configuration used to train the model
+    config: dict[str, Any]
+
+
+class ModelRegistry:
+    """
+    Keep built segmentation networks around, so we don't rebuild them for every scan
+
+    Each (model name, device, precision, backend) is only read from disk and built
+    once.
+    If more than `max_models` have been loaded, the least recently used one is
+    thrown away - e.g. when comparing lots of models, we don't want all of them in
+    (GPU) memory at once.
+
+    :param max_models: how many networks to keep loaded
 
-@functools.cache
-def get_jaw_segment_model(segment_model_name: str, *, device: str) -> ModelState:
+    """
+
+    def __init__(self, max_models: int = 2):
+        if max_models < 1:
+            raise ValueError(f"Must keep at least one model, got {max_models}")
+
+        self.max_models = max_models
+        self._models: OrderedDict[tuple[str, str, torch.dtype, str], LoadedModel] = (
+            OrderedDict()
+        )
+
+        # Models might be requested from several threads at once
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        model_name: str,
+        *,
+        device: str,
+        dtype: torch.dtype = torch.float32,
+        backend: str = "torch",
+    ) -> LoadedModel:
+        """
+        Get a network, building it if it isn't already loaded
+
+        :param model_name: the name of the segmentation model, as chosen when the model
+                           was trained.
+        :param device: either "cuda" to run on GPU or "cpu"
+        :param dtype: the precision to run the model at. Half precision (float16) is
+                      only really useful on the GPU; use bfloat16 on the CPU.
+        :param backend: what to run the network with; see `backends.load`
+
+        :returns: the network and its training config
+
+        """
+        key = (model_name, str(torch.device(device)), dtype, backend)
+
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+
+            model_state = load_model(model_name)
+            model_path = files.model_path({"model_path": model_name})
+            loaded = LoadedModel(
+                backends.load(
+                    backend,
+                    lambda: model_state.load_model(set_eval=True).to(
+                        device=device, dtype=dtype
+                    ),
+                    model_path,
+                    artifact.model_files(model_path),
+                    device=device,
+                    dtype=dtype,
+                ),
+                model_state.config,
+            )
+
+            self._models[key] = loaded
+            while len(self._models) > self.max_models:
+                # Check where the evicted model was, not where the new one is
+                evicted_device = self._models.popitem(last=False)[0][1]
+                if torch.device(evicted_device).type == "cuda":
+                    torch.cuda.empty_cache()
+
+            return loaded
+
+    def clear(self) -> None:
+        """
+        Unload all the networks
+        """
+        with self._lock:
+            self._models.clear()
+
+    def __contains__(self, key: tuple[str, str, torch.dtype, str]) -> bool:
+        return key in self._models
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+
+registry = ModelRegistry()
+"""The networks used by `get_jaw_segment_model`"""
+
+
+def get_jaw_segment_model(
+    segment_model_name: str,
+    *,
+    device: str,
+    dtype: torch.dtype = torch.float32,
+    backend: str = "torch",
+) -> LoadedModel:
     """
     Get a segmentation model.
 
+    The network is only built once for each device and precision, and kept in
+    `registry` for next time.
+
     :param segment_model_name: the name of the segmentation model, as chosen when the model
                                was trained.
     :param device: either "cuda" to run on GPU or "cpu"
-    :returns: trained jaw segmentation model
+    :param dtype: the precision to run the model at
+    :param backend: what to run the network with; see `backends.load`
+    :returns: trained jaw segmentation model, ready for inference
+    """
+    return registry.get(segment_model_name, device=device, dtype=dtype, backend=backend)
+
+
+@dataclass(frozen=True)
+class Location:
+    """Where the locator model found the object, and everything it took to get there"""
+
+    # The scan, downsampled to the size the locator model expects
+    downsampled: np.ndarray
+
+    # The centre of the object in the full-size scan (z, y, x)
+    centroid: tuple[int, int, int]
+
+    # The (start, end) of the crop window along each axis of the full-size scan
+    crop_box: tuple[tuple[int, int], tuple[int, int], tuple[int, int]]
+
+    cropped: np.ndarray
+
+
+def locate_object(
+    locator_model: torch.nn.Module,
+    ct_scan: np.ndarray,
+    *,
+    locator_input_size: tuple[int, int, int],
+    window_size: tuple[int, int, int],
+    downsampled: np.ndarray | None = None,
+) -> Location:
+    """
+    Find the region of interest in the CT scan using the model, and crop it out.
+
+    Like `crop_object`, but also returns the intermediate steps so they can be
+    cached.
+
+    :param locator_model: the model used to locate an object in a CT scan
+    :param ct_scan: 3D greyscale numpy array - the input data
+    :param locator_input_size: the size of the input to the locator model.
+    :param window_size: size of the cropped image.
+    :param downsampled: the scan already downsampled to `locator_input_size`, if
+                        we've got it (e.g. from a cache). Downsampled here otherwise.
+
+    :returns: the location and the cropped image
+    :raises CropOutOfBoundsError: if the crop window goes outside the scan
     """
-    return load_model(segment_model_name)
+    if downsampled is None:
+        downsampled = downsample_img(ct_scan, locator_input_size, interpolate=True)
+
+    # Find the centroid on the downsampled image, then scale it back up
+    centroid = scale_prediction_up(
+        predict_centroid(locator_model, downsampled),
+        scale_factor(ct_scan.shape, locator_input_size),
+    )
+
+    return Location(
+        downsampled=downsampled,
+        centroid=centroid,
+        crop_box=tuple(
+            transform.start_and_end(c, size) for c, size in zip(centroid, window_size)
+        ),
+        cropped=transform.crop(ct_scan, centroid, window_size, centred=True),
+    )
 
 
 def crop_object(
@@ -89,36 +302,55 @@ def crop_object(
 
     :returns: 3D numpy array of the cropped image
     """
-    return crop(
+    return locate_object(
         locator_model,
         ct_scan,
-        model_input_size=locator_input_size,
+        locator_input_size=locator_input_size,
         window_size=window_size,
-    )
+    ).cropped
 
 
-def segment_object(
-    segmentor_model: ModelState,
-    cropped_ct_scan: np.ndarray,
+def segment_objects(
+    segmentor_model: LoadedModel | ModelState,
+    cropped_ct_scans: list[np.ndarray],
     *,
+    batch_size: int = 1,
     threshold: float | None = 0.5,
     largest_component: bool = True,
-) -> np.ndarray:
+    half_precision: bool = False,
+    quantise: bool = False,
+    skip_threshold: float | None = None,
+    whole_window: bool = False,
+) -> list[np.ndarray]:
     """
-    Segment an object from a cropped CT scan
+    Segment objects from several cropped CT scans at once
 
-    Thresholds the model's output at 0.5, and takes the largest connected component
-    after this thresholding.
+    Each cropped scan is only a handful of patches, so segmenting them one at a time
+    means running the model on small batches. This pools the patches from all the
+    scans into batches of `batch_size`, which makes better use of the CPU/GPU.
 
-    :param cropped_ct_scan: 3D CT scan to perform inference on
-    :param segmentor_model: trained model for performing segmentation
+    :param segmentor_model: trained model for performing segmentation, e.g. from
+                            `get_jaw_segment_model`. If a `ModelState` is passed, the
+                            network is built from scratch (on the CPU) every time.
+    :param cropped_ct_scans: 3D CT scans to perform inference on
+    :param batch_size: how many patches to run through the model at once
     :param threshold: either a float, in which case the output is thresholded, or None
                       in which case the model's output is not thresholded and will return
                       a floating-point array rather than a binary mask.
     :param largest_component: whether to take the largest connected component in the
                               predicted mask. A threshold must be provided if this is `True`.
-
-    :returns: a numpy array of model predictions
+    :param half_precision: stitch the patches together in float16, to halve the memory
+    :param quantise: if not thresholding, return the probabilities as uint8 (0-255)
+                     rather than floats
+    :param skip_threshold: skip patches with no voxels at least this bright (with
+                           intensities scaled to [0, 1]), i.e. with no bone in them.
+                           They're predicted as background without running the model.
+    :param whole_window: run the model on each whole crop at once rather than on
+                         overlapping patches, if there's enough memory. Faster, since
+                         the overlaps aren't computed several times, but the model
+                         sees different context than it was trained with.
+
+    :returns: the model's predictions, in the same order as `cropped_ct_scans`
     :raises: InferenceError if `largest_connected_component` is `True` but no threshold is provided
              (it makes no sense to take the largest connected component of a float image).
     """
@@ -130,26 +362,80 @@ def segment_object(
     # Get the config from the model
     config = segmentor_model.config
 
-    # Turn the image into a Subject that we can perform inference on
-    scaled = data.ints2float(cropped_ct_scan)
-    tensor = torch.as_tensor(scaled, dtype=torch.float32).unsqueeze(0)
-    subject = tio.Subject(image=tio.Image(tensor=tensor, type=tio.INTENSITY))
+    # Turn the images into Subjects that we can perform inference on
+    subjects = []
+    for cropped_ct_scan in cropped_ct_scans:
+        scaled = data.ints2float(cropped_ct_scan)
+        tensor = torch.as_tensor(scaled, dtype=torch.float32).unsqueeze(0)
+        subjects.append(tio.Subject(image=tio.Image(tensor=tensor, type=tio.INTENSITY)))
+
+    net = (
+        segmentor_model.net
+        if isinstance(segmentor_model, LoadedModel)
+        else segmentor_model.load_model(set_eval=True)
+    )
 
-    prediction = predict(
-        segmentor_model.load_model(set_eval=True),
-        subject,
+    predictions = predict_many(
+        net,
+        subjects,
         # Perform inference with the same settings we trained with
         patch_size=data.get_patch_size(config),
         # Hard-code the patch overlap but it would be better if it were
         # in the config
-        patch_overlap=(4, 4, 4),
+        patch_overlap=PATCH_OVERLAP,
         activation=activation_name(config),
+        batch_size=batch_size,
+        accumulator_dtype=torch.float16 if half_precision else torch.float32,
+        quantise=quantise,
+        skip_threshold=skip_threshold,
+        whole_window_multiple=input_multiple(config) if whole_window else None,
     )
 
-    if threshold is not None:
-        prediction = prediction > threshold
+    results = []
+    for prediction in predictions:
+        if threshold is not None:
+            prediction = prediction > (threshold * 255 if quantise else threshold)
+
+        if largest_component:
+            prediction = largest_connected_component(prediction)
+
+        results.append(prediction)
+
+    return results
 
-    if largest_component:
-        prediction = largest_connected_component(prediction)
 
+def segment_object(
+    segmentor_model: LoadedModel | ModelState,
+    cropped_ct_scan: np.ndarray,
+    *,
+    threshold: float | None = 0.5,
+    largest_component: bool = True,
+    half_precision: bool = False,
+    quantise: bool = False,
+    skip_threshold: float | None = None,
+    whole_window: bool = False,
+) -> np.ndarray:
+    """
+    Segment an object from a cropped CT scan
+
+    Thresholds the model's output at 0.5, and takes the largest connected component
+    after this thresholding. See `segment_objects` for the options.
+
+    :param segmentor_model: trained model for performing segmentation, e.g. from
+                            `get_jaw_segment_model`
+    :param cropped_ct_scan: 3D CT scan to perform inference on
+
+    :returns: a numpy array of model predictions
+    :raises: InferenceError if `largest_connected_component` is `True` but no threshold is provided
+    """
+    (prediction,) = segment_objects(
+        segmentor_model,
+        [cropped_ct_scan],
+        threshold=threshold,
+        largest_component=largest_component,
+        half_precision=half_precision,
+        quantise=quantise,
+        skip_threshold=skip_threshold,
+        whole_window=whole_window,
+    )
     return prediction
@@ -0,0 +1,512 @@
+"""
+Run inference on lots of scans, overlapping reading and writing with the model
+
+Inference on each scan has three steps: read it from disk (often over the network),
+run the models on it, and write the outputs. Doing these one after the other leaves
+the CPU/GPU idle while we wait for the disk. The `Pipeline` here runs them at the
+same time on different scans: a few threads read scans ahead of time, the calling
+thread (which owns the models) runs them, and a few more threads write the results.
+
+The queues between the stages are bounded, so if the model can't keep up the readers
+wait rather than filling up memory with scans.
+
+On the CPU one process can't keep all the cores busy, so `run_in_processes` forks
+several workers that each run the pipeline, pulling items from a shared queue.
+Anything set up before forking (e.g. models whose weights are in shared memory) is
+shared between them rather than copied.
+
+"""
+
+import time
+import queue
+import pickle
+import itertools
+import threading
+import traceback
+import multiprocessing
+from dataclasses import dataclass, field
+from typing import Any, Callable, Generic, Iterable, TypeVar
+
+import torch
+
+Item = TypeVar("Item")
+
+_DONE = object()
+"""Put on a queue when there's nothing more coming"""
+
+
+class _Stopped(Exception):
+    """The pipeline was stopped while we were waiting on a queue"""
+
+
+@dataclass
+class StageReport:
+    """How much work one stage of the pipeline did"""
+
+    name: str
+    n_threads: int
+
+    # Total time spent working (not waiting on the queues), over all threads
+    busy: float = 0.0
+    n_done: int = 0
+
+    def utilisation(self, wall_time: float) -> float:
+        """The fraction of the time that this stage's threads were working"""
+        return self.busy / (wall_time * self.n_threads) if wall_time else 0.0
+
+
+@dataclass
+class Failure:
+    """Something that went wrong with one item"""
+
+    item: Any
+    stage: str
+    error: Exception
+
+
+@dataclass
+class PipelineReport:
+    """What happened when running the pipeline"""
+
+    wall_time: float
+    stages: list[StageReport]
+    failures: list[Failure] = field(default_factory=list)
+
+    def summary(self) -> str:
+        """
+        A table of how busy each stage was
+
+        The slowest stage is the one that's busy nearly all the time; the others
+        spend some of their time waiting for it.
+
+        """
+        lines = [
+            f"{'Stage':<8} {'Threads':>7} {'Done':>6} {'Busy /s':>9} {'Utilisation':>12}"
+        ]
+        for stage in self.stages:
+            lines.append(
+                f"{stage.name:<8} {stage.n_threads:>7} {stage.n_done:>6}"
+                f" {stage.busy:>9.1f} {stage.utilisation(self.wall_time):>12.0%}"
+            )
+        lines.append(
+            f"{len(self.failures)} failed; took {self.wall_time:.1f}s in total"
+        )
+        return "\n".join(lines)
+
+
+class Pipeline(Generic[Item]):
+    """
+    Read, process and write lots of items at once
+
+    Errors of the types in `item_errors` are recorded as failures for that item and
+    the pipeline carries on; anything else stops everything and is re-raised from
+    `run`.
+
+    :param read: read an item, e.g. load a scan from its path. Runs in the reader
+                 threads
+    :param compute: process an item and what was read; runs in the thread that
+                    calls `run`
+    :param write: write the result of `compute`. Runs in the writer threads
+    :param n_readers: how many items to read at once
+    :param n_writers: how many results to write at once
+    :param queue_size: how many read items (and results) can wait between stages
+    :param item_errors: errors that only affect one item
+    :param batch_size: if given, `compute` is called with lists of up to this many
+                       items and what was read for each, and should return a list
+                       of results. A result can be one of the `item_errors`, to fail
+                       just that item. Batches are only smaller at the end.
+
+    """
+
+    def __init__(
+        self,
+        read: Callable[[Item], Any],
+        compute: Callable[[Item, Any], Any],
+        write: Callable[[Item, Any], None],
+        *,
+        n_readers: int = 2,
+        n_writers: int = 2,
+        queue_size: int = 2,
+        item_errors: tuple[type[Exception], ...] = (),
+        batch_size: int | None = None,
+    ):
+        if min(n_readers, n_writers, queue_size) < 1:
+            raise ValueError("Need at least one reader, writer and queue slot")
+        if batch_size is not None and batch_size < 1:
+            raise ValueError(f"Batch size must be at least 1, got {batch_size}")
+
+        self.read = read
+        self.compute = compute
+        self.write = write
+        self.n_readers = n_readers
+        self.n_writers = n_writers
+        self.queue_size = queue_size
+        self.item_errors = item_errors
+        self.batch_size = batch_size
+
+    def run(self, items: Iterable[Item]) -> PipelineReport:
+        """
+        Run every item through the pipeline
+
+        :param items: the items, e.g. paths to scans
+        :returns: how busy each stage was and which items failed
+        :raises: the first unexpected error from any stage
+
+        """
+        return _Run(self, items).run()
+
+
+class _Run:
+    """
+    The state of one run through a pipeline
+
+    """
+
+    def __init__(self, pipeline: Pipeline, items: Iterable):
+        self.pipeline = pipeline
+
+        self._items = iter(items)
+        self._items_lock = threading.Lock()
+
+        self._read_queue = queue.Queue(pipeline.queue_size)
+        self._write_queue = queue.Queue(pipeline.queue_size)
+
+        self._stop = threading.Event()
+        self._error: BaseException | None = None
+        self._lock = threading.Lock()
+
+        self._readers_left = pipeline.n_readers
+        self._read_done = False
+        self.stages = {
+            "read": StageReport("read", pipeline.n_readers),
+            "compute": StageReport("compute", 1),
+            "write": StageReport("write", pipeline.n_writers),
+        }
+        self.failures: list[Failure] = []
+
+    def _put(self, q: queue.Queue, value: Any) -> None:
+        """
+        Put something on a queue, giving up if the pipeline is stopped
+
+        """
+        while not self._stop.is_set():
+            try:
+                q.put(value, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise _Stopped
+
+    def _get(self, q: queue.Queue) -> Any:
+        """
+        Get something from a queue, giving up if the pipeline is stopped
+
+        """
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        raise _Stopped
+
+    def _next_item(self) -> Any:
+        with self._items_lock:
+            return next(self._items, _DONE)
+
+    def _do(self, stage: str, item: Any, fcn: Callable, *args: Any) -> Any:
+        """
+        Run one stage on an item, keeping track of the time and any failures
+
+        :returns: the result, or _DONE if it failed
+
+        """
+        start = time.perf_counter()
+        try:
+            return fcn(item, *args)
+        except self.pipeline.item_errors as e:
+            with self._lock:
+                self.failures.append(Failure(item, stage, e))
+            return _DONE
+        finally:
+            with self._lock:
+                self.stages[stage].busy += time.perf_counter() - start
+                self.stages[stage].n_done += 1
+
+    def _do_batch(self, items: list, data: list) -> list:
+        """
+        Run the compute stage on a batch of items, keeping track of the time and any
+        failures
+
+        :returns: the results, with _DONE for any that failed
+
+        """
+        start = time.perf_counter()
+        try:
+            results = self.pipeline.compute(items, data)
+        except self.pipeline.item_errors as e:
+            results = [e] * len(items)
+        finally:
+            with self._lock:
+                self.stages["compute"].busy += time.perf_counter() - start
+                self.stages["compute"].n_done += len(items)
+
+        retval = []
+        for item, result in zip(items, results, strict=True):
+            if isinstance(result, self.pipeline.item_errors):
+                with self._lock:
+                    self.failures.append(Failure(item, "compute", result))
+                result = _DONE
+            retval.append(result)
+        return retval
+
+    def _abort(self, error: BaseException) -> None:
+        """
+        Stop everything, remembering the first error
+
+        """
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._stop.set()
+
+    def _reader(self) -> None:
+        try:
+            while (item := self._next_item()) is not _DONE:
+                data = self._do("read", item, self.pipeline.read)
+                if data is not _DONE:
+                    self._put(self._read_queue, (item, data))
+
+            # The last reader to finish tells the compute stage
+            with self._lock:
+                self._readers_left -= 1
+                last = self._readers_left == 0
+            if last:
+                self._put(self._read_queue, _DONE)
+        except _Stopped:
+            pass
+        except BaseException as e:  # pylint: disable=broad-exception-caught
+            self._abort(e)
+
+    def _writer(self) -> None:
+        try:
+            while (entry := self._get(self._write_queue)) is not _DONE:
+                item, result = entry
+                self._do("write", item, self.pipeline.write, result)
+        except _Stopped:
+            pass
+        except BaseException as e:  # pylint: disable=broad-exception-caught
+            self._abort(e)
+
+    def _next_batch(self) -> list[tuple[Any, Any]]:
+        """
+        Get up to a batch of read items (one if we're not batching); empty once
+        there's nothing left
+
+        """
+        batch = []
+        while len(batch) < (self.pipeline.batch_size or 1) and not self._read_done:
+            entry = self._get(self._read_queue)
+            if entry is _DONE:
+                self._read_done = True
+            else:
+                batch.append(entry)
+        return batch
+
+    def _computer(self) -> None:
+        try:
+            while batch := self._next_batch():
+                if self.pipeline.batch_size is None:
+                    ((item, data),) = batch
+                    done = [
+                        (item, self._do("compute", item, self.pipeline.compute, data))
+                    ]
+                else:
+                    items = [item for item, _ in batch]
+                    done = zip(
+                        items, self._do_batch(items, [data for _, data in batch])
+                    )
+
+                for item, result in done:
+                    if result is not _DONE:
+                        self._put(self._write_queue, (item, result))
+
+            for _ in range(self.pipeline.n_writers):
+                self._put(self._write_queue, _DONE)
+        except _Stopped:
+            pass
+        except BaseException as e:  # pylint: disable=broad-exception-caught
+            self._abort(e)
+
+    def run(self) -> PipelineReport:
+        start = time.perf_counter()
+
+        threads = [
+            threading.Thread(target=self._reader, name=f"read-{i}")
+            for i in range(self.pipeline.n_readers)
+        ] + [
+            threading.Thread(target=self._writer, name=f"write-{i}")
+            for i in range(self.pipeline.n_writers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        # The models live in this thread
+        self._computer()
+        for thread in threads:
+            thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+        return PipelineReport(
+            time.perf_counter() - start, list(self.stages.values()), self.failures
+        )
+
+
+class WorkerError(RuntimeError):
+    """A worker process died, or hit an unexpected error"""
+
+
+def _picklable(error: Exception) -> Exception:
+    """
+    The error, or a RuntimeError with the same message if it can't be sent between
+    processes
+
+    """
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:  # pylint: disable=broad-exception-caught
+        return RuntimeError(f"{type(error).__name__}: {error}")
+
+
+def _worker(
+    pipeline: Pipeline,
+    items: multiprocessing.Queue,
+    results: multiprocessing.Queue,
+    n_threads: int,
+) -> None:
+    """
+    Run the pipeline on items from the shared queue until we get a None; runs in
+    each worker process
+
+    """
+    torch.set_num_threads(n_threads)
+    try:
+        report = pipeline.run(iter(items.get, None))
+        for failure in report.failures:
+            failure.error = _picklable(failure.error)
+        results.put(report)
+    except BaseException:  # pylint: disable=broad-exception-caught
+        results.put(traceback.format_exc())
+
+
+def _combine(reports: list[PipelineReport], wall_time: float) -> PipelineReport:
+    """
+    Add up the reports from each worker, as if it was one pipeline with all their
+    threads
+
+    """
+    stages = {}
+    for report in reports:
+        for stage in report.stages:
+            total = stages.setdefault(stage.name, StageReport(stage.name, 0))
+            total.n_threads += stage.n_threads
+            total.busy += stage.busy
+            total.n_done += stage.n_done
+
+    return PipelineReport(
+        wall_time,
+        list(stages.values()),
+        [failure for report in reports for failure in report.failures],
+    )
+
+
+def run_in_processes(
+    pipeline: Pipeline,
+    items: Iterable,
+    *,
+    n_workers: int,
+    threads_per_worker: int,
+) -> PipelineReport:
+    """
+    Run the pipeline in several forked processes at once, each taking items from a
+    shared queue as it's ready for them
+
+    The workers are forked, so they see everything that exists when this is called
+    without it being pickled - e.g. models with their weights in shared memory
+    (`torch.nn.Module.share_memory`), which then aren't copied for each worker.
+    Items and the workers' reports are pickled, so they should be small.
+
+    Don't use this with CUDA; forked processes can't use it.
+
+    :param pipeline: the pipeline to run in each worker
+    :param items: the items, e.g. paths to scans
+    :param n_workers: how many processes to run
+    :param threads_per_worker: how many intra-op threads each worker's torch should
+                               use. The workers should share the cores between them
+    :returns: the workers' reports added up. The compute stage has one thread per
+              worker
+    :raises WorkerError: if a worker dies or hits an unexpected error
+
+    """
+    if n_workers < 1 or threads_per_worker < 1:
+        raise ValueError("Need at least one worker and one thread per worker")
+
+    start = time.perf_counter()
+    context = multiprocessing.get_context("fork")
+
+    # Items are only taken from `items` as the workers are ready for them, in case
+    # getting one does something (e.g. claims it from a `WorkQueue`)
+    work, results = context.Queue(maxsize=n_workers), context.Queue()
+    stop = threading.Event()
+
+    def feed() -> None:
+        for item in itertools.chain(items, [None] * n_workers):
+            while True:
+                if stop.is_set():
+                    return
+                try:
+                    work.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    workers = [
+        context.Process(
+            target=_worker,
+            args=(pipeline, work, results, threads_per_worker),
+            name=f"inference-{i}",
+        )
+        for i in range(n_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    feeder = threading.Thread(target=feed, name="feed")
+    feeder.start()
+
+    reports = []
+    try:
+        while len(reports) < n_workers:
+            try:
+                result = results.get(timeout=1.0)
+            except queue.Empty:
+                # A worker that was killed (e.g. out of memory) never sends anything
+                if any(w.exitcode not in (None, 0) for w in workers):
+                    raise WorkerError(  # pylint: disable=raise-missing-from
+                        f"A worker died: exit codes {[w.exitcode for w in workers]}"
+                    )
+                continue
+
+            if isinstance(result, str):
+                raise WorkerError(f"Error in a worker:\n{result}")
+            reports.append(result)
+    finally:
+        stop.set()
+        feeder.join()
+        for worker in workers:
+            if len(reports) < n_workers:
+                worker.terminate()
+            worker.join()
+
+    return _combine(reports, time.perf_counter() - start)
@@ -0,0 +1,216 @@
+"""
+Execution profiles: how PyTorch should run the models on this machine
+
+A profile sets how many threads PyTorch uses, whether the networks (and their
+inputs) are stored channels-last, whether to run in bfloat16 mixed precision on
+the CPU, and whether to pick deterministic or fast algorithms. Which of these is
+fastest depends a lot on the CPU, so `scripts/benchmarks/execution_profiles.py`
+tries them all and saves the fastest one (see `save`); inference then uses the
+saved profile unless told otherwise.
+
+"""
+
+import json
+import warnings
+import dataclasses
+from dataclasses import dataclass
+from typing import Any
+
+import torch
+
+from ..util import files
+from .backends import CpuModule
+
+
+@dataclass(frozen=True)
+class ExecutionProfile:
+    """
+    How to run the models
+
+    Anything left as None isn't changed from PyTorch's defaults.
+
+    """
+
+    name: str
+
+    # Threads used within an operation (e.g. one convolution), and for running
+    # independent operations at the same time
+    intra_op_threads: int | None = None
+    inter_op_threads: int | None = None
+
+    # Store the networks' weights and inputs as channels-last (NDHWC), which the
+    # oneDNN convolutions on the CPU are often faster with
+    channels_last: bool = False
+
+    # Run the networks in bfloat16 mixed precision. Only worth it on CPUs with
+    # bfloat16 instructions (e.g. AVX512-BF16 or AMX); slower elsewhere
+    bf16: bool = False
+
+    # True to only use deterministic algorithms, False to let PyTorch pick the
+    # fastest (e.g. cuDNN benchmarking)
+    deterministic: bool | None = None
+
+    def autocast(self, device: str | torch.device) -> torch.autocast:
+        """
+        Mixed precision context for running a network with this profile
+
+        :param device: the device the network is on
+        :returns: a context manager; does nothing unless `bf16` is set
+
+        """
+        return torch.autocast(
+            torch.device(device).type, dtype=torch.bfloat16, enabled=self.bf16
+        )
+
+
+PROFILES = {
+    profile.name: profile
+    for profile in (
+        ExecutionProfile("default"),
+        ExecutionProfile("deterministic", deterministic=True),
+        ExecutionProfile("fast", deterministic=False),
+        ExecutionProfile("channels_last", channels_last=True, deterministic=False),
+        ExecutionProfile("bf16", bf16=True, deterministic=False),
+        ExecutionProfile(
+            "channels_last_bf16", channels_last=True, bf16=True, deterministic=False
+        ),
+    )
+}
+"""The built-in profiles"""
+
+SAVED = "saved"
+"""Ask `get` for the profile saved by the benchmark"""
+
+
+def save(profile: ExecutionProfile, **details: Any) -> None:
+    """
+    Save a profile as the one to use on this machine
+
+    :param profile: the profile
+    :param details: anything else to record alongside it, e.g. the timings
+
+    """
+    files.execution_profile_path().write_text(
+        json.dumps({"profile": dataclasses.asdict(profile), **details}, indent=2)
+    )
+
+
+def saved() -> ExecutionProfile | None:
+    """
+    The profile saved by the benchmark, or None if it hasn't been run
+
+    """
+    path = files.execution_profile_path()
+    if not path.is_file():
+        return None
+    return ExecutionProfile(**json.loads(path.read_text())["profile"])
+
+
+def get(name: str | None = None) -> ExecutionProfile:
+    """
+    Get a profile by name
+
+    :param name: one of `PROFILES`, or `SAVED` for the one saved by the benchmark.
+                 None to use the saved profile if there is one, and the default
+                 otherwise
+    :returns: the profile
+
+    :raises ValueError: if there's no profile with this name
+    :raises FileNotFoundError: if asking for the saved profile and there isn't one
+
+    """
+    if name is None:
+        return saved() or PROFILES["default"]
+
+    if name == SAVED:
+        if (profile := saved()) is None:
+            raise FileNotFoundError(
+                f"No saved profile at {files.execution_profile_path()}; run"
+                " scripts/benchmarks/execution_profiles.py"
+            )
+        return profile
+
+    if name not in PROFILES:
+        raise ValueError(
+            f"Unknown execution profile {name}; must be one of {[*PROFILES, SAVED]}"
+        )
+    return PROFILES[name]
+
+
+def apply(profile: ExecutionProfile) -> None:
+    """
+    Set PyTorch's threading and algorithm selection for this process
+
+    The number of inter-op threads can only be set before PyTorch has run anything
+    in parallel; if it's too late, this warns and leaves it as it is.
+
+    """
+    if profile.intra_op_threads is not None:
+        torch.set_num_threads(profile.intra_op_threads)
+
+    if (
+        profile.inter_op_threads is not None
+        and torch.get_num_interop_threads() != profile.inter_op_threads
+    ):
+        try:
+            torch.set_num_interop_threads(profile.inter_op_threads)
+        except RuntimeError as e:
+            warnings.warn(f"Can't set the number of inter-op threads: {e}")
+
+    if profile.deterministic is not None:
+        torch.use_deterministic_algorithms(profile.deterministic, warn_only=True)
+        torch.backends.cudnn.deterministic = profile.deterministic
+        torch.backends.cudnn.benchmark = not profile.deterministic
+
+
+class ProfiledModule(torch.nn.Module):
+    """
+    A PyTorch network that runs its inputs channels-last and/or in mixed precision,
+    as set by a profile. Always returns float32.
+
+    :param net: the network, in channels-last already if the profile wants it
+    :param profile: the profile
+
+    """
+
+    def __init__(self, net: torch.nn.Module, profile: ExecutionProfile):
+        super().__init__()
+        self.net = net
+        self.profile = profile
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.profile.channels_last and x.dim() == 5:
+            x = x.contiguous(memory_format=torch.channels_last_3d)
+        with self.profile.autocast(x.device):
+            return self.net(x).float()
+
+
+def wrap(net: torch.nn.Module, profile: ExecutionProfile) -> torch.nn.Module:
+    """
+    Get a network ready to run with a profile
+
+    Only affects PyTorch networks - the other backends (see `backends`) pick their
+    own layouts and precision, though they still use the profile's threads.
+
+    :param net: the network. Converted to channels-last in place if the profile
+                wants it
+    :param profile: the profile
+
+    :returns: something that can be called like the network; the network itself if
+              the profile doesn't change how it's run
+
+    """
+    if isinstance(net, CpuModule) or not (profile.channels_last or profile.bf16):
+        return net
+
+    if profile.channels_last:
+        net.to(memory_format=torch.channels_last_3d)
+    return ProfiledModule(net, profile)
+
+
+def fingerprint(profile: ExecutionProfile) -> dict[str, bool]:
+    """
+    The parts of a profile that change the models' outputs, for cache keys
+
+    """
+    return {"bf16": profile.bf16}
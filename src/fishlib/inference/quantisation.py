@@ -0,0 +1,178 @@
+"""
+Quantise the segmentation model to INT8, for faster inference on the CPU
+
+This uses post-training static quantisation: the weights are stored as 8-bit
+integers, and so are the activations between layers. Working out what range of
+values each activation takes needs some real data, so the model is first run on a
+few windows (calibration) with observers recording the ranges, then converted.
+
+The network is traced with `torch.fx`, so the MONAI code doesn't need changing.
+Only the convolutions are quantised - they're where nearly all the time goes. With
+PyTorch's default settings the PReLUs, instance norms and attention gates are
+quantised too, which makes the output much worse (on the smoke-test model the logits
+only correlated at ~0.5 with the float model's, vs >0.99 quantising just the
+convolutions) for little extra speed. The transposed convolutions are left in float,
+since PyTorch can't quantise them per-channel.
+
+Dynamic quantisation (where only the weights are quantised ahead of time) isn't
+an option: PyTorch only supports it for linear and recurrent layers, and the U-Net
+is all convolutions.
+
+The quantised model is saved next to the float one as:
+    <name>.int8.pt      the calibrated model - the float weights plus the ranges
+                        recorded by the observers
+    <name>.int8.json    the settings needed to rebuild it, and the model config
+Some quantised layers don't put everything they need in their state dict, so
+rather than saving the converted model we save the calibrated one and convert it
+again when it's loaded (which only takes a second or two, and always gives the same
+model).
+
+"""
+
+import copy
+import json
+import pathlib
+from dataclasses import dataclass
+from typing import Any
+
+import torch
+from torch.ao.quantization import QConfigMapping, get_default_qconfig
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from ..model.model import model as build_model
+
+WEIGHTS_SUFFIX = ".int8.pt"
+SETTINGS_SUFFIX = ".int8.json"
+
+
+@dataclass(frozen=True)
+class QuantisedPaths:
+    """Where the files making up a quantised model live"""
+
+    weights: pathlib.Path
+    settings: pathlib.Path
+
+    def exists(self) -> bool:
+        """Whether the model has been quantised"""
+        return self.weights.is_file() and self.settings.is_file()
+
+
+def paths(model_path: pathlib.Path) -> QuantisedPaths:
+    """
+    The quantised model's files
+
+    :param model_path: path to the float model's pickle, e.g. from `files.model_path`
+
+    """
+    model_path = pathlib.Path(model_path)
+    stem = model_path.name.removesuffix(".pkl")
+    return QuantisedPaths(
+        weights=model_path.with_name(stem + WEIGHTS_SUFFIX),
+        settings=model_path.with_name(stem + SETTINGS_SUFFIX),
+    )
+
+
+def prepare(
+    net: torch.nn.Module, input_shape: tuple[int, ...], *, engine: str = "x86"
+) -> torch.fx.GraphModule:
+    """
+    Add observers to a network, ready for calibration
+
+    Run the returned network on some typical inputs (e.g. with `model.predict`),
+    then pass it to `convert`.
+
+    :param net: the float network. Not changed
+    :param input_shape: the shape of one input (channels, z, y, x), for tracing
+    :param engine: the quantised backend to target: "x86" (or "fbgemm") for Intel/AMD,
+                   "qnnpack" for ARM
+
+    :returns: the network with observers
+    :raises ValueError: if PyTorch doesn't support the engine on this machine
+
+    """
+    if engine not in torch.backends.quantized.supported_engines:
+        raise ValueError(
+            f"Quantisation engine {engine} not supported here; must be one of"
+            f" {torch.backends.quantized.supported_engines}"
+        )
+    torch.backends.quantized.engine = engine
+
+    # Everything else runs in float, with the activations converted at the edges
+    qconfig_mapping = QConfigMapping().set_object_type(
+        torch.nn.Conv3d, get_default_qconfig(engine)
+    )
+
+    # `prepare_fx` changes the network in place
+    return prepare_fx(
+        copy.deepcopy(net).eval().cpu().float(),
+        qconfig_mapping,
+        (torch.rand(1, *input_shape),),
+    )
+
+
+def convert(prepared: torch.fx.GraphModule) -> torch.fx.GraphModule:
+    """
+    Turn a calibrated network into a quantised one
+
+    :param prepared: from `prepare`, after running it on the calibration data.
+                     Not changed
+    :returns: the quantised network
+
+    """
+    return convert_fx(copy.deepcopy(prepared))
+
+
+def save(
+    model_path: pathlib.Path,
+    prepared: torch.fx.GraphModule,
+    config: dict[str, Any],
+    *,
+    input_shape: tuple[int, ...],
+    engine: str,
+) -> QuantisedPaths:
+    """
+    Save a calibrated network next to the float model
+
+    :param model_path: path to the float model's pickle
+    :param prepared: from `prepare`, after calibration
+    :param config: the config the float model was trained with
+    :param input_shape: the shape passed to `prepare`
+    :param engine: the engine passed to `prepare`
+
+    :returns: the paths that were written
+
+    """
+    quantised = paths(model_path)
+    torch.save(prepared.state_dict(), quantised.weights)
+    quantised.settings.write_text(
+        json.dumps(
+            {"engine": engine, "input_shape": list(input_shape), "config": config},
+            indent=2,
+        )
+    )
+    return quantised
+
+
+def load(model_path: pathlib.Path) -> torch.fx.GraphModule:
+    """
+    Load a quantised model
+
+    :param model_path: path to the float model's pickle; the quantised model is
+                       next to it
+    :returns: the quantised network, ready for inference on the CPU
+
+    :raises FileNotFoundError: if the model hasn't been quantised
+
+    """
+    quantised = paths(model_path)
+    settings = json.loads(quantised.settings.read_text())
+
+    prepared = prepare(
+        build_model(settings["config"]["model_params"]).eval(),
+        tuple(settings["input_shape"]),
+        engine=settings["engine"],
+    )
+    prepared.load_state_dict(
+        torch.load(quantised.weights, map_location="cpu", weights_only=True)
+    )
+    return convert_fx(prepared)
@@ -0,0 +1,323 @@
+"""
+Share a batch of inference between several machines that only have a filesystem in
+common
+
+Each machine runs the same inference script on the same list of scans, pointing at
+the same work queue directory. Before working on a scan it claims it by creating a
+lease file; creating a file that doesn't exist yet is atomic, so only one machine
+gets each scan. While it's working, a background thread keeps touching its leases
+(the heartbeat). When a scan is finished it's recorded in the manifest and the lease
+is removed.
+
+If a machine crashes its leases stop being touched, and once they're older than
+`lease_time` another machine takes them over and redoes the work. This means a scan
+might (rarely) be done twice, e.g. if a machine is so busy that it misses several
+heartbeats - but never not at all.
+
+The directory looks like:
+    leases/<key>.lease    one for each scan being worked on; holds who's doing it
+    manifest/<key>.json   one for each scan that's finished (or failed)
+
+Lease expiry compares the lease's modification time (set by the file server) with
+the time on this machine, so the clocks should roughly agree; keep `lease_time` well
+above any clock difference.
+
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import weakref
+import pathlib
+import threading
+from typing import Any, Callable, Generator, Iterable, TypeVar
+
+Item = TypeVar("Item")
+
+_QUEUES: "weakref.WeakSet[WorkQueue]" = weakref.WeakSet()
+"""Every work queue in this process, so we can fix their locks after a fork"""
+
+
+def _after_fork() -> None:
+    """
+    Give every work queue a new lock in a forked child: if we forked while a
+    heartbeat thread held one, the child would never be able to take it
+
+    """
+    for queue in _QUEUES:
+        queue._after_fork()  # pylint: disable=protected-access
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+class WorkQueue:
+    """
+    Claim items of work through lease files in a shared directory
+
+    Use it as a context manager, so that the leases get renewed in the background
+    and any we're still holding are given up at the end.
+
+    :param directory: the work queue directory, shared between all the machines.
+                      Created if it doesn't exist
+    :param lease_time: how long (in seconds) a lease lasts without being renewed
+                       before someone else can take it over
+    :param heartbeat: how often (in seconds) to renew our leases. Defaults to a
+                      fifth of `lease_time`
+
+    """
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        *,
+        lease_time: float = 300.0,
+        heartbeat: float | None = None,
+    ):
+        self.directory = pathlib.Path(directory)
+        self.lease_time = lease_time
+        self.heartbeat = heartbeat if heartbeat is not None else lease_time / 5
+        if not 0 < self.heartbeat < self.lease_time:
+            raise ValueError(
+                f"Heartbeat {self.heartbeat}s must be shorter than the lease"
+                f" ({self.lease_time}s)"
+            )
+
+        # Unique to this process, so we can tell our leases from everyone else's
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self._lease_dir = self.directory / "leases"
+        self._manifest_dir = self.directory / "manifest"
+        self._lease_dir.mkdir(parents=True, exist_ok=True)
+        self._manifest_dir.mkdir(parents=True, exist_ok=True)
+
+        self._held: set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+        _QUEUES.add(self)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def _lease_path(self, key: str) -> pathlib.Path:
+        if not key or "/" in key or key.startswith("."):
+            raise ValueError(f"Can't use {key!r} as a work queue key")
+        return self._lease_dir / f"{key}.lease"
+
+    def _record_path(self, key: str) -> pathlib.Path:
+        return self._manifest_dir / f"{key}.json"
+
+    def is_done(self, key: str) -> bool:
+        """Whether an item is in the manifest (finished or failed)"""
+        return self._record_path(key).exists()
+
+    def _is_ours(self, path: pathlib.Path) -> bool:
+        try:
+            return path.read_text() == self.owner
+        except FileNotFoundError:
+            return False
+
+    def _expired(self, path: pathlib.Path) -> bool:
+        try:
+            return time.time() - path.stat().st_mtime > self.lease_time
+        except FileNotFoundError:
+            return False
+
+    def _create(self, key: str) -> bool:
+        """
+        Create the lease file, if nobody else has one
+
+        """
+        try:
+            fd = os.open(self._lease_path(key), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(self.owner)
+        return True
+
+    def _reclaim(self, key: str) -> bool:
+        """
+        Take over an expired lease
+
+        Several machines might try at once, so we first rename the lease out of the
+        way (only one rename can succeed) and then create our own.
+
+        """
+        path = self._lease_path(key)
+        stale = path.with_name(f"{path.name}.{uuid.uuid4().hex}.stale")
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return False
+
+        if not self._expired(stale):
+            # Someone else took it over between us checking and renaming; give it
+            # back (unless yet another lease has appeared since)
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            stale.unlink()
+            return False
+
+        stale.unlink()
+        return self._create(key)
+
+    def claim(self, key: str) -> bool:
+        """
+        Try to claim an item
+
+        :param key: identifies the item, e.g. the scan's file name. Must be a valid
+                    file name
+        :returns: whether we got it. We don't if it's already done, or someone else
+                  has a lease on it that hasn't expired
+
+        """
+        if self.is_done(key):
+            return False
+        path = self._lease_path(key)
+        if not (self._create(key) or (self._expired(path) and self._reclaim(key))):
+            return False
+
+        # It might have been finished just before we made our lease
+        if self.is_done(key):
+            path.unlink(missing_ok=True)
+            return False
+
+        with self._lock:
+            self._held.add(key)
+        return True
+
+    def claim_all(
+        self, items: Iterable[Item], key: Callable[[Item], str] = str
+    ) -> Generator[Item, None, None]:
+        """
+        Claim items one at a time, yielding the ones we get
+
+        Items leased by someone else are tried again until they're done, so if
+        another machine crashes we'll pick up its work once its leases expire. This
+        means the generator only finishes once every item is in the manifest, or
+        held by us.
+
+        :param items: the items, e.g. paths to scans
+        :param key: gets the key for each item
+        :returns: the items we've claimed. Call `complete` or `fail` for each one
+
+        """
+        remaining = list(items)
+        while remaining:
+            waiting = []
+            for item in remaining:
+                item_key = key(item)
+                if self.claim(item_key):
+                    yield item
+                elif not self.is_done(item_key) and item_key not in self._held:
+                    waiting.append(item)
+
+            remaining = waiting
+            if remaining:
+                time.sleep(self.heartbeat)
+
+    def release(self, key: str) -> None:
+        """
+        Give up our lease on an item without finishing it, so someone else can do it
+
+        """
+        with self._lock:
+            self._held.discard(key)
+        path = self._lease_path(key)
+        if self._is_ours(path):
+            path.unlink(missing_ok=True)
+
+    def _record(self, key: str, record: dict[str, Any]) -> None:
+        """
+        Write an item's manifest entry and give up the lease
+
+        The entry is written to a temporary file then renamed, so it's never seen
+        half-written.
+
+        """
+        record = {"key": key, "owner": self.owner, "time": time.time(), **record}
+
+        path = self._record_path(key)
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        tmp_path.write_text(json.dumps(record))
+        os.replace(tmp_path, path)
+
+        self.release(key)
+
+    def complete(self, key: str, **details: Any) -> None:
+        """
+        Record that an item is finished
+
+        :param key: the item
+        :param details: anything else to put in the manifest, e.g. the output paths.
+                        Must be JSON serialisable
+
+        """
+        self._record(key, {"status": "done", **details})
+
+    def fail(self, key: str, reason: str) -> None:
+        """
+        Record that an item failed, so nobody tries it again. Delete its manifest
+        entry to retry it.
+
+        """
+        self._record(key, {"status": "failed", "reason": reason})
+
+    def manifest(self) -> dict[str, dict[str, Any]]:
+        """
+        Everything that's been finished or has failed, by key
+
+        """
+        return {
+            path.name.removesuffix(".json"): json.loads(path.read_text())
+            for path in self._manifest_dir.glob("*.json")
+        }
+
+    def _renew(self) -> None:
+        """
+        Touch all our leases, forgetting any that aren't ours any more
+
+        """
+        with self._lock:
+            held = list(self._held)
+
+        for key in held:
+            path = self._lease_path(key)
+            try:
+                if not self._is_ours(path):
+                    raise FileNotFoundError
+                os.utime(path)
+            except FileNotFoundError:
+                # Finished (e.g. by a worker process we forked), or taken over
+                with self._lock:
+                    self._held.discard(key)
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(self.heartbeat):
+            self._renew()
+
+    def __enter__(self) -> "WorkQueue":
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._heartbeat, name="heartbeat", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        with self._lock:
+            held = list(self._held)
+        for key in held:
+            self.release(key)
@@ -0,0 +1,151 @@
+"""
+Activation (gradient) checkpointing for the attention U-Net
+
+During training, every layer's output is normally kept in memory until the backward
+pass. For a 3D U-Net on big patches this is most of the memory we use. With
+checkpointing, a block only keeps its input and re-runs its forward pass during the
+backward pass to get everything else back - so we use less memory, but each training
+step takes longer.
+
+Blocks are wrapped in place (by replacing their `forward`), so the parameter names
+and state dicts are the same as for a model without checkpointing. It's only worth
+doing for training; `model.model` only turns it on when asked for a model to train.
+
+"""
+
+import types
+import functools
+import contextlib
+from typing import Any, Callable, Generator, Iterable
+
+import torch
+from torch.utils.checkpoint import checkpoint
+from monai.networks.nets import AttentionUnet
+from monai.networks.nets.attentionunet import AttentionLayer
+
+
+@contextlib.contextmanager
+def _frozen_norm_stats(module: torch.nn.Module) -> Generator[None, None, None]:
+    """
+    Stop batch norm layers from updating their running statistics, so that re-running
+    the forward pass doesn't count the batch twice
+
+    """
+    norms = [
+        m
+        for m in module.modules()
+        if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)
+    ]
+    saved = [
+        (
+            m.momentum,
+            None if m.num_batches_tracked is None else m.num_batches_tracked.clone(),
+        )
+        for m in norms
+    ]
+
+    for norm in norms:
+        norm.momentum = 0.0
+    try:
+        yield
+    finally:
+        for norm, (momentum, num_batches_tracked) in zip(norms, saved):
+            norm.momentum = momentum
+            if num_batches_tracked is not None:
+                norm.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def _checkpointed_forward(self: torch.nn.Module, *args: Any, **kwargs: Any) -> Any:
+    """
+    The forward pass of a block, checkpointed when training
+
+    Bound to the block as a method (rather than a closure over it), so that copying
+    the block - e.g. with `copy.deepcopy`, or when `torch.fx` traces it - gives a
+    block that runs its own layers.
+
+    """
+    forward = functools.partial(type(self).forward, self)
+
+    # There's nothing to save memory on if we're not going to do a backward pass
+    if not (self.training and torch.is_grad_enabled()):
+        return forward(*args, **kwargs)
+
+    return checkpoint(
+        forward,
+        *args,
+        use_reentrant=False,
+        context_fn=lambda: (contextlib.nullcontext(), _frozen_norm_stats(self)),
+        **kwargs,
+    )
+
+
+def _checkpoint_forward(module: torch.nn.Module) -> None:
+    """
+    Make a module checkpoint its forward pass when training
+
+    """
+    module.forward = types.MethodType(_checkpointed_forward, module)
+
+
+def _blocks(net: AttentionUnet) -> list[tuple[int, torch.nn.Module]]:
+    """
+    The blocks of the network that we can checkpoint, and which level (resolution)
+    of the U-Net they're at - 0 is the full resolution, each level down is halved.
+
+    Walks the nested `AttentionLayer`s: each one has an encoder block (taking us down
+    a level), the rest of the network below it, and then the decoder blocks (upsampling,
+    attention and merging) at its own level.
+
+    """
+    head, encdec, _ = net.model
+    blocks = [(0, head)]
+
+    layer, level = encdec, 0
+    while isinstance(layer, AttentionLayer):
+        blocks.extend(
+            [(level, layer.upconv), (level, layer.attention), (level, layer.merge)]
+        )
+
+        if isinstance(layer.submodule, torch.nn.Sequential):
+            encoder, layer = layer.submodule
+        else:
+            # The bottom of the U
+            encoder, layer = layer.submodule, None
+
+        blocks.append((level + 1, encoder))
+        level += 1
+
+    return blocks
+
+
+def checkpoint_attention_unet(
+    net: torch.nn.Module, levels: bool | Iterable[int] = True
+) -> torch.nn.Module:
+    """
+    Turn on activation checkpointing for the encoder and decoder blocks of an
+    attention U-Net
+
+    The most memory is used at the top levels (full resolution), so checkpointing
+    only those gets most of the memory saving for less of the extra compute.
+
+    :param net: the model. Modified in place
+    :param levels: which levels to checkpoint (0 is the full resolution), or True
+                   for all of them
+
+    :returns: the model
+    :raises TypeError: if the model isn't an AttentionUnet
+
+    """
+    if not isinstance(net, AttentionUnet):
+        raise TypeError(
+            f"Activation checkpointing is only supported for AttentionUnet, not {type(net)}"
+        )
+
+    include: Callable[[int], bool] = (
+        (lambda _: True) if levels is True else set(levels).__contains__
+    )
+    for level, block in _blocks(net):
+        if include(level):
+            _checkpoint_forward(block)
+
+    return net
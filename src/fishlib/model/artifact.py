@@ -0,0 +1,190 @@
+"""
+Save models as plain files that can be read without unpickling anything
+
+A trained model is pickled as a `ModelState`, which holds the weights, the optimiser
+state and the config all together - so to run inference we have to unpickle the Adam
+moment buffers (twice the size of the weights) that we never use, and unpickling
+runs arbitrary code.
+
+Alongside the pickle we can save the model as an artifact: three files next to it
+with the same stem:
+    <name>.weights.pt     the model weights; a flat dict of tensors, memory-mapped
+                          when it's read so only the bits we touch get loaded
+    <name>.config.json    the config the model was trained with
+    <name>.optimizer.pt   the optimiser state, if we want to keep it (optional)
+
+The weights are saved with `torch.save` and read with `weights_only=True`, so
+reading them can only ever make tensors.
+
+"""
+
+import os
+import json
+import uuid
+import pathlib
+from dataclasses import dataclass
+from typing import Any
+
+import torch
+
+WEIGHTS_SUFFIX = ".weights.pt"
+CONFIG_SUFFIX = ".config.json"
+OPTIMIZER_SUFFIX = ".optimizer.pt"
+
+
+@dataclass(frozen=True)
+class ArtifactPaths:
+    """Where the files making up a model artifact live"""
+
+    weights: pathlib.Path
+    config: pathlib.Path
+    optimizer: pathlib.Path
+
+    def exists(self) -> bool:
+        """Whether there's an artifact here; the optimiser state is optional"""
+        return self.weights.is_file() and self.config.is_file()
+
+
+def paths(model_path: pathlib.Path) -> ArtifactPaths:
+    """
+    The artifact files for a model
+
+    :param model_path: path to the model's pickle, e.g. from `files.model_path`.
+                       The pickle doesn't need to exist
+    :returns: the paths to the artifact's files, next to the pickle
+
+    """
+    model_path = pathlib.Path(model_path)
+    stem = model_path.name.removesuffix(".pkl")
+    return ArtifactPaths(
+        weights=model_path.with_name(stem + WEIGHTS_SUFFIX),
+        config=model_path.with_name(stem + CONFIG_SUFFIX),
+        optimizer=model_path.with_name(stem + OPTIMIZER_SUFFIX),
+    )
+
+
+def is_stale(model_path: pathlib.Path) -> bool:
+    """
+    Whether the pickle has been written since the artifact next to it was, e.g. by
+    retraining the model without saving a new artifact
+
+    :param model_path: path to the model's pickle
+    :returns: True if both exist and either of the artifact's files is older than
+              the pickle
+
+    """
+    model_path = pathlib.Path(model_path)
+    artifact = paths(model_path)
+    if not (artifact.exists() and model_path.is_file()):
+        return False
+
+    pickle_time = model_path.stat().st_mtime
+    return any(
+        path.stat().st_mtime < pickle_time
+        for path in (artifact.weights, artifact.config)
+    )
+
+
+def model_files(model_path: pathlib.Path) -> list[pathlib.Path]:
+    """
+    The files `model.load_model` reads for a model: the artifact's weights and config
+    if there is an up-to-date artifact, otherwise the pickle
+
+    """
+    artifact = paths(model_path)
+    if artifact.exists() and not is_stale(model_path):
+        return [artifact.weights, artifact.config]
+    return [pathlib.Path(model_path)]
+
+
+def _write(path: pathlib.Path, write) -> None:
+    """
+    Write to a temporary file and then rename it, so nobody reads half a file
+
+    """
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def save(
+    model_path: pathlib.Path,
+    model_state_dict: dict[str, torch.Tensor],
+    config: dict[str, Any],
+    optimizer_state_dict: dict[str, Any] | None = None,
+) -> ArtifactPaths:
+    """
+    Save a model as an artifact
+
+    The tensors are copied to the CPU first, so this works for a model that's still
+    on the GPU.
+
+    :param model_path: path to the model's pickle; the artifact goes next to it
+    :param model_state_dict: the model weights
+    :param config: the config used to train the model. Must be JSON serialisable
+    :param optimizer_state_dict: the optimiser state. Not saved if None
+
+    :returns: the paths to the files that were written
+
+    """
+    artifact = paths(model_path)
+    artifact.weights.parent.mkdir(parents=True, exist_ok=True)
+
+    # Check this before writing anything, so we don't leave weights without a config
+    config_json = json.dumps(config, indent=2)
+
+    weights = {
+        name: tensor.detach().cpu().contiguous()
+        for name, tensor in model_state_dict.items()
+    }
+    _write(artifact.weights, lambda path: torch.save(weights, path))
+    _write(artifact.config, lambda path: path.write_text(config_json))
+
+    if optimizer_state_dict is not None:
+        _write(artifact.optimizer, lambda path: torch.save(optimizer_state_dict, path))
+
+    return artifact
+
+
+def load_weights(model_path: pathlib.Path) -> dict[str, torch.Tensor]:
+    """
+    Read a model's weights, memory-mapped
+
+    The tensors are backed by the file, so pages are only read from disk when the
+    weights are used (e.g. copied into a model by `load_state_dict`).
+
+    :param model_path: path to the model's pickle; the artifact is next to it
+    :returns: the weights
+
+    :raises FileNotFoundError: if there's no weights file
+
+    """
+    return torch.load(
+        paths(model_path).weights, map_location="cpu", mmap=True, weights_only=True
+    )
+
+
+def load_config(model_path: pathlib.Path) -> dict[str, Any]:
+    """
+    Read the config a model was trained with
+
+    :raises FileNotFoundError: if there's no config file
+
+    """
+    return json.loads(paths(model_path).config.read_text())
+
+
+def load_optimizer(model_path: pathlib.Path) -> dict[str, Any] | None:
+    """
+    Read a model's optimiser state, if it was saved
+
+    :returns: the optimiser state dict, or None if it wasn't saved
+
+    """
+    path = paths(model_path).optimizer
+    if not path.is_file():
+        return None
+    return torch.load(path, map_location="cpu", weights_only=True)
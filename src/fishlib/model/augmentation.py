@@ -0,0 +1,332 @@
+"""
+Patch-first data augmentation
+
+The default training pipeline augments the whole cropped window and then takes a
+random patch from it, which means that the (expensive) interpolation in e.g.
+`torchio.RandomAffine` is done for lots of voxels that we immediately throw away.
+The transform here samples the patch location first and then only resamples the
+voxels that end up in the patch.
+
+"""
+
+import itertools
+from typing import Callable
+
+import torch
+import numpy as np
+import torchio as tio
+import SimpleITK as sitk
+from torchio.data.io import nib_to_sitk, get_sitk_metadata_from_ras_affine
+
+from .sampling import DENSITY_KEY
+
+
+def uniform_location(
+    subject: tio.Subject, patch_size: tuple[int, int, int]
+) -> tuple[int, int, int]:
+    """
+    Choose the start of a patch uniformly from all the valid locations in a subject,
+    in the same way as `tio.UniformSampler` does
+
+    :param subject: the subject to take the patch from
+    :param patch_size: the shape of the patch
+
+    :returns: the index of the first voxel in the patch
+    :raises ValueError: if the patch is bigger than the image
+
+    """
+    spatial_shape = subject.spatial_shape
+    if any(p > s for p, s in zip(patch_size, spatial_shape)):
+        raise ValueError(f"Patch {patch_size} larger than image {spatial_shape}")
+
+    return tuple(
+        int(torch.randint(s - p + 1, (1,)).item())
+        for s, p in zip(spatial_shape, patch_size)
+    )
+
+
+def _patch_affine(affine: np.ndarray, index: tuple[int, int, int]) -> np.ndarray:
+    """
+    The affine matrix of a patch starting at `index` in an image with the given affine
+
+    """
+    retval = affine.copy()
+    retval[:3, 3] = affine[:3, :3] @ np.asarray(index) + affine[:3, 3]
+    return retval
+
+
+def _geometry(
+    affine: np.ndarray, size: tuple[int, int, int], pixel_type: int
+) -> sitk.Image:
+    """
+    An empty SimpleITK image with the right size, spacing, origin and direction
+
+    """
+    origin, spacing, direction = get_sitk_metadata_from_ras_affine(affine)
+
+    retval = sitk.Image([int(x) for x in size], pixel_type)
+    retval.SetOrigin(origin)
+    retval.SetSpacing(spacing)
+    retval.SetDirection(direction)
+
+    return retval
+
+
+def _input_region(
+    transform: sitk.Transform,
+    reference: sitk.Image,
+    floating: sitk.Image,
+) -> tuple[tuple[int, int, int], tuple[int, int, int]]:
+    """
+    Find the region of the floating image that contributes to the resampled
+    reference image
+
+    The transform is affine, so the input region is the bounding box of the
+    transformed corners of the reference image. We add a voxel on each side
+    for the interpolation.
+
+    :returns: the (inclusive) start of the region
+    :returns: the (exclusive) end of the region
+
+    """
+    corners = itertools.product(*[(0, s - 1) for s in reference.GetSize()])
+    indices = np.array(
+        [
+            floating.TransformPhysicalPointToContinuousIndex(
+                transform.TransformPoint(
+                    reference.TransformContinuousIndexToPhysicalPoint(corner)
+                )
+            )
+            for corner in corners
+        ]
+    )
+
+    shape = floating.GetSize()
+    start = np.clip(np.floor(indices.min(axis=0)).astype(int) - 1, 0, shape)
+    end = np.clip(np.ceil(indices.max(axis=0)).astype(int) + 2, 0, shape)
+
+    # The region might be completely outside the image (e.g. if there's a big
+    # translation) - keep one voxel so that we still have something to resample
+    start = np.minimum(start, np.asarray(shape) - 1)
+    end = np.maximum(end, start + 1)
+
+    return tuple(int(x) for x in start), tuple(int(x) for x in end)
+
+
+def resample_patch(
+    affine: tio.Affine,
+    subject: tio.Subject,
+    index: tuple[int, int, int],
+    patch_size: tuple[int, int, int],
+) -> tio.Subject:
+    """
+    Apply an affine transform to a subject, but only evaluate it on one patch
+
+    This gives the same result as applying the transform to the whole subject and then
+    cropping out the patch (the transform is still centred on the whole image, and
+    the padding value is still found from the whole image), but the interpolation is
+    only done for the voxels inside the patch.
+
+    :param affine: the affine transform to apply
+    :param subject: the subject to transform. Modified in place
+    :param index: the start of the patch
+    :param patch_size: the size of the patch
+
+    :returns: the transformed patch, as a subject
+
+    """
+    for image in affine.get_images(subject):
+        # This is centred on the whole image, like it would be normally
+        transform = affine.get_affine_transform(image)
+
+        patch_affine = _patch_affine(image.affine, index)
+        reference = _geometry(patch_affine, patch_size, sitk.sitkFloat32)
+
+        # Only convert the bit of the image that we'll actually use
+        start, end = _input_region(
+            transform,
+            reference,
+            _geometry(image.affine, image.spatial_shape, sitk.sitkUInt8),
+        )
+        region = image.data[:, start[0] : end[0], start[1] : end[1], start[2] : end[2]]
+        region_affine = _patch_affine(image.affine, start)
+
+        transformed = []
+        for channel, tensor in zip(region, image.data):
+            floating = nib_to_sitk(channel[np.newaxis], region_affine, force_3d=True)
+            if image[tio.TYPE] != tio.INTENSITY:
+                interpolation = affine.label_interpolation
+                default_value = affine.default_pad_label
+            elif affine.default_pad_value in ("mean", "otsu"):
+                # These look at the borders of the image, so we need all of it
+                interpolation = affine.image_interpolation
+                default_value = affine.get_default_pad_value(
+                    tensor, nib_to_sitk(tensor[np.newaxis], image.affine, force_3d=True)
+                )
+            else:
+                interpolation = affine.image_interpolation
+                default_value = affine.get_default_pad_value(tensor, floating)
+
+            resampler = sitk.ResampleImageFilter()
+            resampler.SetInterpolator(affine.get_sitk_interpolator(interpolation))
+            resampler.SetReferenceImage(reference)
+            resampler.SetDefaultPixelValue(float(default_value))
+            resampler.SetOutputPixelType(sitk.sitkFloat32)
+            resampler.SetTransform(transform)
+
+            transformed.append(
+                torch.as_tensor(
+                    sitk.GetArrayFromImage(resampler.Execute(floating)).transpose()
+                )
+            )
+
+        image.set_data(torch.stack(transformed))
+        image.affine = patch_affine
+
+    return subject
+
+
+def _crop(
+    subject: tio.Subject,
+    index: tuple[int, int, int],
+    patch_size: tuple[int, int, int],
+) -> tio.Subject:
+    """
+    Crop a patch out of a subject
+
+    """
+    shape = subject.spatial_shape
+    bounds = []
+    for start, size, length in zip(index, patch_size, shape):
+        bounds.extend([start, length - start - size])
+
+    return tio.Crop(bounds)(subject)
+
+
+class PatchFirstAugmentation(tio.Transform):
+    """
+    Augment a random patch of a subject, instead of augmenting the whole subject
+    and then taking a patch from it.
+
+    Chooses the patch location first (uniformly, like `tio.UniformSampler`, unless
+    told otherwise), then applies the transforms in order. Flips are tracked so that
+    the patch still contains the same bit of the subject after flipping.
+    `tio.RandomAffine` is only evaluated for the voxels in the patch, and anything after
+    this is applied to the patch.
+
+    The output is a subject the size of the patch, so a sampler with the same patch size
+    will just return the whole thing.
+
+    :param transforms: the augmentations to apply, in order
+    :param patch_size: the size of the patch to take
+    :param locations: how to choose the start of the patch; called with the subject
+                      and the patch size. Uniform by default.
+    :raises ValueError: if a RandomFlip uses anatomical labels instead of axis indices
+
+    """
+
+    def __init__(
+        self,
+        transforms: list[tio.Transform],
+        patch_size: tuple[int, int, int],
+        locations: Callable[
+            [tio.Subject, tuple[int, int, int]], tuple[int, int, int]
+        ] = uniform_location,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.transforms = transforms
+        self.patch_size = tuple(patch_size)
+        self.locations = locations
+
+        for transform in transforms:
+            if isinstance(transform, tio.RandomFlip) and not all(
+                isinstance(axis, int) for axis in transform.axes
+            ):
+                raise ValueError(f"Flip axes must be indices, not {transform.axes}")
+
+    def _flip(
+        self,
+        transform: tio.RandomFlip,
+        subject: tio.Subject,
+        index: tuple[int, int, int],
+    ) -> tuple[tio.Subject, tuple[int, int, int]]:
+        """
+        Randomly flip the subject, moving the patch so it covers the same voxels
+
+        """
+        # We're bypassing the transform's __call__, so need to do this ourselves
+        if torch.rand(1).item() > transform.probability:
+            return subject, index
+
+        flip = transform.get_params(transform.flip_probability)
+        axes = [axis for axis in range(3) if flip[axis] and axis in transform.axes]
+        if not axes:
+            return subject, index
+
+        index = tuple(
+            length - size - start if axis in axes else start
+            for axis, (start, size, length) in enumerate(
+                zip(index, self.patch_size, subject.spatial_shape)
+            )
+        )
+        return tio.Flip(axes)(subject), index
+
+    def _affine(
+        self,
+        transform: tio.RandomAffine,
+        subject: tio.Subject,
+        index: tuple[int, int, int],
+    ) -> tio.Subject | None:
+        """
+        Randomly apply an affine transform to the patch
+
+        Returns None if the transform wasn't applied
+
+        """
+        if torch.rand(1).item() > transform.probability:
+            return None
+
+        scales, degrees, translation = transform.get_params(
+            transform.scales,
+            transform.degrees,
+            transform.translation,
+            transform.isotropic,
+        )
+        affine = tio.Affine(
+            scales=scales.tolist(),
+            degrees=degrees.tolist(),
+            translation=translation.tolist(),
+            center=transform.center,
+            default_pad_value=transform.default_pad_value,
+            default_pad_label=transform.default_pad_label,
+            image_interpolation=transform.image_interpolation,
+            label_interpolation=transform.label_interpolation,
+        )
+        return resample_patch(affine, subject, index, self.patch_size)
+
+    def apply_transform(self, subject: tio.Subject) -> tio.Subject:
+        index = self.locations(subject, self.patch_size)
+        cropped = False
+
+        for transform in self.transforms:
+            if isinstance(transform, tio.RandomFlip):
+                subject, index = self._flip(transform, subject, index)
+
+            elif isinstance(transform, tio.RandomAffine):
+                if (transformed := self._affine(transform, subject, index)) is None:
+                    continue
+
+                # Anything after this acts on the patch
+                subject, index, cropped = transformed, (0, 0, 0), True
+
+            else:
+                subject = transform(subject)
+
+        if not cropped:
+            subject = _crop(subject, index, self.patch_size)
+
+        # We don't need this any more, and don't want to collate it into batches
+        subject.pop(DENSITY_KEY, None)
+
+        return subject
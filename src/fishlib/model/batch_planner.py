@@ -0,0 +1,161 @@
+"""
+Choose a batch size that fits in memory
+
+Training with `batch_size` patches at once might not fit in memory (especially with
+big patches), and finding out halfway through a long training run is expensive.
+The planner here tries training steps with increasing numbers of patches
+(micro-batches) before training starts and measures the peak memory of each. We then
+use the biggest micro-batch that fits and accumulate the gradients over several of
+them, so that each optimiser step still sees `batch_size` patches.
+
+"""
+
+import os
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from typing import Any
+
+import torch
+
+from . import model
+
+
+@dataclass
+class BatchPlan:
+    """How to split each batch up"""
+
+    micro_batch_size: int
+    accumulation_steps: int
+
+    # Peak memory (bytes) measured for each micro-batch size we tried
+    peak_memory: dict[int, float] = field(default_factory=dict)
+
+    @property
+    def batch_size(self) -> int:
+        """The number of patches seen by each optimiser step"""
+        return self.micro_batch_size * self.accumulation_steps
+
+
+def memory_limit(device: str, fraction: float = 0.8) -> float:
+    """
+    How much memory we're allowed to use
+
+    :param device: "cuda" or "cpu"
+    :param fraction: how much of the total memory to allow, to leave some room for
+                     everything else (e.g. the training data)
+
+    :returns: the limit, in bytes
+
+    """
+    if torch.device(device).type == "cuda":
+        _, total = torch.cuda.mem_get_info(device)
+    else:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return fraction * total
+
+
+def _probe(
+    config: dict[str, Any], patch_size: tuple[int, int, int], batch_size: int
+) -> float:
+    """
+    Run a training step and find the peak memory used, in bytes.
+    Runs in a fresh process, so the peak isn't affected by anything else
+
+    """
+    device = config["device"]
+    net = model.model(config["model_params"], train=True).to(device).train()
+    optimiser = model.optimiser(config, net)
+    loss_fn = model.lossfn(config)
+
+    x = torch.rand(batch_size, config["model_params"]["in_channels"], *patch_size)
+    y = (torch.rand(batch_size, 1, *patch_size) > 0.5).to(torch.uint8)
+
+    with torch.autocast(device):
+        loss = loss_fn(net(x.to(device)), y.to(device))
+    loss.backward()
+    optimiser.step()
+
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+        return float(torch.cuda.max_memory_reserved())
+
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024.0
+
+
+def _measure(
+    config: dict[str, Any], patch_size: tuple[int, int, int], batch_size: int
+) -> float | None:
+    """
+    Measure the peak memory of a training step in a separate process
+
+    :returns: the peak memory in bytes, or None if it ran out of memory (or was
+              killed for using too much)
+
+    """
+    with ProcessPoolExecutor(
+        1, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        try:
+            return executor.submit(_probe, config, patch_size, batch_size).result()
+        except (torch.OutOfMemoryError, BrokenProcessPool):
+            return None
+
+
+def plan_batches(
+    config: dict[str, Any],
+    patch_size: tuple[int, int, int],
+    batch_size: int,
+    limit: float,
+) -> BatchPlan:
+    """
+    Find the biggest micro-batch that fits in memory, and how many of them make up
+    a batch
+
+    Micro-batch sizes are tried in powers of two, then the batch size. Once we've
+    measured two, we extrapolate (memory is roughly linear in the number of patches)
+    and don't try ones that we expect to go over the limit.
+    The micro-batch size is always a divisor of the batch size, so that accumulating
+    gradients over the micro-batches gives exactly the same batch size.
+
+    :param config: the configuration, e.g. from userconf.yml. The device, model
+                   parameters, optimiser and loss are used
+    :param patch_size: the size of each patch
+    :param batch_size: the number of patches we want for each optimiser step
+    :param limit: the most memory we're allowed to use, in bytes
+
+    :returns: the plan
+    :raises RuntimeError: if even a single patch doesn't fit
+
+    """
+    peak_memory = {}
+
+    sizes = [2**i for i in range(batch_size.bit_length()) if 2**i < batch_size]
+    for size in sizes + [batch_size]:
+        # Don't try anything we expect to go over the limit, in case it brings the
+        # whole machine down
+        if len(peak_memory) >= 2:
+            (small, small_peak), (big, big_peak) = sorted(peak_memory.items())[-2:]
+            per_patch = (big_peak - small_peak) / (big - small)
+            if big_peak + per_patch * (size - big) > limit:
+                break
+
+        peak = _measure(config, patch_size, size)
+        if peak is None or peak > limit:
+            break
+
+        peak_memory[size] = peak
+
+    if not peak_memory:
+        raise RuntimeError(
+            f"A single {patch_size} patch doesn't fit in {limit / 1024**3:.1f}GB"
+        )
+
+    # The biggest divisor of the batch size that we know fits
+    largest = max(peak_memory)
+    micro_batch_size = max(d for d in range(1, largest + 1) if batch_size % d == 0)
+
+    return BatchPlan(micro_batch_size, batch_size // micro_batch_size, peak_memory)
@@ -0,0 +1,274 @@
+"""
+Save the state of training every few epochs, so that we can carry on if it crashes
+
+A checkpoint holds everything we need to carry on exactly where we left off: the
+model, optimiser, gradient scaler and learning rate scheduler, the random number
+generators (on every process, if we're training on several), the state of the
+training data and the losses so far.
+
+Saving happens in two parts: the state is copied to CPU memory straight away (so
+training can carry on changing it), then pickled to disk in a background thread
+while the next epoch runs. Each checkpoint is written to a temporary file and then
+renamed, so a crash while writing never leaves a half-written checkpoint behind.
+
+"""
+
+import os
+import re
+import copy
+import pickle
+import random
+import pathlib
+import threading
+from dataclasses import dataclass, field, fields, is_dataclass
+from typing import Any
+
+import torch
+import numpy as np
+
+from .prefetch import EpochTiming
+
+_NAME = re.compile(r"checkpoint_epoch_(\d+)\.pkl")
+
+
+@dataclass
+class TrainingState:
+    """Everything needed to carry on training"""
+
+    # The next epoch to run
+    epoch: int
+
+    model_state_dict: dict[str, torch.Tensor]
+    optimizer_state_dict: dict[str, Any]
+    scaler_state_dict: dict[str, Any]
+    scheduler_state_dict: dict[str, Any] | None
+
+    # The random number generator states on each process, in rank order
+    rng_states: list[dict[str, Any]]
+
+    # The state of the training data, from `DataConfig.state_dict`
+    data_state: dict[str, Any]
+
+    train_losses: list[list[float]]
+    val_losses: list[list[float]]
+    foreground_fractions: list[list[float]] = field(default_factory=list)
+    epoch_timings: list[EpochTiming] = field(default_factory=list)
+
+    # So we can warn if we're resuming with different batches
+    accumulation_steps: int = 1
+
+
+def rng_state() -> dict[str, Any]:
+    """
+    The state of all the random number generators on this process
+
+    """
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        "numpy": np.random.get_state(),
+        "random": random.getstate(),
+    }
+
+
+def set_rng_state(state: dict[str, Any]) -> None:
+    """
+    Put the random number generators back to a state from `rng_state`
+
+    """
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
+
+
+def _to_cpu(obj: Any) -> Any:
+    """
+    A copy of some (possibly nested) state, with any tensors copied to the CPU
+
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if is_dataclass(obj):
+        return type(obj)(**{f.name: _to_cpu(getattr(obj, f.name)) for f in fields(obj)})
+    if isinstance(obj, dict):
+        return type(obj)((key, _to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)) and not hasattr(obj, "_fields"):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def checkpoint_dir(model_path: pathlib.Path) -> pathlib.Path:
+    """
+    Where to keep the checkpoints while training a model: next to it, named after
+    it, so models saved in the same directory don't share checkpoints
+
+    :param model_path: where the trained model will be saved, e.g. from
+                       `files.model_path`
+
+    """
+    model_path = pathlib.Path(model_path)
+    return model_path.with_name(f"{model_path.stem}_checkpoints")
+
+
+def remove(directory: pathlib.Path) -> None:
+    """
+    Delete the checkpoints in a directory, e.g. once the model has been saved, and
+    the directory too if there's nothing else in it
+
+    """
+    for path in list_checkpoints(directory):
+        path.unlink()
+    if directory.is_dir() and not any(directory.iterdir()):
+        directory.rmdir()
+
+
+def checkpoint_path(directory: pathlib.Path, epoch: int) -> pathlib.Path:
+    """
+    Where the checkpoint from before `epoch` is stored
+
+    """
+    return directory / f"checkpoint_epoch_{epoch}.pkl"
+
+
+def list_checkpoints(directory: pathlib.Path) -> list[pathlib.Path]:
+    """
+    The checkpoints in a directory, oldest first
+
+    """
+    if not directory.is_dir():
+        return []
+
+    found = [
+        (int(match.group(1)), path)
+        for path in directory.iterdir()
+        if (match := _NAME.fullmatch(path.name))
+    ]
+    return [path for _, path in sorted(found)]
+
+
+def latest_checkpoint(directory: pathlib.Path) -> pathlib.Path | None:
+    """
+    The most recent checkpoint in a directory, or None if there aren't any
+
+    """
+    checkpoints = list_checkpoints(directory)
+    return checkpoints[-1] if checkpoints else None
+
+
+def load(path: pathlib.Path) -> TrainingState:
+    """
+    Read a checkpoint
+
+    :param path: the checkpoint file
+    :returns: the training state
+
+    """
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def _write_atomic(state: TrainingState, path: pathlib.Path) -> None:
+    """
+    Pickle the state to a temporary file, then rename it to `path` - so `path` is
+    either the whole checkpoint or not there at all
+
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    # Make sure the rename itself is on disk
+    dir_fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class AsyncCheckpointer:
+    """
+    Write checkpoints in a background thread, keeping only the most recent few
+
+    Only one checkpoint is written at a time; saving another waits for the last one
+    to finish. Errors in the background thread are re-raised on the next call to
+    `save` or `wait`.
+
+    :param directory: where to put the checkpoints. Created if it doesn't exist
+    :param keep: how many of the most recent checkpoints to keep
+
+    """
+
+    def __init__(self, directory: pathlib.Path, keep: int = 3):
+        if keep < 1:
+            raise ValueError(f"Must keep at least one checkpoint, got {keep}")
+
+        self.directory = pathlib.Path(directory)
+        self.keep = keep
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        # Anything left over from a crash while writing
+        for tmp_path in self.directory.glob("checkpoint_epoch_*.pkl.tmp"):
+            tmp_path.unlink()
+
+        self._thread: threading.Thread | None = None
+        self._error: Exception | None = None
+
+    def _write(self, state: TrainingState) -> None:
+        """
+        Write a checkpoint and delete the old ones; runs in the background thread
+
+        """
+        try:
+            _write_atomic(state, checkpoint_path(self.directory, state.epoch))
+            for old in list_checkpoints(self.directory)[: -self.keep]:
+                old.unlink()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self._error = e
+
+    def save(self, state: TrainingState) -> None:
+        """
+        Copy the state to CPU memory and start writing it to disk
+
+        Returns once the copy has been made, so the caller can carry on changing the
+        model etc. straight away
+
+        :param state: the training state; tensors may be on any device
+
+        """
+        self.wait()
+
+        snapshot = _to_cpu(state)
+
+        # Not a daemon thread, so the checkpoint still gets finished if training
+        # crashes while it's being written
+        self._thread = threading.Thread(
+            target=self._write, args=(snapshot,), name="checkpoint"
+        )
+        self._thread.start()
+
+    def wait(self) -> None:
+        """
+        Wait for the checkpoint being written (if any) to finish
+
+        :raises: whatever went wrong writing the last checkpoint
+
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def __enter__(self) -> "AsyncCheckpointer":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.wait()
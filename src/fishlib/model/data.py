@@ -6,7 +6,7 @@ Loading, pre-processing, etc. the data for the model
 import sys
 import pathlib
 import datetime
-from typing import Any
+from typing import Any, Callable
 from dataclasses import dataclass
 
 import pydicom
@@ -15,10 +15,21 @@ import numpy as np
 import torchio as tio
 import torch
 import torch.utils
+from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 
 from ..images import io, transform
 from ..util import files, util
+from .augmentation import PatchFirstAugmentation, uniform_location
+from .sampling import (
+    ForegroundLocations,
+    ForegroundSampler,
+    UniformSampler,
+    add_foreground_density,
+)
+from .validation import ValidationPatches, validation_options
+from .patch_bank import PatchBank, PatchBankLoader, check_metadata, shuffle_seed
+from . import distributed
 
 
 @dataclass
@@ -142,16 +153,22 @@ class DataConfig:
     training and validation data, and reserves a single Subject for testing.
 
     :param config: model training configuration, e.g. read from userconf.yml
-    :param train_subjects: The training subjects
+    :param train_subjects: The training subjects. Can be None if training from a
+                           patch bank, since they aren't needed then
     :param val_subjects: The validation subjects
+    :param micro_batch_size: if the batches are being split up and the gradients
+                             accumulated (see `fishlib.model.batch_planner`), the number
+                             of patches in each training batch from this process
 
     """
 
     def __init__(
         self,
         config: dict,
-        train_subjects: tio.SubjectsDataset,
+        train_subjects: tio.SubjectsDataset | None,
         val_subjects: tio.SubjectsDataset,
+        *,
+        micro_batch_size: int | None = None,
     ):
         """
         Constructor
@@ -166,14 +183,59 @@ class DataConfig:
 
         """
 
-        # Assign class variables
-        self._train_data: tio.SubjectsLoader = self._train_val_loader(
-            train_subjects, config, train=True
-        )
-        self._val_data: tio.SubjectsLoader = self._train_val_loader(
-            val_subjects, config, train=False
+        # If we're training on several processes, each one gets its own share of the
+        # subjects - these need to be told which epoch it is, so they shuffle differently
+        self._subject_samplers: list[DistributedSampler] = []
+
+        self._micro_batch_size = micro_batch_size
+
+        # Seeded from the global generator, so it's the same for the same `torch_seed`,
+        # but different on each process
+        self._generator = torch.Generator().manual_seed(
+            int(torch.randint(2**62, (1,)).item()) + distributed.rank()
         )
 
+        # Assign class variables
+        # Training patches are either augmented on the fly, or read from a bank of
+        # pre-augmented patches
+        if (bank_dir := config.get("patch_bank")) is None:
+            if train_subjects is None:
+                raise ValueError("Need the training subjects if not using a patch bank")
+            self._train_data: tio.SubjectsLoader | PatchBankLoader = (
+                self._train_val_loader(train_subjects, config, train=True)
+            )
+        else:
+            self._train_data = self._bank_loader(
+                pathlib.Path(bank_dir).expanduser(),
+                (
+                    len(files.dicom_paths(config, "train"))
+                    if train_subjects is None
+                    else len(train_subjects)
+                ),
+                config,
+            )
+
+        # Validation patches are either drawn randomly every epoch, or extracted once
+        options = validation_options(config)
+        if options["patches"] == "queue":
+            self._val_data: tio.SubjectsLoader | ValidationPatches = (
+                self._train_val_loader(val_subjects, config, train=False)
+            )
+        else:
+            self._val_data = ValidationPatches.from_subjects(
+                val_subjects,
+                get_patch_size(config),
+                mode=options["patches"],
+                batch_size=options["batch_size"],
+                n_random=options["n_random"],
+                seed=options["seed"],
+                memmap_dir=(
+                    None
+                    if options["memmap_dir"] is None
+                    else pathlib.Path(options["memmap_dir"]).expanduser()
+                ),
+            ).shard(distributed.rank(), distributed.world_size())
+
     def _train_val_loader(
         self,
         subjects: tio.SubjectsDataset,
@@ -184,7 +246,9 @@ class DataConfig:
         """
         Create a dataloader from a SubjectsDataset
 
-        Training data is shuffled and has the last batch dropped; validation data is not
+        Training data is shuffled and has the last batch dropped; validation data is not.
+        If we're training on several processes, each one gets a share of the subjects and
+        the training batch size is split between them.
 
         :param subjects: The dataset. Training data should have random transforms applied
         :param train: If we're training or not
@@ -195,44 +259,245 @@ class DataConfig:
 
         """
         # Get some info from the config
-        patch_size = get_patch_size(config)
         batch_size = config["batch_size"]
-        num_workers = config["num_workers"]
+        if train:
+            batch_size = self._train_batch_size(config)
 
         shuffle = train is True
         drop_last = train is True
 
-        patch_sampler = tio.UniformSampler(patch_size=patch_size)
+        # Every rank gets the same number of subjects (some might be repeated), so that
+        # they all have the same number of batches
+        subject_sampler = None
+        if distributed.is_distributed():
+            subject_sampler = DistributedSampler(subjects, shuffle=shuffle)
+            self._subject_samplers.append(subject_sampler)
 
-        patches = tio.Queue(
-            subjects,
-            max_length=10000,  # Not sure if this matters
-            samples_per_volume=1,
-            sampler=patch_sampler,
-            num_workers=num_workers,
-            shuffle_patches=True,
-            shuffle_subjects=True,
-        )
+        # Training batches are read in a background thread (see
+        # `fishlib.model.prefetch`) while the model runs, so their random numbers come
+        # from a generator of their own - if they were drawn from the global one, the
+        # order they got mixed up with e.g. dropout's would change from run to run
+        generator = self._generator if train else None
 
         return tio.SubjectsLoader(
-            patches,
+            patch_queue(
+                subjects,
+                config,
+                train=train,
+                subject_sampler=subject_sampler,
+                generator=generator,
+            ),
             batch_size=batch_size,
             shuffle=shuffle,
             num_workers=0,
             drop_last=drop_last,
+            generator=generator,
         )
 
+    def _bank_loader(
+        self, bank_dir: pathlib.Path, n_subjects: int, config: dict[str, Any]
+    ) -> PatchBankLoader:
+        """
+        Stream training batches from a patch bank, created by
+        `scripts/create_patch_bank.py`
+
+        Each epoch has the same number of batches as it would if we were augmenting on
+        the fly (one patch per training subject, with the last batch dropped). If we're
+        training on several processes, each batch is split between them.
+
+        :param bank_dir: where the bank is
+        :param n_subjects: the number of training subjects
+        :param config: the configuration, e.g. from userconf.yml
+
+        :returns: the loader
+        :raises ValueError: if the patches in the bank are the wrong size, or the bank
+                            was made with different data or augmentation settings
+
+        """
+        bank = PatchBank(bank_dir)
+        if bank.patch_size != (patch_size := get_patch_size(config)):
+            raise ValueError(
+                f"Patch bank at {bank_dir} has patch size {bank.patch_size},"
+                f" but the config has {patch_size}"
+            )
+        check_metadata(bank_dir, config)
+
+        batch_size = self._train_batch_size(config)
+        return PatchBankLoader(
+            bank,
+            batch_size,
+            n_batches=max(1, n_subjects // (batch_size * distributed.world_size())),
+            seed=shuffle_seed(config),
+            rank=distributed.rank(),
+            world_size=distributed.world_size(),
+        )
+
+    def _train_batch_size(self, config: dict[str, Any]) -> int:
+        """
+        The number of patches in each training batch on this process
+
+        """
+        if self._micro_batch_size is not None:
+            return self._micro_batch_size
+        return distributed.per_rank_batch_size(config["batch_size"])
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Tell the data which epoch it is, so that the subjects are shuffled differently
+        each epoch when training on several processes. Does nothing otherwise.
+
+        :param epoch: the epoch that's about to start
+
+        """
+        for sampler in self._subject_samplers:
+            sampler.set_epoch(epoch)
+
+    def state_dict(self) -> dict[str, Any]:
+        """
+        The state of the training data that isn't set by the random seed, so that
+        training can be resumed from a checkpoint
+
+        Only a patch bank has any; patches augmented during training are drawn afresh
+        after resuming.
+
+        """
+        if isinstance(self._train_data, PatchBankLoader):
+            return {"patch_bank": self._train_data.state_dict()}
+        return {}
+
+    def load_state_dict(self, state: dict[str, Any]) -> None:
+        """
+        Carry on from a state given by `state_dict`
+
+        """
+        if "patch_bank" in state and isinstance(self._train_data, PatchBankLoader):
+            self._train_data.load_state_dict(state["patch_bank"])
+
     @property
-    def train_data(self) -> tio.SubjectsLoader:
+    def train_data(self) -> tio.SubjectsLoader | PatchBankLoader:
         """Get the training data"""
         return self._train_data
 
     @property
-    def val_data(self) -> tio.SubjectsLoader:
+    def val_data(self) -> tio.SubjectsLoader | ValidationPatches:
         """Get the validation data"""
         return self._val_data
 
 
+class _Queue(tio.Queue):
+    """
+    A `tio.Queue` that draws its random numbers - the order of the subjects, the
+    dataloader workers' seeds and the order of the patches - from a generator of its
+    own, rather than the global one
+
+    :param generator: where to draw the random numbers from. The global generator
+                      if None
+
+    """
+
+    def __init__(self, *args: Any, generator: torch.Generator | None, **kwargs: Any):
+        # The subjects loader might be made while the queue is being set up
+        self.generator = generator
+        super().__init__(*args, **kwargs)
+
+    def _get_subjects_iterable(self):
+        subjects_loader = torch.utils.data.DataLoader(
+            self.subjects_dataset,
+            num_workers=self.num_workers,
+            batch_size=1,
+            collate_fn=self._get_first_item,
+            sampler=self.subject_sampler,
+            shuffle=self.shuffle_subjects,
+            generator=self.generator,
+        )
+        self._num_sampled_subjects = 0
+        return iter(subjects_loader)
+
+    def _shuffle_patches_list(self):
+        indices = torch.randperm(self.num_patches, generator=self.generator)
+        self.patches_list = [self.patches_list[i] for i in indices]
+
+
+def patch_queue(
+    subjects: tio.SubjectsDataset,
+    config: dict[str, Any],
+    *,
+    train: bool,
+    subject_sampler: torch.utils.data.Sampler | None = None,
+    generator: torch.Generator | None = None,
+) -> tio.Queue:
+    """
+    A queue of patches drawn from the subjects, one per subject per pass through them.
+    The queue never runs out - it starts again from the first subject.
+
+    :param subjects: The dataset. Training data should have random transforms applied
+    :param config: The configuration, e.g. from userconf.yml
+    :param train: If we're training or not
+    :param subject_sampler: which subjects to use, e.g. a `DistributedSampler` to take
+                            a share of them. By default, all of them are used in a
+                            random order
+    :param generator: where the queue and the patch sampler draw their random numbers
+                      from. The global generator if None. Transforms that run in this
+                      process (i.e. with `num_workers: 0`) still use the global one
+
+    :returns: the queue
+
+    """
+    return _Queue(
+        subjects,
+        max_length=10000,  # Not sure if this matters
+        samples_per_volume=1,
+        sampler=_patch_sampler(config, train=train, generator=generator),
+        subject_sampler=subject_sampler,
+        num_workers=config["num_workers"],
+        shuffle_patches=True,
+        shuffle_subjects=subject_sampler is None,
+        generator=generator,
+    )
+
+
+def _patch_sampler(
+    config: dict[str, Any], *, train: bool, generator: torch.Generator | None = None
+) -> tio.data.PatchSampler:
+    """
+    Choose how to draw patches from the subjects
+
+    If we're using patch-first augmentation, the training subjects are already the size
+    of a patch (the location was chosen during augmentation) so we just take all of it.
+    Otherwise, training patches might be drawn according to how much foreground they
+    contain (`foreground_ratio` in the config). Validation patches are always uniform.
+
+    """
+    patch_size = get_patch_size(config)
+    foreground_ratio = config.get("foreground_ratio")
+
+    if not train or foreground_ratio is None or config.get("patch_first_augmentation"):
+        return UniformSampler(patch_size, generator)
+
+    # The subjects have been augmented by the time they get here, so we can't use a
+    # density map that was calculated in advance; the sampler finds it once for all
+    # the patches it draws from each subject
+    return ForegroundSampler(
+        patch_size,
+        ForegroundLocations(foreground_ratio, cache=False, generator=generator),
+    )
+
+
+def patch_locations(
+    config: dict[str, Any],
+) -> Callable[[tio.Subject, tuple[int, int, int]], tuple[int, int, int]]:
+    """
+    How to choose where training patches come from, as defined in the config
+
+    :param config: The configuration, e.g. from userconf.yml
+    :returns: a callable taking a subject and patch size, returning the patch start
+
+    """
+    if (foreground_ratio := config.get("foreground_ratio")) is None:
+        return uniform_location
+    return ForegroundLocations(foreground_ratio)
+
+
 def ints2float(int_arr: np.ndarray) -> np.ndarray:
     """
     Scale an array from 16-bit integer values to float values in [0, 1]
@@ -399,10 +664,38 @@ def _transforms(transform_dict: dict) -> tio.transforms.Transform:
     )
 
 
+def augmentation(config: dict[str, Any]) -> tio.transforms.Transform:
+    """
+    The augmentations to apply to the training data, as defined in the config
+    (see `transforms` in userconf.yml)
+
+    If `patch_first_augmentation` is set in the config, the patch location is chosen
+    before augmenting, and only the patch is augmented. The output of this transform
+    is then already the size of a patch.
+
+    :param config: The configuration, e.g. from userconf.yml
+    :returns: the transform
+
+    """
+    if not config.get("patch_first_augmentation", False):
+        return _transforms(config["transforms"])
+
+    return PatchFirstAugmentation(
+        [
+            load_transform(transform_name, args)
+            for transform_name, args in config["transforms"].items()
+        ],
+        get_patch_size(config),
+        locations=patch_locations(config),
+    )
+
+
 def read_dicoms_from_disk(
     config: dict,
     verbose: bool = False,
-) -> tuple[tio.SubjectsDataset, tio.SubjectsDataset, tio.Subject]:
+    *,
+    train: bool = True,
+) -> tuple[tio.SubjectsDataset | None, tio.SubjectsDataset, tio.Subject]:
     """
     Get all the data used in the training process - training, validation and testing
     This reads in the DICOMs created by `scripts/create_dicoms.py`.
@@ -412,8 +705,10 @@ def read_dicoms_from_disk(
     :param config: The configuration, e.g. from userconf.yml
     :param verbose: whether to print extra stuff, in case we want to be sure about where
                     we're reading from
+    :param train: whether to read the training DICOMs. There's no need to when training
+                  from a patch bank
 
-    :returns: subjects for training
+    :returns: subjects for training, or None if `train` is False
     :returns: subjects for validation
     :returns: a subject, for testing
 
@@ -422,21 +717,32 @@ def read_dicoms_from_disk(
     """
     # Read in data + convert to subjects
     window_size = transform.window_size(config)
-    train_subjects, test_subjects, val_subjects = (
-        [
+
+    def read(mode: str) -> list[tio.Subject]:
+        return [
             subject(path, window_size)
             for path in tqdm(
                 files.dicom_paths(config, mode, verbose), desc=f"Reading {mode} DICOMs"
             )
         ]
-        for mode in ("train", "test", "val")
-    )
 
-    # Convert to SubjectsDatasets, which is where the transforms get applied
+    train_subjects = read("train") if train else None
+    test_subjects, val_subjects = read("test"), read("val")
 
-    train_subjects = tio.SubjectsDataset(
-        train_subjects, transform=_transforms(config["transforms"])
-    )
+    # If we're choosing where patches come from before augmenting, we only need to work
+    # out how much of the jaw is in each patch once
+    if (
+        train
+        and config.get("patch_first_augmentation")
+        and isinstance(locations := patch_locations(config), ForegroundLocations)
+    ):
+        add_foreground_density(train_subjects, get_patch_size(config), locations)
+
+    # Convert to SubjectsDatasets, which is where the transforms get applied
+    if train:
+        train_subjects = tio.SubjectsDataset(
+            train_subjects, transform=augmentation(config)
+        )
     val_subjects = tio.SubjectsDataset(val_subjects)
     (test_subject,) = test_subjects
 
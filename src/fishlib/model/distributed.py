@@ -0,0 +1,143 @@
+"""
+Data-parallel training across several processes (ranks) on the CPU
+
+Each rank holds a copy of the model and trains on its own share of the patches;
+`DistributedDataParallel` averages the gradients between ranks after every backward
+pass, so the copies stay the same. Ranks talk to each other with the gloo backend,
+and find each other through a file on a shared filesystem - so they can be spread
+over several machines.
+
+Everything here also works if we're not running distributed (it behaves as if there
+is one rank), so the training code doesn't need to check.
+
+"""
+
+import os
+import pathlib
+import warnings
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def file_init_method(rendezvous: pathlib.Path) -> str:
+    """
+    The URL that tells the ranks to find each other through a file
+
+    :param rendezvous: a file that all ranks can see, e.g. on a shared filesystem.
+                       It shouldn't exist before the ranks start
+    :returns: the init method for `torch.distributed.init_process_group`
+
+    """
+    return f"file://{rendezvous.resolve()}"
+
+
+def setup(rank: int, world_size: int, init_method: str, threads: int) -> None:
+    """
+    Join the process group, and limit how many threads this rank uses
+
+    :param rank: the index of this process out of all processes on all machines
+    :param world_size: the total number of processes
+    :param init_method: how to find the other processes, e.g. from `file_init_method`
+    :param threads: how many intra-op threads this rank should use. The ranks on a
+                    machine should share its cores between them
+
+    """
+    torch.set_num_threads(threads)
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+
+    dist.init_process_group(
+        "gloo", init_method=init_method, rank=rank, world_size=world_size
+    )
+
+
+def cleanup() -> None:
+    """
+    Leave the process group, if we're in one
+
+    """
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed() -> bool:
+    """Whether we're running with more than one process"""
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank() -> int:
+    """The index of this process (0 if not distributed)"""
+    return dist.get_rank() if is_distributed() else 0
+
+
+def world_size() -> int:
+    """The number of processes (1 if not distributed)"""
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    """Whether this process should write outputs, print things etc."""
+    return rank() == 0
+
+
+def per_rank_batch_size(batch_size: int) -> int:
+    """
+    The batch size each rank should use, so that the total batch size across all
+    ranks is the same as in the config
+
+    :param batch_size: the total batch size, e.g. from userconf.yml
+    :returns: the batch size for each rank
+
+    """
+    n_ranks = world_size()
+    if batch_size % n_ranks:
+        warnings.warn(
+            f"Batch size {batch_size} doesn't divide between {n_ranks} ranks;"
+            f" using {max(1, batch_size // n_ranks) * n_ranks} in total"
+        )
+    return max(1, batch_size // n_ranks)
+
+
+def wrap(net: torch.nn.Module) -> torch.nn.Module:
+    """
+    Wrap the model so that its gradients are synchronised between ranks.
+    This also copies rank 0's parameters to all the other ranks.
+
+    :param net: the model
+    :returns: the wrapped model, or the model itself if we're not distributed
+
+    """
+    return DistributedDataParallel(net) if is_distributed() else net
+
+
+def gather(values: list[float]) -> list[float]:
+    """
+    Collect a list of values from every rank, e.g. the loss for each batch
+
+    :param values: the values on this rank
+    :returns: the values from all ranks, in rank order. The same on every rank.
+
+    """
+    if not is_distributed():
+        return list(values)
+
+    gathered = [None] * world_size()
+    dist.all_gather_object(gathered, list(values))
+    return [value for rank_values in gathered for value in rank_values]
+
+
+def minimum(value: int) -> int:
+    """
+    The smallest value across all ranks, e.g. so that they can agree on a batch size
+
+    :param value: the value on this rank
+    :returns: the smallest value on any rank. The same on every rank.
+
+    """
+    if not is_distributed():
+        return value
+
+    tensor = torch.tensor(value)
+    dist.all_reduce(tensor, op=dist.ReduceOp.MIN)
+    return int(tensor.item())
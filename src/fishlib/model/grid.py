@@ -0,0 +1,265 @@
+"""
+Split an image into a grid of overlapping patches for inference, and stitch the
+predictions back together
+
+This does the same thing as `tio.GridSampler` and `tio.inference.GridAggregator`
+(with `overlap_mode="hann"`), but works directly on tensors: patches are views into
+the image rather than a new `tio.Subject` each, and predictions are added straight
+into one preallocated output instead of being collected up first.
+
+"""
+
+import functools
+from typing import Generator
+
+import torch
+
+from .validation import grid_starts
+
+
+@functools.lru_cache(maxsize=8)
+def hann_window(patch_size: tuple[int, int, int]) -> torch.Tensor:
+    """
+    3D Hann window to weight each patch's prediction by, so that the edges of the
+    patches (where the model has the least context) count for less.
+    The same as the one torchio uses.
+
+    Cached, so don't modify the result in place.
+
+    :param patch_size: the size of the patches
+    :returns: the window, with shape `patch_size`
+
+    """
+    window = torch.ones(patch_size)
+    for dim, size in enumerate(patch_size):
+        # Trim the zeros off the ends, so every voxel gets some weight
+        window_1d = torch.hann_window(size + 2, periodic=False)[1:-1]
+
+        shape = [1, 1, 1]
+        shape[dim] = size
+        window = window * window_1d.view(shape)
+
+    return window
+
+
+@functools.lru_cache(maxsize=4)
+def _window_sum(
+    spatial_shape: tuple[int, int, int],
+    patch_size: tuple[int, int, int],
+    patch_overlap: tuple[int, int, int],
+) -> torch.Tensor:
+    """
+    The total weight given to each voxel by the windows of all the patches
+
+    Cached, so don't modify the result in place.
+
+    """
+    total = torch.zeros(spatial_shape)
+    window = hann_window(patch_size)
+    for start in grid_starts(spatial_shape, patch_size, patch_overlap):
+        total[_slices(start, patch_size)] += window
+
+    return total
+
+
+def _slices(
+    start: tuple[int, int, int], patch_size: tuple[int, int, int]
+) -> tuple[slice, slice, slice]:
+    """
+    Index a patch out of a (spatial) image
+
+    """
+    return tuple(slice(s, s + size) for s, size in zip(start, patch_size))
+
+
+class GridPatches:
+    """
+    A grid of overlapping patches covering an image, in the same order as
+    `tio.GridSampler`
+
+    :param image: the image, with shape (channels, z, y, x)
+    :param patch_size: the size of each patch
+    :param patch_overlap: how much neighbouring patches overlap
+
+    :raises ValueError: if the patch is larger than the image, or if the overlap
+                        is not smaller than the patch
+
+    """
+
+    def __init__(
+        self,
+        image: torch.Tensor,
+        patch_size: tuple[int, int, int],
+        patch_overlap: tuple[int, int, int] = (0, 0, 0),
+    ):
+        self.image = image
+        self.patch_size = tuple(patch_size)
+        self.patch_overlap = tuple(patch_overlap)
+
+        self.starts = grid_starts(self.spatial_shape, self.patch_size, patch_overlap)
+
+    @property
+    def spatial_shape(self) -> tuple[int, int, int]:
+        """The shape of the image, without the channel dimension"""
+        return tuple(self.image.shape[1:])
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __getitem__(self, index: int) -> torch.Tensor:
+        """
+        A patch, as a view into the image (so it isn't copied)
+
+        """
+        return self.image[(slice(None), *_slices(self.starts[index], self.patch_size))]
+
+    def maxima(self, downsample: int = 4) -> torch.Tensor:
+        """
+        A cheap upper bound on the largest value in each patch
+
+        Found from a copy of the image shrunk by taking the max of each
+        `downsample`-sized block, so it's never smaller than the true maximum (but
+        may be a bit bigger, since blocks can stick out of the edge of a patch).
+
+        :param downsample: the size of the blocks
+        :returns: the bound for each patch, over all channels
+
+        """
+        blocks = torch.nn.functional.max_pool3d(
+            self.image.unsqueeze(0).float(),
+            kernel_size=downsample,
+            stride=downsample,
+            ceil_mode=True,
+        )[0].amax(dim=0)
+
+        return torch.stack(
+            [
+                blocks[
+                    tuple(
+                        slice(s // downsample, -(-(s + size) // downsample))
+                        for s, size in zip(start, self.patch_size)
+                    )
+                ].max()
+                for start in self.starts
+            ]
+        )
+
+    def batches(
+        self, batch_size: int
+    ) -> Generator[tuple[torch.Tensor, list[tuple[int, int, int]]], None, None]:
+        """
+        The patches in batches, ready to go into the model
+
+        Batches are only made when they're asked for, so only one batch's worth of
+        patches is copied out of the image at a time.
+
+        :param batch_size: the most patches in each batch
+        :returns: the batch, with shape (batch, channels, *patch_size)
+        :returns: the start of each patch in the batch
+
+        """
+        for i in range(0, len(self), batch_size):
+            indices = range(i, min(i + batch_size, len(self)))
+            yield (
+                torch.stack([self[j] for j in indices]),
+                [self.starts[j] for j in indices],
+            )
+
+
+def pooled_batches(
+    grids: list[GridPatches],
+    batch_size: int,
+    include: list[list[int]] | None = None,
+) -> Generator[tuple[torch.Tensor, list[tuple[int, tuple[int, int, int]]]], None, None]:
+    """
+    The patches from several images in batches, so that images with only a few
+    patches still make full batches
+
+    The patches must all be the same size and have the same number of channels.
+
+    :param grids: the patches in each image
+    :param batch_size: the most patches in each batch
+    :param include: which patches to use from each image, if not all of them
+    :returns: the batch, with shape (batch, channels, *patch_size)
+    :returns: for each patch in the batch, which image (index into `grids`) it's from
+              and where it starts
+
+    """
+    if include is None:
+        include = [range(len(grid)) for grid in grids]
+    indices = [(i, j) for i, patches in enumerate(include) for j in patches]
+    for k in range(0, len(indices), batch_size):
+        batch = indices[k : k + batch_size]
+        yield (
+            torch.stack([grids[i][j] for i, j in batch]),
+            [(i, grids[i].starts[j]) for i, j in batch],
+        )
+
+
+class GridAccumulator:
+    """
+    Add up the predictions on a grid of patches, weighted by a Hann window, to get
+    a prediction for the whole image
+
+    :param n_channels: the number of channels in the predictions
+    :param spatial_shape: the shape of the whole image
+    :param patch_size: the size of each patch
+    :param patch_overlap: how much neighbouring patches overlap
+    :param dtype: the type to add the predictions up in
+
+    """
+
+    def __init__(
+        self,
+        n_channels: int,
+        spatial_shape: tuple[int, int, int],
+        patch_size: tuple[int, int, int],
+        patch_overlap: tuple[int, int, int] = (0, 0, 0),
+        dtype: torch.dtype = torch.float32,
+    ):
+        self.spatial_shape = tuple(spatial_shape)
+        self.patch_size = tuple(patch_size)
+        self.patch_overlap = tuple(patch_overlap)
+
+        self._output = torch.zeros((n_channels, *self.spatial_shape), dtype=dtype)
+        self._window = hann_window(self.patch_size).to(dtype)
+        self._finished = False
+
+    def add(
+        self, predictions: torch.Tensor, starts: list[tuple[int, int, int]]
+    ) -> None:
+        """
+        Add a batch of predictions
+
+        :param predictions: predictions on some patches, with shape
+                            (batch, channels, *patch_size)
+        :param starts: the start of each patch, e.g. from `GridPatches.batches`
+
+        :raises RuntimeError: if we've already got the output
+
+        """
+        if self._finished:
+            raise RuntimeError("Can't add predictions after getting the output")
+
+        predictions = predictions.to(device="cpu", dtype=self._output.dtype)
+        for prediction, start in zip(predictions, starts, strict=True):
+            self._output[(slice(None), *_slices(start, self.patch_size))].addcmul_(
+                prediction, self._window
+            )
+
+    def output(self) -> torch.Tensor:
+        """
+        Get the prediction for the whole image. Can only be called once, since the
+        predictions are normalised in place.
+
+        :returns: the prediction, with shape (channels, *spatial_shape)
+        :raises RuntimeError: if we've already got the output
+
+        """
+        if self._finished:
+            raise RuntimeError("Already got the output")
+        self._finished = True
+
+        return self._output.div_(
+            _window_sum(self.spatial_shape, self.patch_size, self.patch_overlap)
+        )
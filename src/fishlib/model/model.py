@@ -6,8 +6,13 @@ Also contains the training loop and inference code.
 """
 
 import os
+import time
 import pickle
-from dataclasses import dataclass
+import pathlib
+import warnings
+import itertools
+import contextlib
+from dataclasses import dataclass, field
 from typing import Type, Any
 
 import torch
@@ -15,8 +20,15 @@ import numpy as np
 import torchio as tio
 from tqdm import trange
 from torch.amp import autocast, GradScaler
+from torch.nn.parallel import DistributedDataParallel
 
 from .data import DataConfig
+from .activation_checkpointing import checkpoint_attention_unet
+from .prefetch import EpochTiming, Prefetcher
+from .patch_bank import PatchBankLoader
+from . import distributed, checkpoints, artifact
+from .validation import ValidationPatches
+from .grid import GridAccumulator, GridPatches, pooled_batches
 from ..util import util, files
 
 
@@ -25,7 +37,9 @@ class ModelState:
     """The state of the model"""
 
     model_state_dict: dict[str, torch.Tensor]
-    optimizer_state_dict: dict[str, torch.Tensor]
+    # None if the model was read from an artifact (see `fishlib.model.artifact`);
+    # use `artifact.load_optimizer` if you need it
+    optimizer_state_dict: dict[str, torch.Tensor] | None
 
     # The configuration used to train the model, as read from the userconf.yml file
     # We keep it here so we know exactly what config was used to train the model
@@ -57,9 +71,40 @@ class TrainingConfig:
     device: torch.device
     epochs: int
     lr_scheduler: torch.optim.lr_scheduler.LRScheduler = None
-    checkpoint: bool = False
     early_stopping: bool = False
 
+    # Whether to save checkpoints during training (see `fishlib.model.checkpoints`),
+    # and where, how often and how many to keep
+    checkpoint: bool = False
+    checkpoint_dir: pathlib.Path | None = None
+    checkpoint_every: int = 10
+    keep_checkpoints: int = 3
+    # Carry on from the latest checkpoint in `checkpoint_dir`
+    resume: bool = False
+
+    # Only find the validation loss every this many epochs; in between, the last
+    # validation losses are repeated
+    validation_every: int = 1
+    # Whether to use mixed precision when finding the validation loss
+    validation_autocast: bool = False
+    # The precision to use for mixed precision validation, e.g. bfloat16 on the CPU;
+    # None for the device's default
+    validation_autocast_dtype: torch.dtype | None = None
+
+    # How many training batches to get ready in the background
+    prefetch: int = 2
+
+    # How many training batches to accumulate gradients over before each optimiser
+    # step, e.g. from `fishlib.model.batch_planner`
+    accumulation_steps: int = 1
+
+    # Filled in during training: the fraction of foreground voxels in each training
+    # batch, for each epoch
+    foreground_fractions: list[list[float]] = field(default_factory=list)
+    # Filled in during training: how long each epoch spent waiting for data vs
+    # doing everything else
+    epoch_timings: list[EpochTiming] = field(default_factory=list)
+
 
 @dataclass
 class IterationConfig:
@@ -68,10 +113,16 @@ class IterationConfig:
     net: torch.nn.Module
     optim: torch.optim.Optimizer
     loss_fn: torch.nn.Module
-    train_data: tio.SubjectsLoader
+    train_data: tio.SubjectsLoader | PatchBankLoader
     scaler: GradScaler
     device: torch.device
 
+    # How many batches to get ready in the background
+    prefetch: int = 2
+
+    # How many batches to accumulate gradients over before each optimiser step
+    accumulation_steps: int = 1
+
 
 def channels(n_layers: int, initial_channels) -> list[int]:
     """
@@ -176,7 +227,7 @@ def model_params(in_params: dict[str, Any]) -> dict[str, Any]:
     return out_params
 
 
-def model(config: dict[str, Any]) -> torch.nn.Module:
+def model(config: dict[str, Any], *, train: bool = False) -> torch.nn.Module:
     """
     U-Net model for segmentation
 
@@ -184,6 +235,10 @@ def model(config: dict[str, Any]) -> torch.nn.Module:
                    userconf.yml. Must contain the following keys:
                      - model_name: the name of the model to use
                      - all the params needed for the model
+                   and optionally activation_checkpointing (see
+                   `fishlib.model.activation_checkpointing`)
+    :param train: whether the model is going to be trained. Activation checkpointing
+                  is only turned on if so; it does nothing for inference
     :returns: the model
 
     """
@@ -191,7 +246,13 @@ def model(config: dict[str, Any]) -> torch.nn.Module:
     classname = util.load_class(config["model_name"])
 
     # Parse the parameters from the config
-    return classname(**model_params(config))
+    net = classname(**model_params(config))
+
+    # Optionally trade compute for memory during training
+    if train and (levels := config.get("activation_checkpointing")):
+        checkpoint_attention_unet(net, levels)
+
+    return net
 
 
 def _get_data(
@@ -211,53 +272,97 @@ def _get_data(
 
 def _train_step(
     iteration_config: IterationConfig,
-) -> tuple[torch.nn.Module, list[float]]:
+) -> tuple[torch.nn.Module, list[float], list[float], EpochTiming]:
     """
     Train the model for one epoch, on the given batches of data provided as a dataloader
 
+    Batches are read and copied to the device in the background while the model is
+    running. The losses are kept on the device and only copied back at the end of the
+    epoch, so we don't have to wait for the device every batch.
+
+    If `accumulation_steps` is more than 1, the gradients from that many batches are
+    added up before each optimiser step (see `fishlib.model.batch_planner`). Any batches
+    left over at the end of the epoch that don't make up a whole step are skipped.
+
     :param iteration_config: the stuff we need to train
 
     :returns: the trained model
     :returns: list of training batch losses
+    :returns: fraction of foreground voxels in each batch
+    :returns: how long we spent waiting for data, and how long doing everything else
 
     """
     net = iteration_config.net
     optim = iteration_config.optim
     loss_fn = iteration_config.loss_fn
-    train_data = iteration_config.train_data
     scaler = iteration_config.scaler
     device = iteration_config.device
 
+    # Only use whole groups of batches, unless there aren't enough for one. The
+    # prefetcher mustn't read the rest, or where e.g. a patch bank carries on from
+    # next epoch would depend on how far ahead it had got
+    n_batches = len(iteration_config.train_data)
+    accumulation_steps = max(1, min(iteration_config.accumulation_steps, n_batches))
+    n_batches -= n_batches % accumulation_steps
+
+    train_data = Prefetcher(
+        iteration_config.train_data,
+        device,
+        depth=iteration_config.prefetch,
+        n_batches=n_batches,
+    )
+
     net.train()
 
+    start = time.perf_counter()
+
     train_losses = []
-    for data in train_data:
-        x, y = _get_data(data)
+    foreground_fractions = []
+    optim.zero_grad()
+    with contextlib.closing(iter(train_data)) as batches:
+        for i, batch in enumerate(itertools.islice(batches, n_batches)):
+            foreground_fractions.append(batch.foreground_fraction)
+            step = (i + 1) % accumulation_steps == 0
+
+            # If we're training on several processes, only synchronise the gradients
+            # when we're about to take a step
+            with (
+                net.no_sync()
+                if isinstance(net, DistributedDataParallel) and not step
+                else contextlib.nullcontext()
+            ):
+                with autocast(device):
+                    out = net(batch.image)
+                    loss = loss_fn(out, batch.label)
 
-        input_, target = x.to(device, non_blocking=True), y.to(
-            device, non_blocking=True
-        )
+                scaler.scale(loss / accumulation_steps).backward()
+
+            if step:
+                scaler.step(optim)
+                scaler.update()
+                optim.zero_grad()
 
-        optim.zero_grad()
-        with autocast(device):
-            out = net(input_)
-            loss = loss_fn(out, target)
+            train_losses.append(loss.detach())
 
-        scaler.scale(loss).backward()
-        scaler.step(optim)
-        scaler.update()
+    # Copying the losses back waits for everything to finish
+    train_losses = (
+        torch.stack(train_losses).float().cpu().tolist() if train_losses else []
+    )
 
-        train_losses.append(loss.item())
+    total = time.perf_counter() - start
+    timing = EpochTiming(train_data.wait_time, total - train_data.wait_time)
 
-    return net, train_losses
+    return net, train_losses, foreground_fractions, timing
 
 
 def _validation_step(
     net: torch.nn.Module,
     loss_fn: torch.nn.Module,
-    validation_data: tio.SubjectsLoader,
+    validation_data: tio.SubjectsLoader | ValidationPatches,
     *,
     device: torch.device,
+    use_autocast: bool = False,
+    autocast_dtype: torch.dtype | None = None,
 ) -> tuple[torch.nn.Module, list[float]]:
     """
     Find the loss on the validation data
@@ -266,6 +371,9 @@ def _validation_step(
     :param loss_fn: the loss function to use
     :param train_data: the validation data
     :param device: the device to run the model on
+    :param use_autocast: whether to run the model in mixed precision
+    :param autocast_dtype: the precision to use with `use_autocast`, e.g.
+                           torch.bfloat16 on the CPU. None for the device's default
 
     :returns: the trained model
     :returns: validation loss for each batch
@@ -275,11 +383,11 @@ def _validation_step(
 
     losses = np.ones(len(validation_data)) * np.nan
 
-    for i, data in enumerate(validation_data):
-        x, y = _get_data(data)
+    with torch.no_grad(), autocast(device, enabled=use_autocast, dtype=autocast_dtype):
+        for i, data in enumerate(validation_data):
+            x, y = _get_data(data)
 
-        batch_img, batch_label = x.to(device), y.to(device)
-        with torch.no_grad():
+            batch_img, batch_label = x.to(device), y.to(device)
             out = net(batch_img)
             loss = loss_fn(out, batch_label)
             losses[i] = loss.item()
@@ -351,6 +459,96 @@ def _early_stop(
     return False
 
 
+def _training_state(
+    epoch: int,
+    net: torch.nn.Module,
+    optim: torch.optim.Optimizer,
+    scaler: GradScaler,
+    data_config: DataConfig,
+    train_config: TrainingConfig,
+    train_losses: list[list[float]],
+    val_losses: list[list[float]],
+) -> checkpoints.TrainingState:
+    """
+    Everything we need to carry on training from the start of `epoch`
+
+    The random states are collected from every process, so this needs to be called
+    on all of them.
+
+    """
+    return checkpoints.TrainingState(
+        epoch=epoch,
+        model_state_dict=net.state_dict(),
+        optimizer_state_dict=optim.state_dict(),
+        scaler_state_dict=scaler.state_dict(),
+        scheduler_state_dict=(
+            train_config.lr_scheduler.state_dict()
+            if train_config.lr_scheduler
+            else None
+        ),
+        rng_states=distributed.gather([checkpoints.rng_state()]),
+        data_state=data_config.state_dict(),
+        train_losses=train_losses,
+        val_losses=val_losses,
+        foreground_fractions=train_config.foreground_fractions,
+        epoch_timings=train_config.epoch_timings,
+        accumulation_steps=train_config.accumulation_steps,
+    )
+
+
+def _resume(
+    net: torch.nn.Module,
+    optim: torch.optim.Optimizer,
+    scaler: GradScaler,
+    data_config: DataConfig,
+    train_config: TrainingConfig,
+) -> tuple[int, list[list[float]], list[list[float]]]:
+    """
+    Load the latest checkpoint into the model, optimiser etc.
+
+    :returns: the epoch to carry on from
+    :returns: the training losses so far
+    :returns: the validation losses so far
+    :raises FileNotFoundError: if there are no checkpoints
+
+    """
+    path = checkpoints.latest_checkpoint(train_config.checkpoint_dir)
+    if path is None:
+        raise FileNotFoundError(f"No checkpoints in {train_config.checkpoint_dir}")
+    state = checkpoints.load(path)
+
+    if state.accumulation_steps != train_config.accumulation_steps:
+        warnings.warn(
+            f"Checkpoint accumulated gradients over {state.accumulation_steps} batches,"
+            f" but we're using {train_config.accumulation_steps}; training won't"
+            " carry on exactly as before"
+        )
+    if len(state.rng_states) != distributed.world_size():
+        warnings.warn(
+            f"Checkpoint is from {len(state.rng_states)} processes, but there are"
+            f" {distributed.world_size()}; training won't carry on exactly as before"
+        )
+
+    net.load_state_dict(state.model_state_dict)
+    optim.load_state_dict(state.optimizer_state_dict)
+    scaler.load_state_dict(state.scaler_state_dict)
+    if train_config.lr_scheduler and state.scheduler_state_dict is not None:
+        train_config.lr_scheduler.load_state_dict(state.scheduler_state_dict)
+    data_config.load_state_dict(state.data_state)
+
+    train_config.foreground_fractions[:] = state.foreground_fractions
+    train_config.epoch_timings[:] = state.epoch_timings
+
+    # Last, so that nothing above changes them
+    checkpoints.set_rng_state(
+        state.rng_states[distributed.rank() % len(state.rng_states)]
+    )
+
+    if distributed.is_main_process():
+        print(f"Resuming from {path} at epoch {state.epoch}")
+    return state.epoch, state.train_losses, state.val_losses
+
+
 def train(
     net: torch.nn.Module,
     optim: torch.optim.Optimizer,
@@ -367,6 +565,14 @@ def train(
     :param data_config: the data to train on
     :param train_config: the configuration for training
 
+    If we're running on several processes (see `fishlib.model.distributed`), each one
+    trains on its share of the data and the gradients are averaged between them. The
+    losses returned are from all the processes.
+
+    If `train_config.checkpoint` is set, the state of training is saved every few
+    epochs (see `fishlib.model.checkpoints`); with `train_config.resume`, training
+    carries on from the latest checkpoint.
+
     :returns: the trained model
     :returns: list of training batch losses
     :returns: list of validation batch losses
@@ -375,29 +581,76 @@ def train(
     train_batch_losses = []
     val_batch_losses = []
 
+    # Gradient scaler for mixed precision training
+    scaler = GradScaler()
+
+    checkpointer = None
+    if train_config.checkpoint or train_config.resume:
+        if train_config.checkpoint_dir is None:
+            raise ValueError("Need a checkpoint_dir to save or resume from checkpoints")
+        if train_config.checkpoint and distributed.is_main_process():
+            checkpointer = checkpoints.AsyncCheckpointer(
+                train_config.checkpoint_dir, train_config.keep_checkpoints
+            )
+
+    start_epoch = 0
+    if train_config.resume:
+        start_epoch, train_batch_losses, val_batch_losses = _resume(
+            net, optim, scaler, data_config, train_config
+        )
+
+    # If we're training on several processes, this keeps the gradients in sync.
+    # It shares its parameters with `net`, which we use directly for validation
+    train_net = distributed.wrap(net)
+
     # How many epochs to wait before stopping training
     patience = 10
 
-    # Gradient scaler for mixed precision training
-    scaler = GradScaler()
+    # If we've resumed and don't validate on the first epoch, we carry on using the
+    # last validation losses
+    if val_batch_losses:
+        val_batch_loss = val_batch_losses[-1]
+
+    progress_bar = trange(
+        start_epoch,
+        train_config.epochs,
+        desc="Training",
+        disable=not distributed.is_main_process(),
+    )
+    for epoch in progress_bar:
+        data_config.set_epoch(epoch)
 
-    progress_bar = trange(train_config.epochs, desc="Training")
-    for _ in progress_bar:
-        net, train_batch_loss = _train_step(
+        train_net, train_batch_loss, foreground_fraction, timing = _train_step(
             IterationConfig(
-                net,
+                train_net,
                 optim,
                 loss_fn,
                 data_config.train_data,
                 scaler,
                 train_config.device,
+                train_config.prefetch,
+                train_config.accumulation_steps,
             )
         )
-        train_batch_losses.append(train_batch_loss)
-
-        net, val_batch_loss = _validation_step(
-            net, loss_fn, data_config.val_data, device=train_config.device
-        )
+        train_batch_losses.append(distributed.gather(train_batch_loss))
+        train_config.foreground_fractions.append(foreground_fraction)
+        train_config.epoch_timings.append(timing)
+
+        # We might not want to validate every epoch - but we always validate on the
+        # first and last epochs
+        if (
+            epoch % train_config.validation_every == 0
+            or epoch == train_config.epochs - 1
+        ):
+            net, val_batch_loss = _validation_step(
+                net,
+                loss_fn,
+                data_config.val_data,
+                device=train_config.device,
+                use_autocast=train_config.validation_autocast,
+                autocast_dtype=train_config.validation_autocast_dtype,
+            )
+            val_batch_loss = distributed.gather(val_batch_loss)
         val_batch_losses.append(val_batch_loss)
 
         # We might want to adjust the learning rate during training
@@ -409,6 +662,22 @@ def train(
             else:
                 train_config.lr_scheduler.step()
 
+        # Every process has to take part, since the checkpoint has all of their
+        # random states
+        if train_config.checkpoint and (epoch + 1) % train_config.checkpoint_every == 0:
+            state = _training_state(
+                epoch + 1,
+                net,
+                optim,
+                scaler,
+                data_config,
+                train_config,
+                train_batch_losses,
+                val_batch_losses,
+            )
+            if checkpointer is not None:
+                checkpointer.save(state)
+
         # Early stopping
         if train_config.early_stopping and _early_stop(
             patience, val_batch_losses, train_batch_losses
@@ -416,42 +685,313 @@ def train(
             break
 
         progress_bar.set_description(f"Val loss: {np.mean(val_batch_losses[-1]):.4f}")
+        progress_bar.set_postfix(
+            foreground=f"{np.mean(foreground_fraction):.3f}",
+            data_wait=f"{timing.data_wait:.1f}s",
+            compute=f"{timing.compute:.1f}s",
+        )
+
+    # Make sure the last checkpoint has been written
+    if checkpointer is not None:
+        checkpointer.wait()
 
     return net, train_batch_losses, val_batch_losses
 
 
+# The channel of the model's output that holds the object we're segmenting
+_FOREGROUND = 1
+
+
+def _foreground_probability(logits: torch.Tensor, activation: str) -> torch.Tensor:
+    """
+    The probability of the foreground class from the model's output, without
+    finding the probabilities of the other classes
+
+    :param logits: the model's output, with shape (batch, classes, *patch_size)
+    :param activation: the activation function, "softmax" or "sigmoid"
+
+    :returns: the probabilities, with shape (batch, 1, *patch_size)
+    :raises ValueError: for an unknown activation
+
+    """
+    foreground = logits[:, _FOREGROUND : _FOREGROUND + 1]
+    if activation == "softmax":
+        # The same as softmax(logits)[:, _FOREGROUND]
+        return torch.exp(foreground - torch.logsumexp(logits, dim=1, keepdim=True))
+    if activation == "sigmoid":
+        return torch.sigmoid(foreground)
+    raise ValueError(f"Unknown activation function: {activation}")
+
+
 def _predict_patches(
     net: torch.nn.Module,
-    patches: tio.data.sampler.PatchSampler,
+    patches: list[GridPatches],
+    accumulators: list[GridAccumulator],
+    *,
+    activation: str,
     batch_size: int = 1,
-) -> tuple[torch.Tensor, torch.Tensor]:
+    skip_threshold: float | None = None,
+) -> None:
     """
-    Make a prediction some patches
+    Make a prediction on the patches from some images, adding the foreground
+    probability for each batch to the right image's accumulator as we go
 
-    Returns the predictions and the locations of the patches
+    Batches are taken out of the images only when the model is ready for them, and
+    only the foreground channel is kept - so the memory we need depends on the batch
+    size, not on the number of patches. Batches can hold patches from several images.
 
-    """
-    tensors = []
-    locations = []
-    for patch in patches:
-        tensors.append(patch[tio.IMAGE][tio.DATA].unsqueeze(0))
-        locations.append(patch[tio.LOCATION])
+    Patches that are skipped aren't added to the accumulator at all, which is the
+    same as predicting zero foreground probability there.
 
-    device = next(net.parameters()).device
+    """
+    include = (
+        None
+        if skip_threshold is None
+        else [
+            torch.nonzero(grid.maxima() >= skip_threshold).flatten().tolist()
+            for grid in patches
+        ]
+    )
 
-    tensors = torch.cat(tensors, dim=0).to(device)
-    locations = torch.stack(locations)
+    # The model might be at a lower precision, e.g. from the inference model registry
+    parameter = next(net.parameters())
+    device, dtype = parameter.device, parameter.dtype
 
-    predictions = []
-    for i in range(0, len(tensors), batch_size):
-        batch = tensors[i : i + batch_size].to(device)
+    for batch, locations in pooled_batches(patches, batch_size, include):
         with torch.no_grad():
-            prediction = net(batch).to("cpu").detach()
-        predictions.append(prediction)
+            logits = net(batch.to(device=device, dtype=dtype)).float()
+            prediction = _foreground_probability(logits, activation)
+
+        for i, accumulator in enumerate(accumulators):
+            in_image = [k for k, (image, _) in enumerate(locations) if image == i]
+            if in_image:
+                accumulator.add(
+                    prediction[in_image], [locations[k][1] for k in in_image]
+                )
+
+
+def input_multiple(config: dict[str, Any]) -> int:
+    """
+    The network's input must be a multiple of this size along each axis, since it's
+    halved (or shrunk by `stride`) at each layer of the U-Net
+
+    :param config: the training config, with "model_params"
+    :returns: the multiple
+
+    """
+    params = config["model_params"]
+    return params["stride"] ** (params["n_layers"] - 1)
+
+
+def _out_of_memory(error: RuntimeError) -> bool:
+    """Whether an error is from running out of memory"""
+    return isinstance(error, torch.cuda.OutOfMemoryError) or any(
+        message in str(error) for message in ("out of memory", "not enough memory")
+    )
+
+
+def _available_memory(device: torch.device) -> int | None:
+    """
+    How many bytes are free on a device: free GPU memory, or for the CPU the
+    "MemAvailable" line of /proc/meminfo
+
+    :returns: the number of bytes, or None if we can't tell (e.g. not on Linux)
+
+    """
+    if device.type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    if device.type != "cpu":
+        return None
 
-    predictions = torch.cat(predictions, dim=0)
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _activation_memory(
+    net: torch.nn.Module, padded_shape: tuple[int, ...]
+) -> int | None:
+    """
+    A conservative estimate of how many bytes running the model on a whole image
+    needs for its activations
+
+    Every convolution is counted as if it ran at full resolution with as many
+    channels as the first one makes: input voxels x channels x depth. The deeper
+    layers of a U-Net have more channels but far fewer voxels, so this
+    overestimates, which is what we want.
+
+    :param net: the model
+    :param padded_shape: the spatial shape of the (padded) image
+    :returns: the estimate, or None if the model has no convolutions we can see
+              (e.g. one run by ONNX Runtime)
+
+    """
+    convs = [
+        module
+        for module in net.modules()
+        if isinstance(module, (torch.nn.Conv3d, torch.nn.ConvTranspose3d))
+    ]
+    if not convs:
+        return None
+
+    element_size = next(net.parameters()).element_size()
+    return (
+        int(np.prod(padded_shape)) * convs[0].out_channels * len(convs) * element_size
+    )
 
-    return predictions, locations
+
+def _fits_in_memory(net: torch.nn.Module, padded_shape: tuple[int, ...]) -> bool:
+    """
+    Whether the model can probably run on a whole image of this (padded) shape;
+    True if we can't tell
+
+    """
+    needed = _activation_memory(net, padded_shape)
+    available = _available_memory(next(net.parameters()).device)
+    return needed is None or available is None or needed <= available
+
+
+def _predict_whole(
+    net: torch.nn.Module, image: torch.Tensor, *, activation: str, pad_multiple: int
+) -> torch.Tensor:
+    """
+    Run the model on the whole image in one go, padding it (by repeating the edge
+    voxels) up to a size the model can take
+
+    :returns: the foreground probability, with the same spatial shape as the image
+
+    """
+    parameter = next(net.parameters())
+    spatial_shape = image.shape[1:]
+
+    # `pad` wants the padding for the last axis first
+    padding = [(-size) % pad_multiple for size in spatial_shape]
+    padded = torch.nn.functional.pad(
+        image.unsqueeze(0),
+        [p for pad in reversed(padding) for p in (0, pad)],
+        mode="replicate",
+    )
+
+    with torch.no_grad():
+        logits = net(padded.to(device=parameter.device, dtype=parameter.dtype)).float()
+        prediction = _foreground_probability(logits, activation)
+
+    return prediction[(0, 0, *(slice(size) for size in spatial_shape))].cpu()
+
+
+def predict_many(
+    net: torch.nn.Module,
+    subjects: list[tio.Subject],
+    *,
+    patch_size: tuple[int, int, int],
+    patch_overlap: tuple[int, int, int],
+    activation: str,
+    batch_size: int = 1,
+    accumulator_dtype: torch.dtype = torch.float32,
+    quantise: bool = False,
+    skip_threshold: float | None = None,
+    whole_window_multiple: int | None = None,
+) -> list[np.ndarray]:
+    """
+    Make predictions on several subjects at once, using the provided model
+
+    Like `predict`, but the patches from all the subjects are pooled together into
+    batches - so small images that only have a few patches each still make full
+    batches. The images can be different sizes.
+
+    :param net: the model to use
+    :param subjects: the subjects to predict on
+    :param patch_size: the size of the patches to use
+    :param patch_overlap: the overlap between patches. Uses a hann window
+    :param activation: the activation function to use
+    :param batch_size: the maximum number of patches that will be simultaneously sent to the model
+    :param accumulator_dtype: the type to stitch the predictions together in.
+                              torch.float16 halves the memory needed, and is plenty
+                              accurate for probabilities.
+    :param quantise: return the probabilities as uint8 (0-255) instead of floats
+    :param skip_threshold: don't run the model on patches where no voxel is at least
+                           this bright (e.g. only air and soft tissue, no bone);
+                           they're given zero foreground probability instead.
+                           None to run it on every patch
+    :param whole_window_multiple: if given, run the model on each whole image in one
+                                  go instead of in overlapping patches, padding it to
+                                  a multiple of this (e.g. from `input_multiple`).
+                                  This avoids running the model several times on
+                                  the overlaps. Images that don't fit in memory are
+                                  split into patches as usual: we estimate the memory
+                                  needed first, and also catch running out.
+
+    returns: the predictions, as 3d numpy arrays in the same order as `subjects`
+
+    """
+    assert activation in {"softmax", "sigmoid"}
+
+    images = [subject[tio.IMAGE][tio.DATA] for subject in subjects]
+    predictions: list[torch.Tensor | None] = [None] * len(images)
+
+    if whole_window_multiple is not None:
+        for i, image in enumerate(images):
+            padded_shape = tuple(
+                size + (-size) % whole_window_multiple for size in image.shape[1:]
+            )
+            if not _fits_in_memory(net, padded_shape):
+                warnings.warn(
+                    f"A whole {tuple(image.shape[1:])} image probably won't fit in"
+                    " memory; splitting it into patches instead"
+                )
+                continue
+
+            # The estimate can be wrong, so still fall back if we do run out
+            try:
+                predictions[i] = _predict_whole(
+                    net,
+                    image,
+                    activation=activation,
+                    pad_multiple=whole_window_multiple,
+                ).to(accumulator_dtype)
+            except RuntimeError as e:
+                if not _out_of_memory(e):
+                    raise
+                warnings.warn(
+                    f"Not enough memory to run the model on a whole {tuple(image.shape[1:])}"
+                    " image; splitting it into patches instead"
+                )
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+
+    # Everything else gets split into patches
+    to_tile = [i for i, prediction in enumerate(predictions) if prediction is None]
+    patches = [GridPatches(images[i], patch_size, patch_overlap) for i in to_tile]
+    accumulators = [
+        GridAccumulator(
+            1, grid.spatial_shape, patch_size, patch_overlap, dtype=accumulator_dtype
+        )
+        for grid in patches
+    ]
+
+    _predict_patches(
+        net,
+        patches,
+        accumulators,
+        activation=activation,
+        batch_size=batch_size,
+        skip_threshold=skip_threshold,
+    )
+    for i, accumulator in zip(to_tile, accumulators):
+        predictions[i] = accumulator.output()[0]
+
+    retval = []
+    for prediction in predictions:
+        if quantise:
+            prediction = prediction.mul_(255).round_().clamp_(0, 255).to(torch.uint8)
+        retval.append(prediction.numpy())
+
+    return retval
 
 
 def predict(
@@ -462,44 +1002,59 @@ def predict(
     patch_overlap: tuple[int, int, int],
     activation: str,
     batch_size: int = 1,
+    accumulator_dtype: torch.dtype = torch.float32,
+    quantise: bool = False,
+    skip_threshold: float | None = None,
+    whole_window_multiple: int | None = None,
 ) -> np.ndarray:
     """
     Make a prediction on a subject using the provided model
 
+    The image is split into a grid of overlapping patches (see `fishlib.model.grid`)
+    and the predictions on them are stitched back together as they're made.
+
     :param net: the model to use
     :param subject: the subject to predict on
     :param patch_size: the size of the patches to use
     :param patch_overlap: the overlap between patches. Uses a hann window
     :param activation: the activation function to use
     :param batch_size: the maximum number of patches that will be simultaneously sent to the model
+    :param accumulator_dtype: the type to stitch the predictions together in.
+                              torch.float16 halves the memory needed, and is plenty
+                              accurate for probabilities.
+    :param quantise: return the probabilities as uint8 (0-255) instead of floats
+    :param skip_threshold: don't run the model on patches where no voxel is at least
+                           this bright; see `predict_many`
+    :param whole_window_multiple: run the model on the whole image at once, padded to
+                                  a multiple of this; see `predict_many`
 
     returns: the prediction, as a 3d numpy array
 
     """
-    assert activation in {"softmax", "sigmoid"}
-
-    # Make predictions on the patches
-    sampler = tio.GridSampler(subject, patch_size, patch_overlap=patch_overlap)
-    prediction, locations = _predict_patches(net, sampler, batch_size)
-
-    # Apply the activation function
-    if activation == "softmax":
-        prediction = torch.nn.functional.softmax(prediction, dim=1)
-    elif activation == "sigmoid":
-        prediction = torch.sigmoid(prediction)
-    else:
-        raise ValueError(f"Unknown activation function: {activation}")
-
-    # Stitch them together
-    aggregator = tio.inference.GridAggregator(sampler=sampler, overlap_mode="hann")
-    aggregator.add_batch(prediction, locations=locations)
-
-    return aggregator.get_output_tensor()[1].numpy()
+    (prediction,) = predict_many(
+        net,
+        [subject],
+        patch_size=patch_size,
+        patch_overlap=patch_overlap,
+        activation=activation,
+        batch_size=batch_size,
+        accumulator_dtype=accumulator_dtype,
+        quantise=quantise,
+        skip_threshold=skip_threshold,
+        whole_window_multiple=whole_window_multiple,
+    )
+    return prediction
 
 
 def load_model(model_name: str) -> ModelState:
     """
-    Load a pickled model from disk given its name
+    Load a model from disk given its name
+
+    If there's an artifact next to the pickle (see `fishlib.model.artifact`), only
+    the weights (memory-mapped) and the config are read from it, and the optimiser
+    state is left out. Otherwise the pickle is read; so is it if the artifact is
+    older than the pickle, with a warning, since then the artifact is probably for
+    an earlier version of the model.
 
     :param model_name: the name of the model to load, e.g. "model_state.pkl", as specified
                        in userconf.yml. Must end in ".pkl".
@@ -513,5 +1068,16 @@ def load_model(model_name: str) -> ModelState:
     if not model_name.endswith(".pkl"):
         raise ValueError(f"Model name should end with .pkl: {model_name}")
 
-    with open(files.model_path({"model_path": model_name}), "rb") as f:
+    model_path = files.model_path({"model_path": model_name})
+    if artifact.is_stale(model_path):
+        warnings.warn(
+            f"The artifact for {model_name} is older than its pickle; reading the"
+            " pickle instead. Save a new artifact (scripts/convert_model.py) to use it"
+        )
+    elif artifact.paths(model_path).exists():
+        return ModelState(
+            artifact.load_weights(model_path), None, artifact.load_config(model_path)
+        )
+
+    with open(model_path, "rb") as f:
         return pickle.load(f)
@@ -0,0 +1,337 @@
+"""
+A bank of pre-augmented training patches, stored on disk
+
+When we train lots of models with the same data settings (e.g.
+`scripts/paper_scripts/train_lots_of_models.sh`), each one reads and augments the
+same volumes over and over again. Instead, we can generate a large (seeded) set of
+augmented patches once and then stream batches from it. The patches are stored in
+chunks of .npy files that are memory-mapped when reading, so several training runs
+reading the same bank at once will share the OS page cache.
+
+"""
+
+import json
+import hashlib
+import pathlib
+from typing import Any, Generator, Iterable
+
+import torch
+import numpy as np
+import torchio as tio
+from tqdm import tqdm
+
+MANIFEST = "manifest.json"
+"""Describes the contents of a patch bank; written last, so a bank without one is incomplete"""
+
+_METADATA_KEYS = (
+    "window_size",
+    "patch_size",
+    "foreground_ratio",
+    "patch_first_augmentation",
+    "transforms",
+    "dicom_dirs",
+    "validation_dicoms",
+    "test_dicoms",
+)
+"""The settings that change what's in a bank"""
+
+
+def metadata(config: dict[str, Any], seed: int) -> dict[str, Any]:
+    """
+    The settings that affect what's in a bank, to record in its manifest
+
+    :param config: the configuration the bank is made with
+    :param seed: the seed used to augment the patches
+
+    """
+    return {"seed": seed} | {
+        key: json.loads(json.dumps(config.get(key))) for key in _METADATA_KEYS
+    }
+
+
+def check_metadata(bank_dir: pathlib.Path, config: dict[str, Any]) -> None:
+    """
+    Check a bank was made with the same data and augmentation settings as a config
+
+    Banks written without any metadata aren't checked.
+
+    :param bank_dir: the bank
+    :param config: the configuration we're training with
+    :raises ValueError: if any of the settings are different
+
+    """
+    with open(bank_dir / MANIFEST, encoding="utf-8") as f:
+        recorded = json.load(f).get("metadata") or {}
+
+    expected = metadata(config, seed=0)
+    different = [
+        key
+        for key in _METADATA_KEYS
+        if key in recorded and recorded[key] != expected[key]
+    ]
+    if different:
+        raise ValueError(
+            f"Patch bank at {bank_dir} was made with different settings to the config: "
+            + "; ".join(
+                f"{key} is {recorded[key]} in the bank, {expected[key]} in the config"
+                for key in different
+            )
+        )
+
+
+def shuffle_seed(config: dict[str, Any]) -> int:
+    """
+    The seed for the order patches are read from a bank in
+
+    Derived from the model's name as well as `torch_seed`, so that models trained
+    from the same bank with the same config (e.g. repeats of one run) see the
+    patches in different orders, while re-running (or resuming) one model gives the
+    same order.
+
+    :param config: the configuration, with "torch_seed" and "model_path"
+
+    """
+    digest = hashlib.sha256(
+        f"{config['torch_seed']}:{config['model_path']}".encode()
+    ).digest()
+    return int.from_bytes(digest[:4], "little")
+
+
+def _chunk_paths(
+    bank_dir: pathlib.Path, chunk: int
+) -> tuple[pathlib.Path, pathlib.Path]:
+    """
+    The image and label files for a chunk
+
+    """
+    return bank_dir / f"images_{chunk:05d}.npy", bank_dir / f"labels_{chunk:05d}.npy"
+
+
+def write_patch_bank(
+    patches: Iterable[tio.Subject],
+    bank_dir: pathlib.Path,
+    *,
+    n_patches: int,
+    chunk_size: int,
+    image_dtype: np.dtype = np.float32,
+    metadata: dict[str, Any] | None = None,
+) -> None:
+    """
+    Write augmented patches to disk
+
+    :param patches: the patches, e.g. from a `tio.Queue`. Must be all the same size,
+                    and there must be at least `n_patches` of them
+    :param bank_dir: directory to write to. Must not already contain a bank
+    :param n_patches: how many patches to write
+    :param chunk_size: how many patches in each file
+    :param image_dtype: what to store the images as - e.g. float16 to halve the size
+    :param metadata: anything else to record in the manifest, e.g. the config used
+
+    :raises FileExistsError: if there's already a bank in the directory
+    :raises ValueError: if we ran out of patches
+
+    """
+    if (bank_dir / MANIFEST).exists():
+        raise FileExistsError(f"Patch bank already exists at {bank_dir}")
+    bank_dir.mkdir(parents=True, exist_ok=True)
+
+    patches = iter(patches)
+    image_shape = label_shape = None
+
+    for chunk, start in enumerate(
+        tqdm(range(0, n_patches, chunk_size), desc="Writing patch bank")
+    ):
+        size = min(chunk_size, n_patches - start)
+        images = labels = None
+
+        for i in range(size):
+            try:
+                patch = next(patches)
+            except StopIteration as e:
+                raise ValueError(f"Ran out of patches after {start + i}") from e
+
+            image = patch[tio.IMAGE][tio.DATA].numpy()
+            label = patch[tio.LABEL][tio.DATA].numpy()
+
+            # Allocate the chunk now that we know the shapes
+            if images is None:
+                image_shape, label_shape = image.shape, label.shape
+                image_path, label_path = _chunk_paths(bank_dir, chunk)
+                images = np.lib.format.open_memmap(
+                    image_path, mode="w+", dtype=image_dtype, shape=(size, *image_shape)
+                )
+                labels = np.lib.format.open_memmap(
+                    label_path, mode="w+", dtype=np.uint8, shape=(size, *label_shape)
+                )
+
+            images[i] = image
+            labels[i] = label
+
+        images.flush()
+        labels.flush()
+        del images, labels
+
+    with open(bank_dir / MANIFEST, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "n_patches": n_patches,
+                "chunk_size": chunk_size,
+                "image_shape": list(image_shape),
+                "label_shape": list(label_shape),
+                "image_dtype": np.dtype(image_dtype).name,
+                "metadata": metadata or {},
+            },
+            f,
+            indent=4,
+        )
+
+
+class PatchBank:
+    """
+    Read patches from a bank written by `write_patch_bank`
+
+    Nothing is read into memory until it's needed; the chunks are memory-mapped.
+
+    :param bank_dir: the directory holding the bank
+    :raises FileNotFoundError: if the bank is missing or incomplete
+
+    """
+
+    def __init__(self, bank_dir: pathlib.Path):
+        if not (bank_dir / MANIFEST).is_file():
+            raise FileNotFoundError(
+                f"No patch bank at {bank_dir} (or it didn't finish being written)"
+            )
+
+        with open(bank_dir / MANIFEST, encoding="utf-8") as f:
+            self.manifest = json.load(f)
+
+        self.chunk_size = self.manifest["chunk_size"]
+        n_chunks = -(-self.manifest["n_patches"] // self.chunk_size)
+
+        self._images, self._labels = [], []
+        for chunk in range(n_chunks):
+            image_path, label_path = _chunk_paths(bank_dir, chunk)
+            self._images.append(np.load(image_path, mmap_mode="r"))
+            self._labels.append(np.load(label_path, mmap_mode="r"))
+
+    @property
+    def patch_size(self) -> tuple[int, int, int]:
+        """The spatial size of the patches"""
+        return tuple(self.manifest["image_shape"][1:])
+
+    def __len__(self) -> int:
+        return self.manifest["n_patches"]
+
+    def __getitem__(self, index: int) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Get a patch
+
+        :returns: the image, as float32
+        :returns: the label
+
+        """
+        chunk, i = divmod(int(index), self.chunk_size)
+        return (
+            torch.from_numpy(self._images[chunk][i].astype(np.float32)),
+            torch.from_numpy(np.array(self._labels[chunk][i])),
+        )
+
+
+class PatchBankLoader:
+    """
+    Stream shuffled batches from a patch bank, in the same format as a
+    `tio.SubjectsLoader`
+
+    Each iteration (epoch) gives `n_batches` batches. We work through a random
+    permutation of the bank, carrying on from where we got to in the last epoch and
+    re-shuffling when we get to the end - so every patch is used before any is
+    repeated, but an epoch doesn't have to be the whole bank.
+
+    If we're training on several processes, they should all use the same seed; each
+    one then takes its share of every batch, so that no patch is used twice at once.
+
+    :param bank: the patches
+    :param batch_size: how many patches in each batch (on this process)
+    :param n_batches: how many batches in each epoch
+    :param seed: seed for the shuffling
+    :param rank: which process this is, if there are several
+    :param world_size: how many processes there are
+
+    """
+
+    def __init__(
+        self,
+        bank: PatchBank,
+        batch_size: int,
+        n_batches: int,
+        seed: int = 0,
+        *,
+        rank: int = 0,
+        world_size: int = 1,
+    ):
+        if batch_size * world_size > len(bank):
+            raise ValueError(
+                f"Batch size {batch_size} x {world_size} processes is bigger than the"
+                f" bank ({len(bank)} patches)"
+            )
+
+        self.bank = bank
+        self.batch_size = batch_size
+        self.n_batches = n_batches
+        self.rank = rank
+        self.world_size = world_size
+
+        self._generator = torch.Generator().manual_seed(seed)
+        self._order = torch.randperm(len(bank), generator=self._generator)
+        self._position = 0
+
+    def _next_indices(self) -> torch.Tensor:
+        """
+        The indices of the patches in the next batch
+
+        """
+        # Batch size across all processes
+        total = self.batch_size * self.world_size
+
+        if self._position + total > len(self._order):
+            self._order = torch.randperm(len(self.bank), generator=self._generator)
+            self._position = 0
+
+        indices = self._order[self._position : self._position + total]
+        indices = indices[self.rank :: self.world_size]
+        self._position += total
+
+        # Read in order, since that's friendlier to the disk
+        return torch.sort(indices).values
+
+    def state_dict(self) -> dict[str, Any]:
+        """
+        Where we've got to in the shuffled bank, so that training can be resumed
+
+        """
+        return {
+            "generator": self._generator.get_state(),
+            "order": self._order.clone(),
+            "position": self._position,
+        }
+
+    def load_state_dict(self, state: dict[str, Any]) -> None:
+        """
+        Carry on from a state given by `state_dict`
+
+        """
+        self._generator.set_state(state["generator"])
+        self._order = state["order"].clone()
+        self._position = state["position"]
+
+    def __len__(self) -> int:
+        return self.n_batches
+
+    def __iter__(self) -> Generator[dict[str, dict[str, torch.Tensor]], None, None]:
+        for _ in range(self.n_batches):
+            images, labels = zip(*(self.bank[i] for i in self._next_indices()))
+            yield {
+                tio.IMAGE: {tio.DATA: torch.stack(images)},
+                tio.LABEL: {tio.DATA: torch.stack(labels)},
+            }
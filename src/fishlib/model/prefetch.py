@@ -0,0 +1,193 @@
+"""
+Get training batches ready in the background
+
+Without this, each training iteration waits for the next batch to come out of the
+dataloader, then waits for it to be copied to the GPU, and only then runs the model.
+The `Prefetcher` here reads batches in a background thread and (if we're using a GPU)
+copies them over on a separate CUDA stream, so that this overlaps with the model
+running on the previous batch.
+
+"""
+
+import time
+import queue
+import itertools
+import threading
+from dataclasses import dataclass
+from typing import Any, Generator, Iterable
+
+import torch
+import torchio as tio
+
+from .sampling import batch_foreground_fraction
+
+
+@dataclass
+class PrefetchedBatch:
+    """A training batch, ready to use"""
+
+    image: torch.Tensor
+    label: torch.Tensor
+
+    # Fraction of foreground voxels in the label, found in the background
+    foreground_fraction: float
+
+    # If the batch was copied on a side stream, the main stream needs to wait for this
+    ready: torch.cuda.Event | None = None
+
+
+@dataclass
+class EpochTiming:
+    """How long we spent waiting for data and doing everything else in an epoch"""
+
+    data_wait: float
+    compute: float
+
+
+_DONE = object()
+"""Put on the queue when there are no more batches"""
+
+
+class Prefetcher:
+    """
+    Iterate over a dataloader in a background thread, keeping the next few batches
+    ready to go
+
+    Batches are pinned and copied to the device ahead of time if the device is a GPU;
+    on the CPU they're just passed through. Exceptions in the background thread are
+    re-raised when the batch they happened on is reached.
+
+    :param loader: the batches, in the format given by a `tio.SubjectsLoader`
+    :param device: the device the batches will be used on
+    :param depth: how many batches to keep ready. If 0, batches are read when
+                  they're needed, without a background thread.
+    :param n_batches: only read this many batches from the loader each pass, e.g. if
+                      the last few won't be used. Nothing past them is read, so the
+                      loader (e.g. a `PatchBankLoader`) carries on from the same place
+                      however far ahead the background thread had got. None for all
+                      of them
+
+    """
+
+    def __init__(
+        self,
+        loader: Iterable[dict[str, dict[str, torch.Tensor]]],
+        device: torch.device | str,
+        depth: int = 2,
+        n_batches: int | None = None,
+    ):
+        if depth < 0:
+            raise ValueError(f"depth must be non-negative, got {depth}")
+
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.n_batches = n_batches
+
+        # How long we spent waiting for batches in the last pass through the loader
+        self.wait_time = 0.0
+
+    def _prepare(
+        self,
+        batch: dict[str, dict[str, torch.Tensor]],
+        stream: torch.cuda.Stream | None,
+    ) -> PrefetchedBatch:
+        """
+        Do the host-side work for a batch and start copying it to the device
+
+        """
+        x, y = batch[tio.IMAGE][tio.DATA], batch[tio.LABEL][tio.DATA]
+        foreground_fraction = batch_foreground_fraction(y)
+
+        if stream is None:
+            return PrefetchedBatch(
+                x.to(self.device), y.to(self.device), foreground_fraction
+            )
+
+        with torch.cuda.stream(stream):
+            x = x.pin_memory().to(self.device, non_blocking=True)
+            y = y.pin_memory().to(self.device, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record(stream)
+
+        return PrefetchedBatch(x, y, foreground_fraction, ready)
+
+    def _fill(self, batches: queue.Queue, stop: threading.Event) -> None:
+        """
+        Read batches into the queue until we run out, or we're told to stop
+
+        """
+
+        def put(item: Any) -> bool:
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        try:
+            for batch in itertools.islice(self.loader, self.n_batches):
+                if not put(self._prepare(batch, stream)):
+                    return
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            put(e)
+            return
+        put(_DONE)
+
+    def _synchronous(self) -> Generator[PrefetchedBatch, None, None]:
+        """
+        Read batches as they're needed, without a background thread
+
+        """
+        batches = itertools.islice(self.loader, self.n_batches)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = self._prepare(next(batches), None)
+            except StopIteration:
+                return
+            finally:
+                self.wait_time += time.perf_counter() - start
+            yield batch
+
+    def __len__(self) -> int:
+        if self.n_batches is None:
+            return len(self.loader)
+        return min(len(self.loader), self.n_batches)
+
+    def __iter__(self) -> Generator[PrefetchedBatch, None, None]:
+        self.wait_time = 0.0
+        if self.depth == 0:
+            yield from self._synchronous()
+            return
+
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._fill, args=(batches, stop), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                self.wait_time += time.perf_counter() - start
+
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+
+                # Make sure the copy has finished before we use the batch, and that
+                # the memory isn't re-used before the main stream is done with it
+                if item.ready is not None:
+                    item.ready.wait()
+                    item.image.record_stream(torch.cuda.current_stream())
+                    item.label.record_stream(torch.cuda.current_stream())
+
+                yield item
+        finally:
+            stop.set()
+            thread.join()
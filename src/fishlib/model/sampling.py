@@ -0,0 +1,331 @@
+"""
+Choosing where to take training patches from
+
+Patches drawn uniformly from the window often don't contain much of the jaw, so
+we waste a lot of compute on them. The samplers here use a coarse map of how much
+foreground (label) there would be in a patch starting at each location, so that we
+can choose what fraction of patches contain some foreground.
+
+"""
+
+from typing import Generator
+
+import torch
+import torchio as tio
+
+DENSITY_KEY = "foreground_density"
+"""Where the foreground density map is cached in a Subject"""
+
+
+def jitter_size(patch_size: tuple[int, int, int], downsample: int) -> list[int]:
+    """
+    How far a patch can be moved from its place on the coarse grid along each axis:
+    anywhere within the block, but never by a whole patch
+
+    """
+    return [min(downsample, p) for p in patch_size]
+
+
+def foreground_density(
+    label: torch.Tensor, patch_size: tuple[int, int, int], downsample: int
+) -> torch.Tensor:
+    """
+    Find the fraction of foreground voxels in a patch starting at each location
+    on a coarse grid.
+
+    A patch starting at a grid point might then be moved by up to `downsample` - 1
+    voxels (see `jitter_size`), so we only count the voxels that the patch covers
+    wherever it ends up: from the last place it could start to the end of the patch
+    at the grid point. Any non-zero density means the patch contains some foreground,
+    however it's moved. Foreground within a block of the edges of the label might not
+    be counted for any patch, and nor might some in between if the patch is smaller
+    than two blocks across (the counted regions then don't overlap). The counts come from a summed-area table, so this costs the
+    same however big the patch is.
+
+    :param label: the label, shape (C, Z, Y, X). Anything non-zero is foreground
+    :param patch_size: the size of the patches that will be drawn
+    :param downsample: the grid spacing; patches start near multiples of this
+
+    :returns: the foreground fraction of the counted region for a patch starting at
+              each multiple of `downsample`, shape (Z', Y', X')
+    :raises ValueError: if the patch is larger than the label
+
+    """
+    spatial_shape = label.shape[1:]
+    if any(p > s for p, s in zip(patch_size, spatial_shape)):
+        raise ValueError(f"Patch {patch_size} larger than label {spatial_shape}")
+
+    # Summed area table, padded with zeros at the start so that we can take differences
+    foreground = (label > 0).any(dim=0).to(torch.int32)
+    table = torch.nn.functional.pad(
+        foreground.cumsum(0, dtype=torch.int32)
+        .cumsum(1, dtype=torch.int32)
+        .cumsum(2, dtype=torch.int32),
+        (1, 0, 1, 0, 1, 0),
+    )
+
+    # Number of places a patch can start, and the region we count for each of them
+    n_starts = [(s - p) // downsample + 1 for s, p in zip(spatial_shape, patch_size)]
+    jitter = jitter_size(patch_size, downsample)
+    starts = [torch.arange(n) * downsample + j - 1 for n, j in zip(n_starts, jitter)]
+    ends = [torch.arange(n) * downsample + p for n, p in zip(n_starts, patch_size)]
+
+    def corner(z: torch.Tensor, y: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+        return table[z[:, None, None], y[None, :, None], x[None, None, :]]
+
+    (z0, y0, x0), (z1, y1, x1) = starts, ends
+    counts = (
+        corner(z1, y1, x1)
+        - corner(z0, y1, x1)
+        - corner(z1, y0, x1)
+        - corner(z1, y1, x0)
+        + corner(z0, y0, x1)
+        + corner(z0, y1, x0)
+        + corner(z1, y0, x0)
+        - corner(z0, y0, x0)
+    )
+
+    n_counted = 1
+    for p, j in zip(patch_size, jitter):
+        n_counted *= p - j + 1
+    return counts / n_counted
+
+
+class ForegroundLocations:
+    """
+    Choose patch locations so that a given fraction of them contain some foreground
+
+    Patches chosen to contain foreground always do. Patches chosen not to might
+    still have some near their edges, since the density map only counts the part of
+    the patch that's covered wherever in its block the patch is moved to.
+
+    :param foreground_ratio: the probability that a patch contains foreground.
+                             The rest are drawn from locations with no foreground.
+                             If there are no locations of the requested type, we draw
+                             from anywhere.
+    :param downsample: the coarse grid spacing used for the density map
+    :param cache: whether to store the density map in the subject and re-use it.
+                  This is only valid if the label doesn't change between calls -
+                  i.e. if we're choosing the patch before any spatial augmentation.
+    :param generator: where to draw the random numbers from. The global generator
+                      if None
+
+    """
+
+    def __init__(
+        self,
+        foreground_ratio: float,
+        downsample: int = 4,
+        cache=True,
+        generator: torch.Generator | None = None,
+    ):
+        if not 0 <= foreground_ratio <= 1:
+            raise ValueError(
+                f"foreground_ratio must be in [0, 1], got {foreground_ratio}"
+            )
+
+        self.foreground_ratio = foreground_ratio
+        self.downsample = downsample
+        self.cache = cache
+        self.generator = generator
+
+    def density(
+        self, subject: tio.Subject, patch_size: tuple[int, int, int]
+    ) -> torch.Tensor:
+        """
+        Get the density map for a subject, calculating it if necessary
+
+        """
+        if self.cache and DENSITY_KEY in subject:
+            return subject[DENSITY_KEY]
+
+        density = foreground_density(
+            subject[tio.LABEL][tio.DATA], patch_size, self.downsample
+        )
+        if self.cache:
+            subject[DENSITY_KEY] = density
+
+        return density
+
+    def __call__(
+        self, subject: tio.Subject, patch_size: tuple[int, int, int]
+    ) -> tuple[int, int, int]:
+        """
+        Choose the start of a patch
+
+        :param subject: the subject to draw from; must have a label
+        :param patch_size: the size of the patch
+
+        :returns: index of the first voxel in the patch
+
+        """
+        return self.choose(
+            self.density(subject, patch_size), subject.spatial_shape, patch_size
+        )
+
+    def choose(
+        self,
+        density: torch.Tensor,
+        spatial_shape: tuple[int, int, int],
+        patch_size: tuple[int, int, int],
+    ) -> tuple[int, int, int]:
+        """
+        Choose the start of a patch from a density map we've already got, e.g. to
+        draw several patches from a subject without finding the map each time
+
+        :param density: the subject's density map, from `density`
+        :param spatial_shape: the shape of the subject
+        :param patch_size: the size of the patch
+
+        :returns: index of the first voxel in the patch
+
+        """
+        want_foreground = (
+            torch.rand(1, generator=self.generator).item() < self.foreground_ratio
+        )
+        candidates = torch.nonzero((density > 0) == want_foreground)
+        if not len(candidates):
+            candidates = torch.nonzero(torch.ones_like(density, dtype=torch.bool))
+
+        coarse = candidates[
+            torch.randint(len(candidates), (1,), generator=self.generator).item()
+        ]
+
+        # Jitter within the block so we can start anywhere, not just on the grid. The
+        # density only counts the voxels the patch covers however far it's moved
+        jitter = torch.stack(
+            [
+                torch.randint(n, (1,), generator=self.generator)[0]
+                for n in jitter_size(patch_size, self.downsample)
+            ]
+        )
+        max_start = torch.tensor(spatial_shape) - torch.tensor(patch_size)
+
+        return tuple(
+            int(x) for x in torch.minimum(coarse * self.downsample + jitter, max_start)
+        )
+
+
+def add_foreground_density(
+    subjects: list[tio.Subject],
+    patch_size: tuple[int, int, int],
+    locations: ForegroundLocations,
+) -> None:
+    """
+    Calculate the foreground density map for each subject up front, so that it
+    only happens once (instead of once per subject per epoch in each worker)
+
+    :param subjects: the subjects. Modified in place
+    :param patch_size: the size of the patches that will be drawn
+    :param locations: the location chooser that will use the maps
+
+    """
+    for subject in subjects:
+        locations.density(subject, patch_size)
+
+
+def batch_foreground_fraction(label: torch.Tensor) -> float:
+    """
+    The fraction of foreground voxels in a batch of labels
+
+    """
+    return (label > 0).to(torch.float32).mean().item()
+
+
+class _PatchSampler(tio.data.PatchSampler):
+    """
+    A `tio.data.PatchSampler` that cuts out patches without touching the global
+    random number generator: every torchio transform, even `tio.Crop`, draws a random
+    number to decide whether to run when it's called
+
+    """
+
+    def crop(
+        self,
+        subject: tio.Subject,
+        index_ini: tuple[int, int, int],
+        patch_size: tuple[int, int, int],
+    ) -> tio.Subject:
+        # Crop copies the patch, so the subject isn't changed
+        patch = self._get_crop_transform(
+            subject, index_ini, patch_size
+        ).apply_transform(subject)
+        patch[tio.LOCATION] = torch.as_tensor(
+            [*index_ini, *(i + p for i, p in zip(index_ini, patch_size))]
+        )
+        patch.update_attributes()
+        return patch
+
+
+class ForegroundSampler(_PatchSampler):
+    """
+    Draw patches from a subject, choosing the location with a `ForegroundLocations`
+
+    The density map is found once each time patches are drawn from a subject (e.g.
+    once per subject per queue fill), even if the locations don't cache it.
+
+    :param patch_size: the size of the patches
+    :param locations: how to choose where the patches come from
+
+    """
+
+    def __init__(
+        self, patch_size: tuple[int, int, int], locations: ForegroundLocations
+    ):
+        super().__init__(patch_size)
+        self.locations = locations
+
+    def _generate_patches(
+        self, subject: tio.Subject, num_patches: int | None = None
+    ) -> Generator[tio.Subject, None, None]:
+        patch_size = tuple(int(x) for x in self.patch_size)
+
+        # Only find the density map once for all the patches from this subject, even
+        # if the locations don't cache it in the subject
+        density = self.locations.density(subject, patch_size)
+
+        patches_left = num_patches if num_patches is not None else True
+        while patches_left:
+            index = self.locations.choose(density, subject.spatial_shape, patch_size)
+
+            patch = self.extract_patch(subject, index)
+            patch.pop(DENSITY_KEY, None)
+            yield patch
+
+            if num_patches is not None:
+                patches_left -= 1
+
+
+class UniformSampler(_PatchSampler):
+    """
+    Draw patches from anywhere in a subject, like `tio.UniformSampler`, but with the
+    random numbers drawn from a generator of our own
+
+    :param patch_size: the size of the patches
+    :param generator: where to draw the random numbers from. The global generator
+                      if None
+
+    """
+
+    def __init__(
+        self,
+        patch_size: tuple[int, int, int],
+        generator: torch.Generator | None = None,
+    ):
+        super().__init__(patch_size)
+        self.generator = generator
+
+    def _generate_patches(
+        self, subject: tio.Subject, num_patches: int | None = None
+    ) -> Generator[tio.Subject, None, None]:
+        valid_range = subject.spatial_shape - self.patch_size
+        patches_left = num_patches if num_patches is not None else True
+        while patches_left:
+            index = tuple(
+                int(torch.randint(x + 1, (1,), generator=self.generator).item())
+                for x in valid_range
+            )
+            yield self.extract_patch(subject, index)
+
+            if num_patches is not None:
+                patches_left -= 1
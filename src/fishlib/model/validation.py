@@ -0,0 +1,267 @@
+"""
+A fixed set of validation patches
+
+Drawing new random validation patches every epoch makes the validation loss noisy
+(so it's hard to compare between epochs, e.g. for early stopping) and means we pay
+the data loading cost every epoch. Instead, we can extract a fixed set of patches
+once and keep them in one big tensor.
+
+"""
+
+import pathlib
+import tempfile
+import itertools
+import weakref
+from typing import Any, Generator
+
+import torch
+import numpy as np
+import torchio as tio
+
+
+def grid_starts(
+    spatial_shape: tuple[int, int, int],
+    patch_size: tuple[int, int, int],
+    patch_overlap: tuple[int, int, int] = (0, 0, 0),
+) -> list[tuple[int, int, int]]:
+    """
+    The start of each patch in a grid covering an image, in the same order as
+    `tio.GridSampler` - the last patch along each axis is moved back so that it
+    ends at the edge of the image.
+
+    :param spatial_shape: the shape of the image
+    :param patch_size: the size of each patch
+    :param patch_overlap: how much neighbouring patches overlap
+
+    :returns: the index of the first voxel in each patch
+    :raises ValueError: if the patch is larger than the image, or if the overlap
+                        is not smaller than the patch
+
+    """
+    starts = []
+    for length, size, overlap in zip(spatial_shape, patch_size, patch_overlap):
+        if size > length:
+            raise ValueError(f"Patch {patch_size} larger than image {spatial_shape}")
+        if overlap >= size:
+            raise ValueError(
+                f"Overlap {patch_overlap} must be smaller than {patch_size}"
+            )
+
+        axis_starts = list(range(0, length - size + 1, size - overlap))
+        if axis_starts[-1] != length - size:
+            axis_starts.append(length - size)
+        starts.append(axis_starts)
+
+    return list(itertools.product(*starts))
+
+
+def random_starts(
+    spatial_shape: tuple[int, int, int],
+    patch_size: tuple[int, int, int],
+    n_patches: int,
+    generator: torch.Generator,
+) -> list[tuple[int, int, int]]:
+    """
+    The start of some randomly (uniformly) placed patches
+
+    :param spatial_shape: the shape of the image
+    :param patch_size: the size of each patch
+    :param n_patches: how many patches
+    :param generator: source of randomness, so that we can get the same patches again
+
+    :returns: the index of the first voxel in each patch
+
+    """
+    return [
+        tuple(
+            int(torch.randint(s - p + 1, (1,), generator=generator).item())
+            for s, p in zip(spatial_shape, patch_size)
+        )
+        for _ in range(n_patches)
+    ]
+
+
+def _remove(path: pathlib.Path) -> None:
+    """
+    Delete a memory-mapped file, and the directory it's in if that's now empty
+
+    """
+    path.unlink(missing_ok=True)
+    try:
+        path.parent.rmdir()
+    except OSError:
+        pass
+
+
+def _allocate(
+    shape: tuple[int, ...], dtype: torch.dtype, memmap_path: pathlib.Path | None
+) -> torch.Tensor:
+    """
+    Allocate an empty tensor, either in memory or backed by a file on disk
+
+    The file is deleted once nothing is using the tensor any more (or when we exit).
+
+    """
+    if memmap_path is None:
+        return torch.empty(shape, dtype=dtype)
+
+    array = np.lib.format.open_memmap(
+        memmap_path,
+        mode="w+",
+        dtype=torch.empty(0, dtype=dtype).numpy().dtype,
+        shape=shape,
+    )
+    weakref.finalize(array, _remove, memmap_path)
+    return torch.from_numpy(array)
+
+
+class ValidationPatches:
+    """
+    A fixed set of validation patches, stored as contiguous tensors.
+
+    Iterating over this gives batches in the same format as a `tio.SubjectsLoader`,
+    so it can be used in place of one for validation.
+
+    :param images: image patches, shape (N, C, Z, Y, X)
+    :param labels: label patches, shape (N, C, Z, Y, X)
+    :param batch_size: how many patches in each batch
+
+    """
+
+    def __init__(self, images: torch.Tensor, labels: torch.Tensor, batch_size: int):
+        if len(images) != len(labels):
+            raise ValueError(f"Got {len(images)} images but {len(labels)} labels")
+
+        self.images = images
+        self.labels = labels
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_subjects(
+        cls,
+        subjects: tio.SubjectsDataset,
+        patch_size: tuple[int, int, int],
+        *,
+        mode: str,
+        batch_size: int,
+        n_random: int = 8,
+        seed: int = 0,
+        memmap_dir: pathlib.Path | None = None,
+    ) -> "ValidationPatches":
+        """
+        Extract the patches from some subjects. Any transforms in the dataset are
+        not applied, since we want the validation patches to be the same every time.
+
+        :param subjects: the validation subjects
+        :param patch_size: size of the patches
+        :param mode: "grid" to cover each subject with a grid of patches or "random"
+                     to take `n_random` randomly placed patches from each
+        :param batch_size: how many patches in each batch
+        :param n_random: how many random patches to take from each subject
+        :param seed: seed for choosing the random patches
+        :param memmap_dir: if provided, the patches are stored in .npy files in a new
+                           directory inside this one and memory-mapped instead of
+                           kept in memory. They're deleted when no longer needed
+
+        :returns: the validation patches
+        :raises ValueError: if the mode isn't recognised
+
+        """
+        generator = torch.Generator().manual_seed(seed)
+
+        locations = []
+        subject_list = list(subjects.dry_iter())
+        for subject in subject_list:
+            if mode == "grid":
+                starts = grid_starts(subject.spatial_shape, patch_size)
+            elif mode == "random":
+                starts = random_starts(
+                    subject.spatial_shape, patch_size, n_random, generator
+                )
+            else:
+                raise ValueError(f"mode must be 'grid' or 'random', not {mode}")
+            locations.extend((subject, start) for start in starts)
+
+        # Each run gets its own directory, so runs (or processes) sharing a
+        # `memmap_dir` don't write over each other's patches
+        if memmap_dir is not None:
+            memmap_dir.mkdir(parents=True, exist_ok=True)
+            memmap_dir = pathlib.Path(tempfile.mkdtemp(prefix="val_", dir=memmap_dir))
+
+        tensors = {}
+        for key in (tio.IMAGE, tio.LABEL):
+            example = subject_list[0][key][tio.DATA]
+            tensors[key] = _allocate(
+                (len(locations), example.shape[0], *patch_size),
+                example.dtype,
+                None if memmap_dir is None else memmap_dir / f"val_{key}.npy",
+            )
+
+            for i, (subject, (z, y, x)) in enumerate(locations):
+                tensors[key][i] = subject[key][tio.DATA][
+                    :,
+                    z : z + patch_size[0],
+                    y : y + patch_size[1],
+                    x : x + patch_size[2],
+                ]
+
+        return cls(tensors[tio.IMAGE], tensors[tio.LABEL], batch_size)
+
+    def shard(self, rank: int, world_size: int) -> "ValidationPatches":
+        """
+        Take every `world_size`th patch, starting at `rank` - so that several
+        processes can each find the loss on their share of the patches
+
+        :param rank: which share to take
+        :param world_size: how many shares to split the patches into
+
+        :returns: the patches in this share
+
+        """
+        if world_size == 1:
+            return self
+        return ValidationPatches(
+            self.images[rank::world_size],
+            self.labels[rank::world_size],
+            self.batch_size,
+        )
+
+    def __len__(self) -> int:
+        """Number of batches"""
+        return -(-len(self.images) // self.batch_size)
+
+    def __iter__(self) -> Generator[dict[str, dict[str, torch.Tensor]], None, None]:
+        for i in range(0, len(self.images), self.batch_size):
+            yield {
+                tio.IMAGE: {tio.DATA: self.images[i : i + self.batch_size]},
+                tio.LABEL: {tio.DATA: self.labels[i : i + self.batch_size]},
+            }
+
+
+def validation_options(config: dict[str, Any]) -> dict[str, Any]:
+    """
+    Get the validation options from the config, filling in the defaults for
+    anything that's missing (e.g. if the config is from an old model)
+
+    The defaults are the same as in userconf.yml: one fixed, seeded random patch from
+    each validation image (mode "random"). Before the other modes existed we drew new
+    random patches every epoch; set the mode to "queue" to get that back.
+
+    :param config: the configuration, e.g. from userconf.yml
+    :returns: the options
+
+    """
+    options = {
+        "patches": "random",
+        "n_random": 1,
+        "seed": 0,
+        "batch_size": config["batch_size"],
+        "every": 1,
+        "autocast": False,
+        "memmap_dir": None,
+    }
+    options.update(config.get("validation") or {})
+    if options["batch_size"] is None:
+        options["batch_size"] = config["batch_size"]
+
+    return options
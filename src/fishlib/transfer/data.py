@@ -127,8 +127,10 @@ def quadrate_data(
 
     # Create datasets
     train_subjects = tio.SubjectsDataset(
-        subjects[:-2], transform=data._transforms(config["transforms"])
+        subjects[:-2], transform=data.augmentation(config)
     )
+    # Patch-first augmentation would crop these to a patch, so the validation data
+    # always gets the ordinary transforms
     val_subjects = tio.SubjectsDataset(
         subjects[-2:-1], transform=data._transforms(config["transforms"])
     )
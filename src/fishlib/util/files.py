@@ -214,6 +214,17 @@ def jaw_locator_model_path(model_name: str) -> pathlib.Path:
     return script_out_dir() / "jaw_location" / model_name / f"{model_name}.pth"
 
 
+def execution_profile_path() -> pathlib.Path:
+    """
+    Get the path to the execution profile saved for this machine by
+    `scripts/benchmarks/execution_profiles.py`
+
+    :returns: path to the JSON file. Might not exist
+
+    """
+    return script_out_dir() / "execution_profile.json"
+
+
 def model_path(config: dict[str, Any]) -> pathlib.Path:
     """
     Get the path to the jaw segmentation model, as created by scripts/2-train_jaw_segmenter.py.
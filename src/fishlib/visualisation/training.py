@@ -54,3 +54,59 @@ def plot_losses(
 
     fig.tight_layout()
     return fig
+
+
+def plot_foreground_fractions(
+    foreground_fractions: list[list[float]],
+) -> matplotlib.figure.Figure:
+    """
+    Plot the fraction of foreground voxels in the training batches against epoch
+
+    :param foreground_fractions: list of lists of floats, the foreground fraction in
+                                 each batch for each epoch
+
+    """
+    fig, axis = plt.subplots()
+
+    epochs = np.arange(len(foreground_fractions))
+    axis.plot(epochs, [np.mean(epoch) for epoch in foreground_fractions], color="C0")
+    axis.fill_between(
+        epochs,
+        [np.min(epoch) for epoch in foreground_fractions],
+        [np.max(epoch) for epoch in foreground_fractions],
+        alpha=0.5,
+        color="C0",
+    )
+
+    axis.set_title("Foreground fraction per batch")
+    axis.set_xlabel("Epoch")
+
+    fig.tight_layout()
+    return fig
+
+
+def plot_epoch_timings(
+    data_wait: list[float], compute: list[float]
+) -> matplotlib.figure.Figure:
+    """
+    Plot how long each training epoch spent waiting for data, and how long it spent
+    doing everything else (mostly running the model)
+
+    :param data_wait: time spent waiting for batches in each epoch, in seconds
+    :param compute: the rest of the time in each epoch, in seconds
+
+    """
+    fig, axis = plt.subplots()
+
+    epochs = np.arange(len(data_wait))
+    axis.stackplot(
+        epochs, compute, data_wait, labels=["Compute", "Data wait"], colors=["C0", "C1"]
+    )
+
+    axis.set_title("Epoch time")
+    axis.set_xlabel("Epoch")
+    axis.set_ylabel("Time /s")
+    axis.legend()
+
+    fig.tight_layout()
+    return fig
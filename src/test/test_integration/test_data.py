@@ -1,6 +1,10 @@
 """Tests for data related utilities"""
 
-from fishlib.model import data
+import pytest
+import torch
+import torchio as tio
+
+from fishlib.model import data, augmentation, patch_bank
 
 
 def test_get_transforms():
@@ -22,3 +26,125 @@ def test_get_transforms():
     assert transform.probability == 0.25
     assert transform.degrees == (-10, 10, -10, 10, -10, 10)
     assert transform.scales == (0.8, 1.2, 0.8, 1.2, 0.8, 1.2)
+
+
+def test_patch_first_affine():
+    """
+    Check that resampling only the patch gives the same result as transforming
+    the whole image and then cropping
+
+    """
+    torch.manual_seed(0)
+    image = torch.rand(1, 20, 18, 16)
+    label = (torch.rand(1, 20, 18, 16) > 0.5).to(torch.uint8)
+
+    def subject() -> tio.Subject:
+        return tio.Subject(
+            image=tio.ScalarImage(tensor=image.clone()),
+            label=tio.LabelMap(tensor=label.clone()),
+        )
+
+    affine = tio.Affine(scales=(0.9, 1.1, 1.0), degrees=(7, -4, 9), translation=0)
+
+    whole = affine(subject())
+    patch = augmentation.resample_patch(affine, subject(), (3, 2, 4), (12, 14, 10))
+
+    assert patch.spatial_shape == (12, 14, 10)
+    for key in ("image", "label"):
+        assert torch.allclose(
+            patch[key].data, whole[key].data[:, 3:15, 2:16, 4:14], atol=1e-6
+        )
+
+
+def test_patch_bank(tmp_path):
+    """
+    Check patches come back out of the bank the same as they went in, and that
+    every patch is used before any are repeated
+
+    """
+    subjects = [
+        tio.Subject(
+            image=tio.ScalarImage(tensor=torch.full((1, 4, 4, 4), float(i))),
+            label=tio.LabelMap(tensor=torch.full((1, 4, 4, 4), i % 2)),
+        )
+        for i in range(10)
+    ]
+    patch_bank.write_patch_bank(subjects, tmp_path, n_patches=10, chunk_size=4)
+
+    bank = patch_bank.PatchBank(tmp_path)
+    assert len(bank) == 10
+    assert bank.patch_size == (4, 4, 4)
+
+    image, label = bank[6]
+    assert torch.equal(image, torch.full((1, 4, 4, 4), 6.0))
+    assert torch.equal(label, torch.zeros((1, 4, 4, 4), dtype=torch.uint8))
+
+    loader = patch_bank.PatchBankLoader(bank, batch_size=2, n_batches=5)
+    seen = [
+        int(x) for batch in loader for x in batch[tio.IMAGE][tio.DATA][:, 0, 0, 0, 0]
+    ]
+    assert sorted(seen) == list(range(10))
+
+
+def test_patch_bank_ranks(tmp_path):
+    """
+    Check that processes sharing a patch bank get different patches from each other
+
+    """
+    subjects = [
+        tio.Subject(
+            image=tio.ScalarImage(tensor=torch.full((1, 4, 4, 4), float(i))),
+            label=tio.LabelMap(tensor=torch.zeros((1, 4, 4, 4), dtype=torch.uint8)),
+        )
+        for i in range(12)
+    ]
+    patch_bank.write_patch_bank(subjects, tmp_path, n_patches=12, chunk_size=5)
+    bank = patch_bank.PatchBank(tmp_path)
+
+    seen = []
+    for rank in range(3):
+        loader = patch_bank.PatchBankLoader(
+            bank, batch_size=2, n_batches=2, rank=rank, world_size=3
+        )
+        seen.extend(
+            int(x)
+            for batch in loader
+            for x in batch[tio.IMAGE][tio.DATA][:, 0, 0, 0, 0]
+        )
+
+    assert sorted(seen) == list(range(12))
+
+
+def test_patch_bank_settings(tmp_path):
+    """
+    Check that a bank made with different settings is refused, and that repeats of
+    a run read it in different orders
+
+    """
+    config = {
+        "torch_seed": 0,
+        "model_path": "attempt_n0.pkl",
+        "window_size": "8,8,8",
+        "patch_size": "4,4,4",
+        "transforms": {"flip": 0.5},
+    }
+    subject = tio.Subject(
+        image=tio.ScalarImage(tensor=torch.zeros((1, 4, 4, 4))),
+        label=tio.LabelMap(tensor=torch.zeros((1, 4, 4, 4), dtype=torch.uint8)),
+    )
+    patch_bank.write_patch_bank(
+        [subject],
+        tmp_path,
+        n_patches=1,
+        chunk_size=1,
+        metadata=patch_bank.metadata(config, seed=1),
+    )
+
+    patch_bank.check_metadata(tmp_path, config)
+    with pytest.raises(ValueError, match="transforms"):
+        patch_bank.check_metadata(tmp_path, config | {"transforms": {"flip": 0.1}})
+
+    assert patch_bank.shuffle_seed(config) == patch_bank.shuffle_seed(dict(config))
+    assert patch_bank.shuffle_seed(config) != patch_bank.shuffle_seed(
+        config | {"model_path": "attempt_n1.pkl"}
+    )
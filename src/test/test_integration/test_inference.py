@@ -0,0 +1,251 @@
+"""
+Integration tests for the inference helpers
+
+"""
+
+import copy
+
+import pytest
+import torch
+
+from fishlib.model import model
+from fishlib.inference import models, backends, quantisation, profiles, compiled
+
+_CONFIG = {
+    "model_params": {
+        "model_name": "monai.networks.nets.AttentionUnet",
+        "n_classes": 2,
+        "n_layers": 2,
+        "in_channels": 1,
+        "spatial_dims": 3,
+        "kernel_size": 3,
+        "n_initial_channels": 2,
+        "stride": 2,
+        "dropout": 0.0,
+    }
+}
+
+
+def test_model_registry(monkeypatch) -> None:
+    """
+    Check that networks are only built once, and the least recently used one is
+    unloaded when there are too many
+
+    """
+    state = model.ModelState(
+        model.model(_CONFIG["model_params"]).state_dict(), {}, _CONFIG
+    )
+
+    loaded = []
+
+    def load_model(model_name):
+        loaded.append(model_name)
+        return state
+
+    monkeypatch.setattr(models, "load_model", load_model)
+
+    registry = models.ModelRegistry(max_models=2)
+    a = registry.get("a.pkl", device="cpu")
+    b = registry.get("b.pkl", device="cpu", dtype=torch.bfloat16)
+
+    assert registry.get("a.pkl", device="cpu") is a
+    assert not a.net.training
+    assert next(b.net.parameters()).dtype == torch.bfloat16
+
+    # b is the least recently used
+    registry.get("c.pkl", device="cpu")
+    assert len(registry) == 2
+    assert ("b.pkl", "cpu", torch.bfloat16, "torch") not in registry
+
+    registry.get("b.pkl", device="cpu", dtype=torch.bfloat16)
+    assert loaded == ["a.pkl", "b.pkl", "c.pkl", "b.pkl"]
+
+
+def test_model_registry_empties_cuda_cache(monkeypatch) -> None:
+    """
+    Check that the CUDA cache is emptied when a model on the GPU is unloaded, whatever
+    device the model that replaces it is on
+
+    """
+    state = model.ModelState({}, {}, _CONFIG)
+    monkeypatch.setattr(models, "load_model", lambda model_name: state)
+    monkeypatch.setattr(models.backends, "load", lambda *args, **kwargs: object())
+
+    emptied = []
+    monkeypatch.setattr(torch.cuda, "empty_cache", lambda: emptied.append(True))
+
+    registry = models.ModelRegistry(max_models=1)
+    registry.get("a.pkl", device="cuda")
+    registry.get("b.pkl", device="cpu")
+    assert len(emptied) == 1
+
+    registry.get("c.pkl", device="cuda")
+    assert len(emptied) == 1
+
+
+def test_backend_fallback(tmp_path) -> None:
+    """
+    Check we get a PyTorch network if the model hasn't been exported to ONNX
+
+    """
+    net = model.model(_CONFIG["model_params"]).eval()
+    model_path = tmp_path / "my_model.pkl"
+
+    with pytest.warns(UserWarning, match="using PyTorch instead"):
+        loaded = backends.load("onnx", lambda: net, model_path, [], device="cpu")
+    assert loaded is net
+    assert backends.fingerprint(loaded) == "torch"
+
+    with pytest.raises(ValueError):
+        backends.load("tensorrt", lambda: net, model_path, [], device="cpu")
+
+
+def test_onnx_parity(tmp_path) -> None:
+    """
+    Check that the ONNX export gives the same output as PyTorch, including for a
+    different input size than it was exported with
+
+    """
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+
+    net = model.model(_CONFIG["model_params"]).eval()
+    model_path = tmp_path / "my_model.pkl"
+    backends.export(net, backends.onnx_path(model_path), input_shape=(1, 8, 8, 8))
+
+    loaded = backends.load("onnx", lambda: net, model_path, [], device="cpu")
+    assert isinstance(loaded, backends.OnnxModule)
+
+    for shape in [(1, 8, 8, 8), (1, 16, 8, 12)]:
+        assert backends.max_difference(net, loaded, shape) < 1e-4
+
+
+def test_quantised_model(tmp_path) -> None:
+    """
+    Check that a calibrated model is rebuilt the same when it's loaded, and that it
+    gives roughly the same output as the float model
+
+    """
+    torch.manual_seed(0)
+    net = model.model(_CONFIG["model_params"]).eval()
+    model_path = tmp_path / "my_model.pkl"
+
+    prepared = quantisation.prepare(net, (1, 8, 8, 8))
+    with torch.no_grad():
+        for _ in range(4):
+            prepared(torch.rand(2, 1, 8, 8, 8))
+    quantisation.save(
+        model_path, prepared, _CONFIG, input_shape=(1, 8, 8, 8), engine="x86"
+    )
+
+    loaded = backends.load("int8", lambda: net, model_path, [], device="cpu")
+    assert backends.backend_name(loaded) == "int8"
+    assert next(loaded.parameters()).dtype == torch.float32
+
+    x = torch.rand(1, 1, 8, 8, 8)
+    with torch.no_grad():
+        assert torch.equal(loaded(x), quantisation.convert(prepared)(x))
+        assert (loaded(x) - net(x)).abs().max() < 0.5
+
+
+def test_quantise_checkpointed_model() -> None:
+    """
+    Check a model built for training with activation checkpointing can still be
+    copied and quantised, and that models built for inference aren't checkpointed
+
+    """
+    params = _CONFIG["model_params"] | {"activation_checkpointing": True}
+    assert "forward" not in vars(model.model(params).model[0])
+
+    torch.manual_seed(0)
+    net = model.model(params, train=True).eval()
+    assert "forward" in vars(net.model[0])
+
+    # The copy's blocks run their own layers, not the original's
+    copied = copy.deepcopy(net)
+    assert copied.model[0].forward.__self__ is copied.model[0]
+
+    x = torch.rand(1, 1, 8, 8, 8)
+    with torch.no_grad():
+        assert torch.equal(copied(x), net(x))
+
+    prepared = quantisation.prepare(net, (1, 8, 8, 8))
+    with torch.no_grad():
+        prepared(x)
+        assert (quantisation.convert(prepared)(x) - net(x)).abs().max() < 0.5
+
+
+def test_execution_profile(tmp_path, monkeypatch) -> None:
+    """
+    Check a network run channels-last in bfloat16 gives float32 output close to the
+    original, and that the saved profile is the default
+
+    """
+    torch.manual_seed(0)
+    net = model.model(_CONFIG["model_params"]).eval()
+    x = torch.rand(2, 1, 8, 8, 8)
+    with torch.no_grad():
+        expected = net(x)
+
+    profile = profiles.get("channels_last_bf16")
+    wrapped = profiles.wrap(net, profile)
+    with torch.no_grad():
+        actual = wrapped(x)
+
+    assert actual.dtype == torch.float32
+    assert next(wrapped.parameters()).is_contiguous(
+        memory_format=torch.channels_last_3d
+    )
+    assert (actual - expected).abs().max() < 0.1
+
+    # Nothing to do for the default profile
+    assert profiles.wrap(net, profiles.get("default")) is net
+
+    monkeypatch.setattr(
+        profiles.files, "execution_profile_path", lambda: tmp_path / "profile.json"
+    )
+    assert profiles.get() == profiles.PROFILES["default"]
+    with pytest.raises(FileNotFoundError):
+        profiles.get(profiles.SAVED)
+
+    profiles.save(profile, note="test")
+    assert profiles.get() == profile
+
+
+def test_compiled_network(tmp_path, monkeypatch) -> None:
+    """
+    Check a frozen network gives the same output as the eager one, is reused from the
+    cache, and that we fall back to eager mode if it can't be compiled
+
+    """
+    torch.manual_seed(0)
+    net = model.model(_CONFIG["model_params"]).eval()
+    kwargs = {
+        "input_shape": (2, 1, 8, 8, 8),
+        "model_key": "test",
+        "profile": profiles.get("default"),
+        "cache_dir": tmp_path,
+    }
+
+    frozen, startup = compiled.compile_network(net, "frozen", **kwargs)
+    assert (startup.mode, startup.cached) == ("frozen", False)
+
+    x = torch.rand(2, 1, 8, 8, 8)
+    with torch.no_grad():
+        assert torch.allclose(frozen(x), net(x), atol=1e-5)
+        # Other shapes run eagerly
+        assert torch.allclose(frozen(x[:1]), net(x[:1]), atol=1e-5)
+
+    _, startup = compiled.compile_network(net, "frozen", **kwargs)
+    assert (startup.mode, startup.cached) == ("frozen", True)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("can't trace")
+
+    monkeypatch.setattr(torch.jit, "trace", fail)
+    with pytest.warns(UserWarning, match="running it eagerly"):
+        eager, startup = compiled.compile_network(
+            net, "frozen", **(kwargs | {"model_key": "other"})
+        )
+    assert eager is net
+    assert startup.mode == "eager"
@@ -3,7 +3,16 @@ Integration tests for the model
 
 """
 
-from fishlib.model import model
+import os
+import pickle
+
+import torch
+import pytest
+import torchio as tio
+from monai.losses import DiceLoss
+
+from fishlib.util import files
+from fishlib.model import model, patch_bank, checkpoints, artifact
 
 
 def test_model_params() -> None:
@@ -25,3 +34,362 @@ def test_model_params() -> None:
 
     # Will raise an exception if something has gone wrong
     model.model(in_params)
+
+
+def test_activation_checkpointing() -> None:
+    """
+    Check that checkpointing doesn't change the gradients or the batch norm statistics
+
+    """
+    in_params = {
+        "model_name": "monai.networks.nets.AttentionUnet",
+        "n_classes": 2,
+        "n_layers": 3,
+        "in_channels": 1,
+        "spatial_dims": 3,
+        "kernel_size": 3,
+        "n_initial_channels": 4,
+        "stride": 2,
+        "dropout": 0.2,
+    }
+    torch.manual_seed(0)
+    plain = model.model(in_params)
+    checkpointed = model.model(
+        in_params | {"activation_checkpointing": True}, train=True
+    )
+    checkpointed.load_state_dict(plain.state_dict())
+
+    x = torch.rand(2, 1, 16, 16, 16)
+    for net in (plain, checkpointed):
+        # Same dropout in both
+        torch.manual_seed(1)
+        net(x).sum().backward()
+
+    for p, q in zip(plain.parameters(), checkpointed.parameters()):
+        assert torch.allclose(p.grad, q.grad)
+
+    for (name, p), q in zip(
+        plain.state_dict().items(), checkpointed.state_dict().values()
+    ):
+        assert torch.equal(p, q), name
+
+
+def test_resume_from_checkpoint(tmp_path) -> None:
+    """
+    Check that stopping and resuming from a checkpoint gives exactly the same model
+    as training straight through
+
+    """
+    in_params = {
+        "model_name": "monai.networks.nets.AttentionUnet",
+        "n_classes": 2,
+        "n_layers": 2,
+        "in_channels": 1,
+        "spatial_dims": 3,
+        "kernel_size": 3,
+        "n_initial_channels": 2,
+        "stride": 2,
+        "dropout": 0.2,
+    }
+
+    torch.manual_seed(0)
+    patches = [
+        tio.Subject(
+            image=tio.ScalarImage(tensor=torch.rand(1, 8, 8, 8)),
+            label=tio.LabelMap(tensor=(torch.rand(1, 8, 8, 8) > 0.5).to(torch.uint8)),
+        )
+        for _ in range(6)
+    ]
+    patch_bank.write_patch_bank(patches, tmp_path / "bank", n_patches=6, chunk_size=3)
+
+    class _Data:
+        """Just enough of a DataConfig"""
+
+        def __init__(self):
+            self.train_data = patch_bank.PatchBankLoader(
+                patch_bank.PatchBank(tmp_path / "bank"), batch_size=2, n_batches=2
+            )
+            self.val_data = [next(iter(self.train_data))]
+
+        def set_epoch(self, epoch):
+            pass
+
+        def state_dict(self):
+            return {"patch_bank": self.train_data.state_dict()}
+
+        def load_state_dict(self, state):
+            self.train_data.load_state_dict(state["patch_bank"])
+
+    def run(epochs: int, checkpoint_dir, *, resume: bool, seed: int):
+        torch.manual_seed(seed)
+        net = model.model(in_params)
+        optim = torch.optim.Adam(net.parameters(), 0.01)
+        train_config = model.TrainingConfig(
+            "cpu",
+            epochs,
+            torch.optim.lr_scheduler.ExponentialLR(optim, gamma=0.9),
+            checkpoint=True,
+            checkpoint_dir=checkpoint_dir,
+            checkpoint_every=1,
+            resume=resume,
+        )
+        loss_fn = DiceLoss(to_onehot_y=True, softmax=True)
+        return model.train(net, optim, loss_fn, _Data(), train_config)
+
+    straight, straight_train, straight_val = run(
+        4, tmp_path / "a", resume=False, seed=1
+    )
+
+    run(2, tmp_path / "b", resume=False, seed=1)
+    assert [p.name for p in checkpoints.list_checkpoints(tmp_path / "b")] == [
+        "checkpoint_epoch_1.pkl",
+        "checkpoint_epoch_2.pkl",
+    ]
+
+    # Different seed, so everything must come from the checkpoint
+    resumed, resumed_train, resumed_val = run(4, tmp_path / "b", resume=True, seed=2)
+
+    assert resumed_train == straight_train
+    assert resumed_val == straight_val
+    for (name, p), q in zip(
+        straight.state_dict().items(), resumed.state_dict().values()
+    ):
+        assert torch.equal(p, q), name
+
+
+def test_prefetch_repeatable() -> None:
+    """
+    Check that two runs with the same seed give the same losses when batches are
+    read in the background and the gradients accumulated, even on the CPU where
+    dropout uses the same global random number generator that the data used to
+
+    """
+    in_params = {
+        "model_name": "monai.networks.nets.AttentionUnet",
+        "n_classes": 2,
+        "n_layers": 2,
+        "in_channels": 1,
+        "spatial_dims": 3,
+        "kernel_size": 3,
+        "n_initial_channels": 2,
+        "stride": 2,
+        "dropout": 0.2,
+    }
+    config = {
+        "batch_size": 1,
+        "num_workers": 0,
+        "patch_size": "8,8,8",
+        "foreground_ratio": 0.5,
+        "validation": {"patches": "random", "n_random": 1},
+    }
+
+    def run() -> list[float]:
+        torch.manual_seed(0)
+        subjects = tio.SubjectsDataset(
+            [
+                tio.Subject(
+                    image=tio.ScalarImage(tensor=torch.rand(1, 12, 12, 12)),
+                    label=tio.LabelMap(
+                        tensor=(torch.rand(1, 12, 12, 12) > 0.9).to(torch.uint8)
+                    ),
+                )
+                for _ in range(5)
+            ]
+        )
+        data = model.DataConfig(config, subjects, subjects)
+        net = model.model(in_params, train=True)
+        optim = torch.optim.Adam(net.parameters(), 0.01)
+        train_config = model.TrainingConfig("cpu", 3, prefetch=2, accumulation_steps=2)
+        loss_fn = DiceLoss(to_onehot_y=True, softmax=True)
+        _, train_losses, _ = model.train(net, optim, loss_fn, data, train_config)
+        return train_losses
+
+    first = run()
+    assert len(first) == 3 and all(len(epoch) == 4 for epoch in first)
+    assert run() == first
+
+
+def test_checkpoints_per_model(tmp_path) -> None:
+    """
+    Check that two models trained in the same directory each get their own
+    checkpoints, and that they're cleared up once the model is saved
+
+    """
+    in_params = {
+        "model_name": "monai.networks.nets.AttentionUnet",
+        "n_classes": 2,
+        "n_layers": 2,
+        "in_channels": 1,
+        "spatial_dims": 3,
+        "kernel_size": 3,
+        "n_initial_channels": 2,
+        "stride": 2,
+        "dropout": 0.0,
+    }
+    batch = {
+        tio.IMAGE: {tio.DATA: torch.rand(1, 1, 8, 8, 8)},
+        tio.LABEL: {tio.DATA: (torch.rand(1, 1, 8, 8, 8) > 0.5).to(torch.uint8)},
+    }
+
+    class _Data:
+        """Just enough of a DataConfig"""
+
+        train_data = [batch]
+        val_data = [batch]
+
+        def set_epoch(self, epoch):
+            pass
+
+        def state_dict(self):
+            return {}
+
+    directories = []
+    for name in ("first.pkl", "second.pkl"):
+        model_path = tmp_path / name
+        checkpoint_dir = checkpoints.checkpoint_dir(model_path)
+
+        # The first model's checkpoints mustn't be picked up by the second
+        assert not checkpoints.list_checkpoints(checkpoint_dir)
+
+        net = model.model(in_params)
+        optim = torch.optim.Adam(net.parameters(), 0.01)
+        model.train(
+            net,
+            optim,
+            DiceLoss(to_onehot_y=True, softmax=True),
+            _Data(),
+            model.TrainingConfig(
+                "cpu",
+                2,
+                checkpoint=True,
+                checkpoint_dir=checkpoint_dir,
+                checkpoint_every=1,
+            ),
+        )
+        assert len(checkpoints.list_checkpoints(checkpoint_dir)) == 2
+        directories.append(checkpoint_dir)
+
+        model_path.touch()
+        checkpoints.remove(checkpoint_dir)
+        assert not checkpoint_dir.exists()
+
+    assert directories[0] != directories[1]
+
+
+def test_model_artifact(tmp_path, monkeypatch) -> None:
+    """
+    Check that a model saved as an artifact is read instead of the pickle, and gives
+    the same network without the optimiser state
+
+    """
+    config = {
+        "model_params": {
+            "model_name": "monai.networks.nets.AttentionUnet",
+            "n_classes": 2,
+            "n_layers": 2,
+            "in_channels": 1,
+            "spatial_dims": 3,
+            "kernel_size": 3,
+            "n_initial_channels": 2,
+            "stride": 2,
+            "dropout": 0.0,
+        }
+    }
+    net = model.model(config["model_params"])
+    optimiser = torch.optim.Adam(net.parameters())
+    net(torch.rand(2, 1, 8, 8, 8)).sum().backward()
+    optimiser.step()
+
+    model_path = tmp_path / "my_model.pkl"
+    monkeypatch.setattr(files, "model_path", lambda config: model_path)
+    artifact.save(model_path, net.state_dict(), config, optimiser.state_dict())
+
+    # There's no pickle, so this has to come from the artifact
+    model_state = model.load_model("my_model.pkl")
+    assert model_state.optimizer_state_dict is None
+    assert model_state.config == config
+
+    loaded = model_state.load_model(set_eval=True)
+    x = torch.rand(1, 1, 8, 8, 8)
+    with torch.no_grad():
+        assert torch.equal(loaded(x), net.eval()(x))
+
+    # The optimiser state is still there if we want it
+    optimiser.load_state_dict(artifact.load_optimizer(model_path))
+
+
+def test_stale_model_artifact(tmp_path, monkeypatch) -> None:
+    """
+    Check that the pickle is read, with a warning, if it's newer than the artifact
+
+    """
+    config = {
+        "model_params": {
+            "model_name": "monai.networks.nets.AttentionUnet",
+            "n_classes": 2,
+            "n_layers": 2,
+            "in_channels": 1,
+            "spatial_dims": 3,
+            "kernel_size": 3,
+            "n_initial_channels": 2,
+            "stride": 2,
+            "dropout": 0.0,
+        }
+    }
+    model_path = tmp_path / "my_model.pkl"
+    monkeypatch.setattr(files, "model_path", lambda config: model_path)
+
+    old_net = model.model(config["model_params"])
+    artifact.save(model_path, old_net.state_dict(), config)
+
+    # Retrain the model, but only write the pickle
+    new_net = model.model(config["model_params"])
+    with open(model_path, "wb") as f:
+        pickle.dump(model.ModelState(new_net.state_dict(), {}, config), f)
+    for path in (artifact.paths(model_path).weights, artifact.paths(model_path).config):
+        os.utime(path, (0, 0))
+
+    assert artifact.is_stale(model_path)
+    assert artifact.model_files(model_path) == [model_path]
+    with pytest.warns(UserWarning, match="older than its pickle"):
+        model_state = model.load_model("my_model.pkl")
+    assert model_state.optimizer_state_dict == {}
+    for name, tensor in new_net.state_dict().items():
+        assert torch.equal(model_state.model_state_dict[name], tensor)
+
+
+def test_validation_autocast_dtype() -> None:
+    """
+    Check validation can run in bfloat16 on the CPU, and gives about the same loss
+
+    """
+    torch.manual_seed(0)
+    net = model.model(
+        {
+            "model_name": "monai.networks.nets.AttentionUnet",
+            "n_classes": 2,
+            "n_layers": 2,
+            "in_channels": 1,
+            "spatial_dims": 3,
+            "kernel_size": 3,
+            "n_initial_channels": 2,
+            "stride": 2,
+            "dropout": 0.0,
+        }
+    )
+    batch = {
+        tio.IMAGE: {tio.DATA: torch.rand(2, 1, 8, 8, 8)},
+        tio.LABEL: {tio.DATA: (torch.rand(2, 1, 8, 8, 8) > 0.5).to(torch.uint8)},
+    }
+    loss_fn = DiceLoss(to_onehot_y=True, softmax=True)
+
+    _, full = model._validation_step(net, loss_fn, [batch], device="cpu")
+    _, mixed = model._validation_step(
+        net,
+        loss_fn,
+        [batch],
+        device="cpu",
+        use_autocast=True,
+        autocast_dtype=torch.bfloat16,
+    )
+    assert abs(full[0] - mixed[0]) < 0.05
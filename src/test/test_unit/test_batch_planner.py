@@ -0,0 +1,29 @@
+"""
+Choosing batch sizes that fit in memory
+
+"""
+
+from fishlib.model import batch_planner
+
+
+def test_plan_batches(monkeypatch):
+    """
+    Check we choose the biggest divisor of the batch size that fits, and don't
+    try sizes we expect to go over the limit
+
+    """
+    tried = []
+
+    def measure(config, patch_size, batch_size):
+        tried.append(batch_size)
+        return 10.0 * batch_size
+
+    monkeypatch.setattr(batch_planner, "_measure", measure)
+
+    plan = batch_planner.plan_batches({}, (8, 8, 8), 12, limit=85.0)
+
+    # 8 fits but 12 doesn't; 6 is the biggest divisor of 12 below 8
+    assert tried == [1, 2, 4, 8]
+    assert plan.micro_batch_size == 6
+    assert plan.accumulation_steps == 2
+    assert plan.batch_size == 12
@@ -0,0 +1,40 @@
+"""
+Caching the stages of inference
+
+"""
+
+import numpy as np
+
+from fishlib.inference.cache import StageCache, file_fingerprint, key
+
+
+def test_stage_cache(tmp_path):
+    """
+    Check that results are cached under their key, and that forcing a stage also
+    forces the ones after it
+
+    """
+    scan = tmp_path / "scan.tif"
+    scan.write_bytes(b"not really a scan")
+    scan_key = key(file_fingerprint(scan), [512, 128, 128])
+
+    cache = StageCache(tmp_path / "cache")
+    assert cache.load("downsample", scan_key) is None
+
+    cache.save("downsample", scan_key, downsampled=np.arange(4))
+    cache.save("segment", scan_key, mask=np.ones(3, dtype=bool))
+    np.testing.assert_array_equal(
+        cache.load("downsample", scan_key)["downsampled"], np.arange(4)
+    )
+
+    # Changing the scan changes the key
+    scan.write_bytes(b"a different scan")
+    assert key(file_fingerprint(scan), [512, 128, 128]) != scan_key
+
+    forced = StageCache(tmp_path / "cache", force=("locate",))
+    assert forced.load("downsample", scan_key) is not None
+    assert forced.load("segment", scan_key) is None
+
+    # Broken files are treated as missing
+    (tmp_path / "cache" / "downsample" / f"{scan_key}.npz").write_bytes(b"oops")
+    assert cache.load("downsample", scan_key) is None
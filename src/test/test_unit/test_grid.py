@@ -0,0 +1,263 @@
+"""
+Tensor-native patch grid for inference
+
+"""
+
+import torch
+import pytest
+import numpy as np
+import torchio as tio
+
+from fishlib.model import grid, model
+
+
+def test_grid_matches_torchio():
+    """
+    Check that splitting an image into patches and stitching predictions back
+    together gives the same as torchio
+
+    """
+    torch.manual_seed(0)
+    image = torch.rand(1, 20, 18, 16)
+    patch_size, overlap = (8, 8, 8), (4, 4, 2)
+
+    def fake_prediction(patch: torch.Tensor) -> torch.Tensor:
+        """Two channels that depend on where the patch is"""
+        return torch.cat([patch, patch**2], dim=0)
+
+    # torchio
+    subject = tio.Subject(image=tio.ScalarImage(tensor=image))
+    sampler = tio.GridSampler(subject, patch_size, patch_overlap=overlap)
+    aggregator = tio.inference.GridAggregator(sampler, overlap_mode="hann")
+    for patch in sampler:
+        aggregator.add_batch(
+            fake_prediction(patch[tio.IMAGE][tio.DATA]).unsqueeze(0),
+            patch[tio.LOCATION].unsqueeze(0),
+        )
+    expected = aggregator.get_output_tensor()
+
+    # Ours
+    patches = grid.GridPatches(image, patch_size, overlap)
+    accumulator = grid.GridAccumulator(2, image.shape[1:], patch_size, overlap)
+    for i in range(len(patches)):
+        assert patches[i].data_ptr() >= image.data_ptr()  # a view, not a copy
+        accumulator.add(fake_prediction(patches[i]).unsqueeze(0), [patches.starts[i]])
+
+    assert len(patches) == len(sampler)
+    assert torch.allclose(accumulator.output(), expected, atol=1e-6)
+
+
+def test_predict_streams():
+    """
+    Check that predicting on a grid only sends the model one batch at a time, and
+    gives the same foreground probability as doing all the patches at once
+
+    """
+    torch.manual_seed(0)
+    image = torch.rand(1, 20, 18, 16)
+    patch_size, overlap = (8, 8, 8), (2, 2, 2)
+
+    class TwoChannels(torch.nn.Module):
+        """Stand-in for the model, remembering the batch sizes it was given"""
+
+        def __init__(self):
+            super().__init__()
+            self.scale = torch.nn.Parameter(torch.tensor(3.0))
+            self.batch_sizes = []
+
+        def forward(self, x):
+            self.batch_sizes.append(len(x))
+            return torch.cat([-self.scale * x, self.scale * x], dim=1)
+
+    net = TwoChannels()
+    prediction = model.predict(
+        net,
+        tio.Subject(image=tio.ScalarImage(tensor=image)),
+        patch_size=patch_size,
+        patch_overlap=overlap,
+        activation="softmax",
+        batch_size=4,
+    )
+
+    patches = grid.GridPatches(image, patch_size, overlap)
+    assert max(net.batch_sizes) == 4
+    assert sum(net.batch_sizes) == len(patches)
+
+    accumulator = grid.GridAccumulator(1, image.shape[1:], patch_size, overlap)
+    with torch.no_grad():
+        for i in range(len(patches)):
+            expected = torch.softmax(net(patches[i].unsqueeze(0)), dim=1)[:, 1:]
+            accumulator.add(expected, [patches.starts[i]])
+
+    assert torch.allclose(torch.as_tensor(prediction), accumulator.output()[0])
+
+
+def test_predict_reduced_precision():
+    """
+    Check that stitching in half precision and quantising the output gives nearly
+    the same probabilities
+
+    """
+    torch.manual_seed(0)
+    subject = tio.Subject(image=tio.ScalarImage(tensor=torch.rand(1, 12, 12, 12)))
+
+    net = torch.nn.Conv3d(1, 3, kernel_size=3, padding=1)
+    kwargs = {"patch_size": (8, 8, 8), "patch_overlap": (2, 2, 2), "batch_size": 2}
+
+    full = model.predict(net, subject, activation="softmax", **kwargs)
+    reduced = model.predict(
+        net,
+        subject,
+        activation="softmax",
+        accumulator_dtype=torch.float16,
+        quantise=True,
+        **kwargs,
+    )
+
+    assert reduced.dtype == np.uint8
+    assert np.abs(reduced / 255 - full).max() < 1 / 255 + 1e-3
+
+    logits = torch.randn(2, 3, 4, 4, 4)
+    assert torch.allclose(
+        model._foreground_probability(logits, "softmax"),
+        torch.softmax(logits, dim=1)[:, 1:2],
+        atol=1e-6,
+    )
+
+
+def test_predict_many_pools_patches():
+    """
+    Check that predicting on several images at once pools their patches into full
+    batches, and gives the same predictions as one at a time
+
+    """
+    torch.manual_seed(0)
+    subjects = [
+        tio.Subject(image=tio.ScalarImage(tensor=torch.rand(1, *shape)))
+        for shape in [(12, 12, 12), (10, 12, 14), (12, 12, 12)]
+    ]
+    net = torch.nn.Conv3d(1, 2, kernel_size=3, padding=1)
+    kwargs = {
+        "patch_size": (8, 8, 8),
+        "patch_overlap": (2, 2, 2),
+        "activation": "softmax",
+    }
+
+    batch_sizes = []
+    net.register_forward_hook(lambda module, args, out: batch_sizes.append(len(out)))
+    pooled = model.predict_many(net, subjects, batch_size=5, **kwargs)
+
+    # 8 patches in each image
+    assert batch_sizes == [5, 5, 5, 5, 4]
+    for subject, prediction in zip(subjects, pooled, strict=True):
+        np.testing.assert_allclose(
+            prediction, model.predict(net, subject, **kwargs), atol=1e-6
+        )
+
+
+def test_predict_skips_empty_patches():
+    """
+    Check that patches with nothing bright enough in them don't go through the
+    model, and are predicted as background
+
+    """
+    torch.manual_seed(0)
+    image = torch.rand(1, 16, 16, 16) * 0.1
+    image[0, 12:, 12:, 12:] = 1.0
+    subject = tio.Subject(image=tio.ScalarImage(tensor=image))
+
+    net = torch.nn.Conv3d(1, 2, kernel_size=3, padding=1)
+    batch_sizes = []
+    net.register_forward_hook(lambda module, args, out: batch_sizes.append(len(out)))
+
+    kwargs = {
+        "patch_size": (8, 8, 8),
+        "patch_overlap": (0, 0, 0),
+        "activation": "softmax",
+    }
+    full = model.predict(net, subject, **kwargs)
+    skipped = model.predict(net, subject, skip_threshold=0.5, **kwargs)
+
+    # Only the corner patch has anything bright in it
+    assert batch_sizes[8:] == [1]
+    np.testing.assert_allclose(skipped[8:, 8:, 8:], full[8:, 8:, 8:], atol=1e-6)
+    assert (skipped[:8] == 0).all()
+
+    patches = grid.GridPatches(image, (8, 8, 8))
+    assert (patches.maxima() >= torch.stack([p.max() for p in patches])).all()
+
+
+def test_predict_whole_window():
+    """
+    Check that the whole window can go through the model in one go, padded to a
+    multiple of the model's stride, and that we fall back to patches if it doesn't
+    fit in memory
+
+    """
+
+    class SmallInputs(torch.nn.Module):
+        """Pretend we run out of memory for anything bigger than a patch"""
+
+        def __init__(self):
+            super().__init__()
+            self.conv = torch.nn.Conv3d(1, 2, kernel_size=1)
+            self.shapes = []
+
+        def forward(self, x):
+            self.shapes.append(tuple(x.shape[2:]))
+            if x.shape[2] > 8:
+                raise RuntimeError("CUDA out of memory. Tried to allocate a lot")
+            return self.conv(x)
+
+    torch.manual_seed(0)
+    subject = tio.Subject(image=tio.ScalarImage(tensor=torch.rand(1, 7, 6, 8)))
+    net = SmallInputs()
+    kwargs = {
+        "patch_size": (4, 4, 4),
+        "patch_overlap": (0, 0, 0),
+        "activation": "softmax",
+    }
+
+    whole = model.predict(net, subject, whole_window_multiple=4, **kwargs)
+    assert net.shapes == [(8, 8, 8)]
+    expected = torch.softmax(net.conv(subject[tio.IMAGE][tio.DATA][None]), dim=1)
+    np.testing.assert_allclose(whole, expected[0, 1].detach().numpy(), atol=1e-6)
+
+    big = tio.Subject(image=tio.ScalarImage(tensor=torch.rand(1, 12, 8, 8)))
+    net.shapes.clear()
+    with pytest.warns(UserWarning, match="splitting it into patches"):
+        tiled = model.predict(net, big, whole_window_multiple=4, **kwargs)
+    assert net.shapes[0] == (12, 8, 8)
+    assert set(net.shapes[1:]) == {(4, 4, 4)}
+    assert tiled.shape == (12, 8, 8)
+
+
+def test_predict_whole_window_memory_estimate(monkeypatch):
+    """
+    Check that we don't try the whole window if our estimate says it won't fit
+
+    """
+    net = torch.nn.Conv3d(1, 2, kernel_size=1)
+    calls = []
+    net.register_forward_hook(lambda module, args, out: calls.append(args[0].shape))
+
+    # 8x8x8 voxels x 2 channels x 1 convolution x 4 bytes
+    assert model._activation_memory(net, (8, 8, 8)) == 8**3 * 2 * 4
+
+    subject = tio.Subject(image=tio.ScalarImage(tensor=torch.rand(1, 7, 6, 8)))
+    kwargs = {
+        "patch_size": (4, 4, 4),
+        "patch_overlap": (0, 0, 0),
+        "activation": "softmax",
+        "whole_window_multiple": 4,
+    }
+
+    monkeypatch.setattr(model, "_available_memory", lambda device: 8**3 * 2 * 4)
+    model.predict(net, subject, **kwargs)
+    assert [tuple(shape[2:]) for shape in calls] == [(8, 8, 8)]
+
+    calls.clear()
+    monkeypatch.setattr(model, "_available_memory", lambda device: 8**3 * 2 * 4 - 1)
+    with pytest.warns(UserWarning, match="probably won't fit"):
+        model.predict(net, subject, **kwargs)
+    assert {tuple(shape[2:]) for shape in calls} == {(4, 4, 4)}
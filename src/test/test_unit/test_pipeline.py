@@ -0,0 +1,119 @@
+"""
+Pipelined inference
+
+"""
+
+import os
+
+import pytest
+
+from fishlib.inference.pipeline import Pipeline, WorkerError, run_in_processes
+
+
+def _read(item: int) -> int:
+    if item == 3:
+        raise OSError("Can't read")
+    return item
+
+
+def _compute(item: int, data: int) -> int:
+    if item == 5:
+        raise KeyError("Can't compute")
+    return data * 10
+
+
+def test_pipeline_failures():
+    """
+    Check that every item gets through, apart from the ones that fail
+
+    """
+    written = []
+    pipeline = Pipeline(
+        _read,
+        _compute,
+        lambda item, result: written.append((item, result)),
+        n_readers=3,
+        n_writers=2,
+        queue_size=1,
+        item_errors=(OSError, KeyError),
+    )
+    report = pipeline.run(range(20))
+
+    assert sorted(written) == [(i, i * 10) for i in range(20) if i not in {3, 5}]
+    assert sorted((f.item, f.stage) for f in report.failures) == [
+        (3, "read"),
+        (5, "compute"),
+    ]
+    assert [stage.n_done for stage in report.stages] == [20, 19, 18]
+
+
+def test_pipeline_error():
+    """
+    Check that an unexpected error stops the pipeline and is raised
+
+    """
+
+    def write(item: int, result: int) -> None:
+        if item == 2:
+            raise RuntimeError("Disk on fire")
+
+    pipeline = Pipeline(_read, _compute, write, item_errors=(OSError, KeyError))
+    with pytest.raises(RuntimeError, match="Disk on fire"):
+        pipeline.run(range(100))
+
+
+def test_pipeline_processes(tmp_path):
+    """
+    Check that the items get shared between worker processes
+
+    """
+
+    def write(item: int, result: int) -> None:
+        (tmp_path / f"{item}_{result}_{os.getpid()}").touch()
+
+    pipeline = Pipeline(_read, _compute, write, item_errors=(OSError, KeyError))
+    report = run_in_processes(pipeline, range(20), n_workers=2, threads_per_worker=1)
+
+    written = [path.name.split("_") for path in tmp_path.iterdir()]
+    assert sorted((int(i), int(r)) for i, r, _ in written) == [
+        (i, i * 10) for i in range(20) if i not in {3, 5}
+    ]
+    assert os.getpid() not in {int(pid) for *_, pid in written}
+    assert sorted(f.item for f in report.failures) == [3, 5]
+    assert [stage.n_threads for stage in report.stages] == [4, 2, 4]
+
+    # Unexpected errors in a worker are raised here
+    pipeline = Pipeline(_read, _compute, write)
+    with pytest.raises(WorkerError, match="Can't (read|compute)"):
+        run_in_processes(pipeline, range(20), n_workers=2, threads_per_worker=1)
+
+
+def test_pipeline_batches():
+    """
+    Check that batched compute gets full batches, and that one item in a batch can
+    fail without the others
+
+    """
+
+    def compute(items: list[int], data: list[int]) -> list[int | KeyError]:
+        sizes.append(len(items))
+        return [
+            KeyError("Can't compute") if i == 5 else d * 10 for i, d in zip(items, data)
+        ]
+
+    sizes, written = [], []
+    pipeline = Pipeline(
+        _read,
+        compute,
+        lambda item, result: written.append((item, result)),
+        item_errors=(OSError, KeyError),
+        batch_size=4,
+    )
+    report = pipeline.run(range(20))
+
+    assert sizes == [4, 4, 4, 4, 3]
+    assert sorted(written) == [(i, i * 10) for i in range(20) if i not in {3, 5}]
+    assert sorted((f.item, f.stage) for f in report.failures) == [
+        (3, "read"),
+        (5, "compute"),
+    ]
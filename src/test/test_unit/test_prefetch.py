@@ -0,0 +1,73 @@
+"""
+Tests for getting batches ready in the background
+
+"""
+
+import pytest
+import torch
+import torchio as tio
+
+from fishlib.model import prefetch
+
+
+def _batches(n: int) -> list[dict[str, dict[str, torch.Tensor]]]:
+    """
+    Some small batches, each filled with its index
+
+    """
+    return [
+        {
+            tio.IMAGE: {tio.DATA: torch.full((2, 1, 4, 4, 4), float(i))},
+            tio.LABEL: {tio.DATA: torch.full((2, 1, 4, 4, 4), i % 2)},
+        }
+        for i in range(n)
+    ]
+
+
+@pytest.mark.parametrize("depth", [0, 1, 3])
+def test_prefetch_order(depth):
+    """
+    Check we get the same batches out, in the same order
+
+    """
+    batches = list(prefetch.Prefetcher(_batches(5), "cpu", depth=depth))
+
+    assert [int(b.image[0, 0, 0, 0, 0]) for b in batches] == list(range(5))
+    assert [b.foreground_fraction for b in batches] == [0.0, 1.0, 0.0, 1.0, 0.0]
+
+
+def test_prefetch_error():
+    """
+    Check an error while loading is raised in the main thread
+
+    """
+
+    def broken():
+        yield from _batches(2)
+        raise RuntimeError("Broken loader")
+
+    prefetcher = prefetch.Prefetcher(broken(), "cpu", depth=2)
+    with pytest.raises(RuntimeError, match="Broken loader"):
+        for _ in prefetcher:
+            pass
+
+
+@pytest.mark.parametrize("depth", [0, 3])
+def test_prefetch_n_batches(depth):
+    """
+    Check we don't read any further than we're told to, even in the background
+
+    """
+    read = []
+
+    def loader():
+        for i, batch in enumerate(_batches(6)):
+            read.append(i)
+            yield batch
+
+    prefetcher = prefetch.Prefetcher(list(_batches(6)), "cpu", n_batches=4)
+    assert len(prefetcher) == 4
+
+    batches = list(prefetch.Prefetcher(loader(), "cpu", depth=depth, n_batches=4))
+    assert len(batches) == 4
+    assert read == [0, 1, 2, 3]
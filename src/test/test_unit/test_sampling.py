@@ -0,0 +1,108 @@
+"""
+Tests for choosing where patches come from
+
+"""
+
+import torch
+import torchio as tio
+
+from fishlib.model import sampling
+
+
+def test_foreground_density():
+    """
+    Check the summed-area table gives the same foreground fraction as counting
+    the voxels in each patch directly
+
+    """
+    torch.manual_seed(0)
+    label = (torch.rand(1, 20, 17, 13) > 0.8).to(torch.uint8)
+    patch_size = (8, 6, 5)
+    downsample = 3
+
+    density = sampling.foreground_density(label, patch_size, downsample)
+
+    assert density.shape == (5, 4, 3)
+    for z, y, x in torch.cartesian_prod(*[torch.arange(n) for n in density.shape]):
+        i, j, k = z * downsample, y * downsample, x * downsample
+
+        # Only the part of the patch it covers wherever it's moved within the block
+        expected = label[0, i + 2 : i + 8, j + 2 : j + 6, k + 2 : k + 5].sum() / (
+            6 * 4 * 3
+        )
+
+        assert torch.isclose(density[z, y, x], expected.float())
+
+
+def test_foreground_locations():
+    """
+    Check that patches always contain foreground if we ask for it
+
+    """
+    torch.manual_seed(0)
+    label = torch.zeros(1, 32, 32, 32, dtype=torch.uint8)
+    label[0, 28:, 28:, 28:] = 1
+    subject = tio.Subject(
+        image=tio.ScalarImage(tensor=torch.rand(1, 32, 32, 32)),
+        label=tio.LabelMap(tensor=label),
+    )
+
+    locations = sampling.ForegroundLocations(1.0, downsample=4)
+    for _ in range(20):
+        z, y, x = locations(subject, (8, 8, 8))
+        assert label[0, z : z + 8, y : y + 8, x : x + 8].any()
+
+
+def test_foreground_patches_contain_foreground():
+    """
+    Check that every patch chosen to contain foreground does, wherever it's moved
+    within its block - including for small blobs of label near the edge of a patch
+
+    """
+    torch.manual_seed(1)
+    patch_size = (8, 7, 7)
+    for _ in range(10):
+        label = torch.zeros(1, 29, 27, 25, dtype=torch.uint8)
+        # Not right at the edges, which no patch's counted region reaches
+        for z, y, x in torch.randint(3, 20, (2, 3)):
+            label[0, z, y, x] = 1
+        subject = tio.Subject(
+            image=tio.ScalarImage(tensor=torch.rand(1, 29, 27, 25)),
+            label=tio.LabelMap(tensor=label),
+        )
+
+        sampler = sampling.ForegroundSampler(
+            patch_size, sampling.ForegroundLocations(1.0, downsample=4, cache=False)
+        )
+        for patch in sampler(subject, num_patches=50):
+            assert patch[tio.LABEL][tio.DATA].any()
+
+
+def test_foreground_sampler_density_once(monkeypatch):
+    """
+    Check the sampler only finds the density map once per subject it draws from,
+    even when it isn't cached
+
+    """
+    calls = []
+    foreground_density = sampling.foreground_density
+
+    def counted(*args):
+        calls.append(args)
+        return foreground_density(*args)
+
+    monkeypatch.setattr(sampling, "foreground_density", counted)
+
+    label = torch.zeros(1, 16, 16, 16, dtype=torch.uint8)
+    label[0, 4:8, 4:8, 4:8] = 1
+    subject = tio.Subject(
+        image=tio.ScalarImage(tensor=torch.rand(1, 16, 16, 16)),
+        label=tio.LabelMap(tensor=label),
+    )
+    sampler = sampling.ForegroundSampler(
+        (8, 8, 8), sampling.ForegroundLocations(0.5, cache=False)
+    )
+
+    assert len(list(sampler(subject, num_patches=10))) == 10
+    assert len(calls) == 1
+    assert sampling.DENSITY_KEY not in subject
@@ -0,0 +1,109 @@
+"""
+Tests for the fixed validation patches
+
+"""
+
+import gc
+
+import yaml
+import torch
+import torchio as tio
+
+from fishlib.util import util
+from fishlib.model import validation
+
+
+def test_grid_starts():
+    """
+    Check the grid is the same as the one torchio would use
+
+    """
+    shape, patch_size, overlap = (24, 19, 16), (16, 8, 16), (4, 2, 0)
+    subject = tio.Subject(image=tio.ScalarImage(tensor=torch.rand(1, *shape)))
+
+    expected = [
+        tuple(int(x) for x in patch[tio.LOCATION][:3])
+        for patch in tio.GridSampler(subject, patch_size, overlap)
+    ]
+
+    assert validation.grid_starts(shape, patch_size, overlap) == expected
+
+
+def test_validation_patches():
+    """
+    Check the patches are cut out of the right place and batched correctly
+
+    """
+    image = torch.arange(8**3, dtype=torch.float32).reshape(1, 8, 8, 8)
+    subjects = tio.SubjectsDataset(
+        [
+            tio.Subject(
+                image=tio.ScalarImage(tensor=image),
+                label=tio.LabelMap(tensor=(image > 100).to(torch.uint8)),
+            )
+        ]
+    )
+
+    patches = validation.ValidationPatches.from_subjects(
+        subjects, (4, 4, 4), mode="grid", batch_size=3
+    )
+
+    assert len(patches) == 3
+    batches = list(patches)
+    assert [len(b[tio.IMAGE][tio.DATA]) for b in batches] == [3, 3, 2]
+
+    # The last patch is the corner
+    assert torch.equal(batches[-1][tio.IMAGE][tio.DATA][-1], image[:, 4:, 4:, 4:])
+    assert torch.equal(
+        batches[-1][tio.LABEL][tio.DATA][-1], (image[:, 4:, 4:, 4:] > 100)
+    )
+
+
+def test_validation_patches_memmap(tmp_path):
+    """
+    Check that each run memory-maps its patches into its own directory, and that
+    they're deleted once they're not needed
+
+    """
+    subjects = [
+        tio.SubjectsDataset(
+            [
+                tio.Subject(
+                    image=tio.ScalarImage(tensor=torch.full((1, 8, 8, 8), value)),
+                    label=tio.LabelMap(
+                        tensor=torch.ones(1, 8, 8, 8, dtype=torch.uint8)
+                    ),
+                )
+            ]
+        )
+        for value in (1.0, 2.0)
+    ]
+    first, second = (
+        validation.ValidationPatches.from_subjects(
+            dataset, (4, 4, 4), mode="grid", batch_size=3, memmap_dir=tmp_path
+        )
+        for dataset in subjects
+    )
+
+    # Making the second set didn't write over the first
+    assert (first.images == 1).all()
+    assert (second.images == 2).all()
+    assert len(list(tmp_path.glob("*/*.npy"))) == 4
+
+    del first, second
+    gc.collect()
+    assert not list(tmp_path.iterdir())
+
+
+def test_validation_defaults():
+    """
+    Check the defaults used when the config has no validation section are the same
+    as the ones in userconf.yml
+
+    """
+    # Not util.userconf(), since that can only be called once per process
+    with open(util.rootdir() / "userconf.yml", "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+    assert validation.validation_options(
+        {"batch_size": config["batch_size"]}
+    ) == validation.validation_options(config)
@@ -0,0 +1,89 @@
+"""
+Sharing work between machines through lease files
+
+"""
+
+import gc
+import os
+import time
+import multiprocessing
+
+from fishlib.inference import work_queue
+from fishlib.inference.work_queue import WorkQueue
+
+
+def _work(directory, items: list[str], crash_after: int | None) -> None:
+    """
+    Do some work from the queue, maybe crashing part way through
+
+    """
+    with WorkQueue(directory, lease_time=1.0, heartbeat=0.1) as queue:
+        for i, item in enumerate(queue.claim_all(items)):
+            if i == crash_after:
+                # Leave the lease behind, like a machine that's died
+                os._exit(1)
+            time.sleep(0.01)
+            queue.complete(item, pid=os.getpid())
+
+
+def test_claim(tmp_path):
+    """
+    Check that only one queue gets an item, and nobody gets it once it's finished
+
+    """
+    first, second = WorkQueue(tmp_path), WorkQueue(tmp_path)
+
+    assert first.claim("a")
+    assert not second.claim("a")
+
+    first.complete("a")
+    assert not second.claim("a")
+    assert first.manifest()["a"]["status"] == "done"
+
+
+def test_crashed_work_redone(tmp_path):
+    """
+    Check that several processes do all the work between them, including the work
+    claimed by one that crashes
+
+    """
+    items = [f"scan_{i}" for i in range(20)]
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=_work, args=(tmp_path, items, crash_after))
+        for crash_after in (2, None, None)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+
+    assert [process.exitcode for process in processes] == [1, 0, 0]
+
+    manifest = WorkQueue(tmp_path).manifest()
+    assert sorted(manifest) == sorted(items)
+    assert {record["status"] for record in manifest.values()} == {"done"}
+
+    # The one it was working on when it crashed was done by someone else
+    pids = [record["pid"] for record in manifest.values()]
+    assert pids.count(processes[0].pid) == 2
+    assert not list((tmp_path / "leases").iterdir())
+
+
+def test_fork_with_lock_held(tmp_path):
+    """
+    Check that a queue still works in a child forked while its lock was held, and
+    that finished queues aren't kept alive for the sake of forking
+
+    """
+    queue = WorkQueue(tmp_path)
+    context = multiprocessing.get_context("fork")
+    with queue._lock:
+        process = context.Process(target=lambda: queue.claim("a") or os._exit(1))
+        process.start()
+    process.join(timeout=60)
+    assert process.exitcode == 0
+
+    del queue
+    gc.collect()
+    assert not work_queue._QUEUES